@@ -0,0 +1,207 @@
+# Benchmark of the OCR path on synthetic counter photos
+#
+# Usage (from the root directory of the project):
+#   python -m benchmarks.ocr_pipeline run --images 200 --output bench.json
+#   python -m benchmarks.ocr_pipeline run --model <file in ocr-models> --recognizer easyocr --output bench.json
+#   python -m benchmarks.ocr_pipeline compare baseline.json bench.json
+#
+# Without --model the fields are cropped at the boxes of the synthetic panel (a ROI template),
+# so the benchmark needs no detection model. With the seven segment recognizer it then needs
+# no downloaded weights at all and runs offline on a CPU.
+# compare exits with 1 if the second run regressed, so it can gate a change.
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+
+from .synthetic import DEFAULT_LABELS, generate_dataset, roi_template
+
+PERCENTILES = [50, 95, 99]
+
+# metric -> whether higher values are better
+COMPARED_METRICS = {
+    "throughput_images_per_second": True,
+    "latency_seconds.p50": False,
+    "latency_seconds.p95": False,
+    "latency_seconds.p99": False,
+    "peak_rss_mb": False,
+}
+ACCURACY_METRICS = ["accuracy.fields", "accuracy.digits"]
+
+
+def percentiles(values: list[float]) -> dict:
+    if len(values) == 0:
+        return {f"p{p}": None for p in PERCENTILES}
+    return {f"p{p}": float(np.percentile(values, p)) for p in PERCENTILES}
+
+
+def digit_accuracy(expected: str, predicted: str | None) -> float:
+    """Fraction of the digits read right, position by position."""
+    if not predicted:
+        return 0.0
+    matches = sum(a == b for a, b in zip(expected, predicted))
+    return matches / max(len(expected), len(predicted))
+
+
+def run(args) -> dict:
+    # imported here, so the settings can be changed before the first image is read
+    from src.config import APP_SETTINGS
+    from src.utils import ocr_model
+
+    APP_SETTINGS.OCR_ALLOW_DOWNLOADS = args.allow_downloads
+    if not args.fallback:
+        # seven segment fields are kept whatever their confidence, EasyOCR is never loaded
+        APP_SETTINGS.OCR_SEVEN_SEGMENT_MIN_CONFIDENCE = 0.0
+
+    dataset = generate_dataset(args.images + args.warm_up, DEFAULT_LABELS, args.digits, args.seed)
+    options = {"recognizer": args.recognizer}
+    if args.model is None:
+        options["roi_template"] = roi_template(dataset[:10], DEFAULT_LABELS, args.digits)
+        # the synthetic photos all line up with the panel, only the digits change
+        APP_SETTINGS.OCR_ROI_MIN_ALIGNMENT_SCORE = 0.0
+    model_name = args.model or "synthetic-roi-template"
+
+    for sample in dataset[:args.warm_up]:
+        ocr_model.get_digits_from_image(sample["contents"], model_name, options)
+    ocr_model.timings.drain()
+
+    latencies = []
+    stages = dict()
+    fields_right = 0
+    digits_right = 0.0
+    n_fields = 0
+    start = time.perf_counter()
+    for sample in dataset[args.warm_up:]:
+        image_start = time.perf_counter()
+        results = ocr_model.get_digits_from_image(sample["contents"], model_name, options)
+        latencies.append(time.perf_counter() - image_start)
+        for stage, seconds in ocr_model.timings.drain():
+            stages.setdefault(stage, []).append(seconds)
+        for label, expected in sample["values"].items():
+            predicted = results["values"].get(label)
+            n_fields += 1
+            fields_right += predicted == expected
+            digits_right += digit_accuracy(expected, predicted)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "config": {
+            "images": args.images,
+            "warm_up": args.warm_up,
+            "seed": args.seed,
+            "digits": args.digits,
+            "labels": DEFAULT_LABELS,
+            "model": args.model,
+            "recognizer": args.recognizer,
+            "fallback": args.fallback,
+            "inference_backend": APP_SETTINGS.OCR_INFERENCE_BACKEND,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+        },
+        "throughput_images_per_second": args.images / elapsed,
+        "latency_seconds": {"mean": float(np.mean(latencies)), **percentiles(latencies)},
+        "stages": {
+            stage: {"count": len(seconds), "total_seconds": float(np.sum(seconds)), **percentiles(seconds)}
+            for stage, seconds in stages.items()
+        },
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "accuracy": {"fields": fields_right / n_fields, "digits": digits_right / n_fields},
+    }
+
+
+def get_metric(report: dict, metric: str):
+    value = report
+    for key in metric.split("."):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def compare(baseline: dict, candidate: dict, tolerance: float, accuracy_tolerance: float) -> dict:
+    """
+    Compare two runs. A metric regressed if it got worse by more than tolerance (relative),
+    or for the accuracy, dropped by more than accuracy_tolerance (absolute).
+    The stage latencies are compared too, but only reported.
+    """
+    metrics = dict()
+    for metric, higher_is_better in COMPARED_METRICS.items():
+        before, after = get_metric(baseline, metric), get_metric(candidate, metric)
+        if not before or after is None:
+            continue
+        change = (after - before) / before
+        regressed = change < -tolerance if higher_is_better else change > tolerance
+        metrics[metric] = {"baseline": before, "candidate": after, "change": change, "regressed": regressed}
+    for metric in ACCURACY_METRICS:
+        before, after = get_metric(baseline, metric), get_metric(candidate, metric)
+        if before is None or after is None:
+            continue
+        metrics[metric] = {"baseline": before, "candidate": after, "change": after - before, "regressed": before - after > accuracy_tolerance}
+
+    stages = dict()
+    for stage in sorted(set(baseline.get("stages", {})) & set(candidate.get("stages", {}))):
+        before, after = baseline["stages"][stage]["p50"], candidate["stages"][stage]["p50"]
+        if before:
+            stages[stage] = {"baseline_p50": before, "candidate_p50": after, "change": (after - before) / before}
+
+    if baseline.get("config") != candidate.get("config"):
+        print("Warning: the runs were made with different configurations", file=sys.stderr)
+    return {
+        "regressed": [metric for metric, result in metrics.items() if result["regressed"]],
+        "metrics": metrics,
+        "stages": stages,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the OCR path on synthetic counter photos")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run the benchmark")
+    run_parser.add_argument("--images", type=int, default=100, help="number of measured images (default: 100)")
+    run_parser.add_argument("--warm-up", type=int, default=5, help="images read before measuring (default: 5)")
+    run_parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic photos (default: 0)")
+    run_parser.add_argument("--digits", type=int, default=5, help="digits per field (default: 5)")
+    run_parser.add_argument("--model", default=None, help="detection model file in ocr-models (default: crop the fields at the synthetic panel boxes)")
+    run_parser.add_argument("--recognizer", choices=["easyocr", "seven_segment"], default="seven_segment", help="(default: seven_segment)")
+    run_parser.add_argument("--fallback", action="store_true", help="let the seven segment recognizer fall back to EasyOCR")
+    run_parser.add_argument("--allow-downloads", action="store_true", help="allow downloading the YOLOv5 repo and EasyOCR weights")
+    run_parser.add_argument("--output", default=None, help="write the report to this file (default: stdout)")
+
+    compare_parser = subparsers.add_parser("compare", help="compare two runs, exits with 1 on a regression")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--tolerance", type=float, default=0.1, help="relative change allowed for latency, throughput and memory (default: 0.1)")
+    compare_parser.add_argument("--accuracy-tolerance", type=float, default=0.0, help="accuracy drop allowed (default: 0.0)")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        # the OCR path logs with print, keep stdout for the report
+        with contextlib.redirect_stdout(sys.stderr):
+            report = json.dumps(run(args), indent=2)
+        if args.output is None:
+            print(report)
+        else:
+            with open(args.output, "w") as f:
+                f.write(report)
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    result = compare(baseline, candidate, args.tolerance, args.accuracy_tolerance)
+    print(json.dumps(result, indent=2))
+    if result["regressed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
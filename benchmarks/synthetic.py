@@ -0,0 +1,111 @@
+# Synthetic counter display photos with known digits
+#
+# Every photo shows a panel of seven segment displays, one per field label, at the same
+# place in every photo (like a fixed camera), with a little noise, lighting change and
+# camera shake. The ground truth digits and the field boxes come with every photo.
+
+import cv2
+import numpy as np
+
+from src.utils.roi_templates import learn_roi_template, roi_sample
+
+DEFAULT_LABELS = ["Total Production", "Good Production", "Rejection", "Neck Finish", "Ovality", "Foreign Container"]
+
+SEGMENTS = {
+    "0": "abcdef", "1": "bc", "2": "abdeg", "3": "abcdg", "4": "bcfg",
+    "5": "acdfg", "6": "acdefg", "7": "abc", "8": "abcdefg", "9": "abcdfg",
+}
+
+PHOTO_SIZE = (1280, 960)
+DIGIT_HEIGHT, DIGIT_WIDTH, SEGMENT_THICKNESS, DIGIT_GAP = 60, 32, 7, 12
+MAX_SHAKE = 4
+
+
+def draw_digits(panel: np.ndarray, digits: str, x: int, y: int, color: tuple):
+    h, w, t = DIGIT_HEIGHT, DIGIT_WIDTH, SEGMENT_THICKNESS
+    for i, digit in enumerate(digits):
+        left = x + i * (w + DIGIT_GAP)
+        regions = {
+            "a": (left + t, y, left + w - t, y + t),
+            "b": (left + w - t, y + t, left + w, y + h // 2),
+            "c": (left + w - t, y + h // 2, left + w, y + h - t),
+            "d": (left + t, y + h - t, left + w - t, y + h),
+            "e": (left, y + h // 2, left + t, y + h - t),
+            "f": (left, y + t, left + t, y + h // 2),
+            "g": (left + t, y + h // 2 - t // 2, left + w - t, y + h // 2 + t // 2 + 1),
+        }
+        for segment in SEGMENTS[digit]:
+            x1, y1, x2, y2 = regions[segment]
+            cv2.rectangle(panel, (x1, y1), (x2 - 1, y2 - 1), color, -1)
+
+
+def layout(labels: list[str], n_digits: int) -> dict:
+    """label -> (x1, y1, x2, y2) box of its display in the photo, two columns of displays."""
+    display_width = n_digits * (DIGIT_WIDTH + DIGIT_GAP) + DIGIT_GAP
+    display_height = DIGIT_HEIGHT + 20
+    boxes = dict()
+    for i, label in enumerate(labels):
+        x = 120 + (i % 2) * 560
+        y = 140 + (i // 2) * 220
+        boxes[label] = (x, y, x + display_width, y + display_height)
+    return boxes
+
+
+def render_photo(values: dict, n_digits: int, rng: np.random.Generator) -> np.ndarray:
+    """A BGR photo of the panel showing values (label -> digits)."""
+    width, height = PHOTO_SIZE
+    photo = np.full((height, width, 3), (90, 95, 100), np.uint8)
+    for label, (x1, y1, x2, y2) in layout(list(values.keys()), n_digits).items():
+        cv2.putText(photo, label, (x1, y1 - 16), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (235, 235, 235), 2)
+        cv2.rectangle(photo, (x1, y1), (x2 - 1, y2 - 1), (190, 210, 200), -1)
+        draw_digits(photo, values[label], x1 + DIGIT_GAP, y1 + 10, (40, 40, 40))
+
+    # camera shake, lighting and sensor noise
+    shift = rng.integers(-MAX_SHAKE, MAX_SHAKE + 1, size=2)
+    photo = cv2.warpAffine(photo, np.float32([[1, 0, shift[0]], [0, 1, shift[1]]]), (width, height), borderMode=cv2.BORDER_REPLICATE)
+    photo = photo.astype(np.float32) * rng.uniform(0.85, 1.15) + rng.normal(0, 4, photo.shape)
+    return np.clip(photo, 0, 255).astype(np.uint8)
+
+
+def ocr_boxes(labels: list[str], n_digits: int) -> dict:
+    """
+    The display boxes in the pixels of the photo, shrunk by the camera shake so the crops never
+    take in the panel around a display.
+    """
+    margin = MAX_SHAKE + 1
+    return {
+        label: [x1 + margin, y1 + margin, x2 - margin, y2 - margin]
+        for label, (x1, y1, x2, y2) in layout(labels, n_digits).items()
+    }
+
+
+def generate_dataset(n_images: int, labels: list[str] = DEFAULT_LABELS, n_digits: int = 5, seed: int = 0) -> list[dict]:
+    """
+    Returns:
+        list[dict]: for every photo, the JPEG "contents" and the ground truth "values"
+    """
+    rng = np.random.default_rng(seed)
+    dataset = []
+    for _ in range(n_images):
+        total = int(rng.integers(10 ** (n_digits - 1), 10 ** n_digits))
+        values = dict()
+        for label in labels:
+            value = total if label == "Total Production" else int(rng.integers(0, total + 1))
+            values[label] = str(value).zfill(n_digits)
+        photo = render_photo(values, n_digits, rng)
+        _, encoded = cv2.imencode(".jpg", photo, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        dataset.append({"contents": encoded.tobytes(), "values": values})
+    return dataset
+
+
+def roi_template(dataset: list[dict], labels: list[str] = DEFAULT_LABELS, n_digits: int = 5) -> dict:
+    """
+    A ROI template of the panel, learned the way the app learns it from detections, so the
+    fields can be read without a detection model.
+    """
+    boxes = ocr_boxes(labels, n_digits)
+    samples = []
+    for sample in dataset:
+        img = cv2.imdecode(np.frombuffer(sample["contents"], np.uint8), cv2.IMREAD_COLOR)
+        samples.append(roi_sample(img, boxes, labels))
+    return learn_roi_template(samples, min_iou=0.5)
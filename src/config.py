@@ -1,6 +1,8 @@
 # Global config
 
 
+from typing import Literal
+
 from pydantic_settings import BaseSettings
 from pydantic import Field, SecretStr
 
@@ -151,6 +153,418 @@ class AppSettings(BaseSettings):
         type="string",
     )
 
+    OCR_WORKERS: int = Field(
+        default=2,
+        title="OCR workers",
+        description="Number of worker processes used for running OCR inference",
+        type="integer",
+        ge=1,
+    )
+
+    OCR_QUEUE_SIZE: int = Field(
+        default=16,
+        title="OCR queue size",
+        description="Maximum number of OCR jobs that can be waiting or running at the same time, extra uploads are rejected",
+        type="integer",
+        ge=1,
+    )
+
+    OCR_BATCH_MAX_SIZE: int = Field(
+        default=8,
+        title="OCR batch max size",
+        description="Maximum number of images run through an OCR model in a single forward pass (1 disables batching)",
+        type="integer",
+        ge=1,
+    )
+
+    OCR_BATCH_MAX_WAIT_MS: int = Field(
+        default=20,
+        title="OCR batch max wait",
+        description="Maximum time in milliseconds an image waits for other images to be batched with",
+        type="integer",
+        ge=0,
+    )
+
+    OCR_RECOGNIZER_ONLY: bool = Field(
+        default=False,
+        title="OCR recognizer only",
+        description="Feed the detected counter regions straight to the EasyOCR recognizer, without loading or running its text detector",
+        type="boolean",
+    )
+
+    OCR_MODEL_CACHE_MAX_MODELS: int = Field(
+        default=8,
+        title="OCR model cache max models",
+        description="Maximum number of OCR models kept loaded by each inference worker (0 means no limit)",
+        type="integer",
+        ge=0,
+    )
+
+    OCR_MODEL_CACHE_MAX_MB: int = Field(
+        default=0,
+        title="OCR model cache max MB",
+        description="Maximum size in MB of the OCR models kept loaded by each inference worker (0 means no limit)",
+        type="integer",
+        ge=0,
+    )
+
+    OCR_WARM_UP_MODELS: int = Field(
+        default=2,
+        title="OCR warm up models",
+        description="Number of most recently uploaded OCR models each inference worker loads in the background on startup",
+        type="integer",
+        ge=0,
+    )
+
+    OCR_YOLOV5_REPO_DIR: str = Field(
+        default="",
+        title="YOLOv5 repo directory",
+        description="Local copy of the ultralytics/yolov5 repo used to load the OCR models (defaults to the torch hub cache)",
+        type="string",
+    )
+
+    OCR_EASYOCR_MODEL_DIR: str = Field(
+        default="",
+        title="EasyOCR model directory",
+        description="Directory holding the EasyOCR weights (defaults to ~/.EasyOCR/model)",
+        type="string",
+    )
+
+    OCR_ALLOW_DOWNLOADS: bool = Field(
+        default=True,
+        title="OCR allow downloads",
+        description="Allow downloading the YOLOv5 repo and EasyOCR weights when no local copy exists, disable on air-gapped servers",
+        type="boolean",
+    )
+
+    OCR_INFERENCE_BACKEND: Literal["torch", "onnx"] = Field(
+        default="onnx",
+        title="OCR inference backend",
+        description="Backend running the detection models, 'onnx' exports the uploaded weights once and runs them with ONNX Runtime, falling back to torch if that fails",
+        type="string",
+    )
+
+    OCR_QUANTIZATION_ENABLED: bool = Field(
+        default=False,
+        title="OCR quantization enabled",
+        description="Quantize uploaded OCR models to INT8, and serve the quantized variant when it is accurate enough (needs the onnx backend)",
+        type="boolean",
+    )
+
+    OCR_QUANTIZATION_CALIBRATION_IMAGES: int = Field(
+        default=16,
+        title="OCR quantization calibration images",
+        description="Number of the latest stored images of the counter used to calibrate and evaluate the quantized model",
+        type="integer",
+        ge=0,
+    )
+
+    OCR_QUANTIZATION_MAX_ACCURACY_DELTA: float = Field(
+        default=0.02,
+        title="OCR quantization max accuracy delta",
+        description="Maximum fraction of detections the quantized model may get wrong compared to the original model for it to be served",
+        type="number",
+        ge=0,
+        le=1,
+    )
+
+    OCR_CALIBRATION_ENABLED: bool = Field(
+        default=False,
+        title="OCR calibration enabled",
+        description="Calibrate the input size of every new version of an OCR model on the stored images of its counter once it is promoted",
+        type="boolean",
+    )
+
+    OCR_CALIBRATION_SIZES: list[int] = Field(
+        default=[640, 512, 416, 320, 256],
+        title="OCR calibration sizes",
+        description="Input sizes of the detection model tried by the calibration, the largest one is the reference",
+        type="array",
+        min_length=1,
+    )
+
+    OCR_CALIBRATION_IMAGES: int = Field(
+        default=50,
+        title="OCR calibration images",
+        description="Number of the latest stored images of the counter, with their readings, replayed by the calibration",
+        type="integer",
+        ge=1,
+    )
+
+    OCR_CALIBRATION_MAX_ACCURACY_DROP: float = Field(
+        default=0.01,
+        title="OCR calibration max accuracy drop",
+        description="Maximum fraction of fields an input size may read wrong, compared to the largest size, to be used",
+        type="number",
+        ge=0,
+        le=1,
+    )
+
+    OCR_RESULT_CACHE_SIZE: int = Field(
+        default=1024,
+        title="OCR result cache size",
+        description="Number of OCR results cached in memory by image content and model, so re-submitted photos skip inference (0 disables the cache)",
+        type="integer",
+        ge=0,
+    )
+
+    OCR_RESULT_CACHE_MONGO: bool = Field(
+        default=False,
+        title="OCR result cache in MongoDB",
+        description="Also keep the cached OCR results in the ocr_result_cache MongoDB collection, shared by all processes",
+        type="boolean",
+    )
+
+    OCR_RESULT_CACHE_TTL_SECONDS: int = Field(
+        default=86400,
+        title="OCR result cache TTL",
+        description="Time in seconds after which cached OCR results are removed from MongoDB",
+        type="integer",
+        ge=1,
+    )
+
+    OCR_ROI_TEMPLATES_ENABLED: bool = Field(
+        default=False,
+        title="OCR ROI templates enabled",
+        description="Learn the field boxes of counters photographed by a fixed camera, and crop them directly instead of running the detection model",
+        type="boolean",
+    )
+
+    OCR_ROI_LEARN_SAMPLES: int = Field(
+        default=10,
+        title="OCR ROI learn samples",
+        description="Number of consecutive detected photos whose field boxes must agree to learn a ROI template",
+        type="integer",
+        ge=2,
+    )
+
+    OCR_ROI_MIN_IOU: float = Field(
+        default=0.85,
+        title="OCR ROI min IoU",
+        description="Minimum overlap (IoU) of every field box with the median box for the photos to agree",
+        type="number",
+        ge=0,
+        le=1,
+    )
+
+    OCR_ROI_MIN_ALIGNMENT_SCORE: float = Field(
+        default=0.9,
+        title="OCR ROI min alignment score",
+        description="Minimum normalized cross correlation between a photo and the ROI template for the template to be used",
+        type="number",
+        ge=-1,
+        le=1,
+    )
+
+    OCR_SEVEN_SEGMENT_MIN_CONFIDENCE: float = Field(
+        default=0.5,
+        title="OCR seven segment min confidence",
+        description="Fields decoded by the seven segment recognizer with a lower confidence are read again by EasyOCR",
+        type="number",
+        ge=0,
+        le=1,
+    )
+
+    OCR_CASCADE_MIN_CONFIDENCE: float = Field(
+        default=0.5,
+        title="OCR cascade min confidence",
+        description="Default minimum detection and OCR confidence for a field read by a cheap cascade stage to be kept",
+        type="number",
+        ge=0,
+        le=1,
+    )
+
+    OCR_CASCADE_DOWNSCALED_SIZE: int = Field(
+        default=320,
+        title="OCR cascade downscaled size",
+        description="Input size of the detection model in the downscaled cascade stage",
+        type="integer",
+        ge=32,
+    )
+
+    OCR_QUALITY_GATE_ENABLED: bool = Field(
+        default=False,
+        title="OCR quality gate enabled",
+        description="Reject photos too small, blurry, dark or washed out by glare before they are queued for inference, unless the quality gate of the OCR model says otherwise",
+        type="boolean",
+    )
+
+    OCR_QUALITY_MIN_SIDE: int = Field(
+        default=480,
+        title="OCR quality min side",
+        description="Default minimum number of pixels on the short side of a photo",
+        type="integer",
+        ge=0,
+    )
+
+    OCR_QUALITY_MIN_SHARPNESS: float = Field(
+        default=20,
+        title="OCR quality min sharpness",
+        description="Default minimum variance of the Laplacian of a photo, measured on a copy 512 pixels wide, below which it is blurry",
+        type="number",
+        ge=0,
+    )
+
+    OCR_QUALITY_MIN_EXPOSURE: float = Field(
+        default=50,
+        title="OCR quality min exposure",
+        description="Default minimum gray level (0-255) of the brightest 1% of a photo, below which it is too dark",
+        type="number",
+        ge=0,
+        le=255,
+    )
+
+    OCR_QUALITY_MAX_GLARE: float = Field(
+        default=0.2,
+        title="OCR quality max glare",
+        description="Default maximum fraction of blown out pixels in a photo",
+        type="number",
+        ge=0,
+        le=1,
+    )
+
+    OCR_IMAGE_MAX_SIDE: int = Field(
+        default=1280,
+        title="OCR image max side",
+        description="Photos are downscaled, keeping their aspect ratio, so their longest side is at most this many pixels before the fields are detected and cropped",
+        type="integer",
+        ge=320,
+    )
+
+    OCR_REDUCED_DECODE: bool = Field(
+        default=True,
+        title="OCR reduced decode",
+        description="Decode JPEG photos at 1/2, 1/4 or 1/8 of their resolution when that still leaves OCR_IMAGE_MAX_SIDE pixels on their longest side",
+        type="boolean",
+    )
+
+    OCR_TILED_DETECTION: bool = Field(
+        default=False,
+        title="OCR tiled detection",
+        description="Also run the detection model on overlapping tiles of the photo, so displays that are small in the photo keep their resolution",
+        type="boolean",
+    )
+
+    OCR_TILE_SIZE: int = Field(
+        default=640,
+        title="OCR tile size",
+        description="Side of the tiles of the tiled detection, in pixels of the downscaled photo, also the input size of the detection model on them",
+        type="integer",
+        ge=32,
+    )
+
+    OCR_TILE_OVERLAP: float = Field(
+        default=0.25,
+        title="OCR tile overlap",
+        description="Fraction of a tile overlapping the next one, a display cut by a tile edge is whole in the next tile if it is smaller than the overlap",
+        type="number",
+        ge=0,
+        lt=1,
+    )
+
+    OCR_SHARED_MODELS: bool = Field(
+        default=False,
+        title="OCR shared models",
+        description="Fork the inference workers from a process that loaded the EasyOCR reader (and the torch detection models) once, so they share the weights copy-on-write",
+        type="boolean",
+    )
+
+    OCR_MODEL_STORE: Literal["local", "gridfs"] = Field(
+        default="local",
+        title="OCR model store",
+        description="Where the uploaded weights are stored once for every process and node: a local (or network shared) directory, or MongoDB GridFS",
+        type="string",
+    )
+
+    OCR_MODEL_STORE_DIR: str = Field(
+        default="model-store",
+        title="OCR model store directory",
+        description="Directory of the local model store",
+        type="string",
+    )
+
+    OCR_MODEL_SYNC_INTERVAL_SECONDS: float = Field(
+        default=10,
+        title="OCR model sync interval seconds",
+        description="How often every process checks for new or removed OCR model versions, to warm them up or release them (0 to disable)",
+        type="number",
+        ge=0,
+    )
+
+    DATA_BATCH_MAX_IMAGES: int = Field(
+        default=50,
+        title="Data batch max images",
+        description="Maximum number of images in a batch upload",
+        type="integer",
+        ge=1,
+    )
+
+    OCR_STREAM_SAMPLE_FPS: float = Field(
+        default=2,
+        title="OCR stream sample fps",
+        description="Default number of frames sampled per second of a counter stream",
+        type="number",
+        gt=0,
+    )
+
+    OCR_STREAM_CPU_BUDGET: float = Field(
+        default=0.05,
+        title="OCR stream CPU budget",
+        description="Default fraction of a CPU core the frame reader may spend on a counter stream",
+        type="number",
+        gt=0,
+        le=1,
+    )
+
+    OCR_STREAM_MIN_CHANGED_FRACTION: float = Field(
+        default=0.002,
+        title="OCR stream min changed fraction",
+        description="Fraction of the pixels of a frame that must change for the counter display to count as changed",
+        type="number",
+        gt=0,
+        le=1,
+    )
+
+    OCR_STREAM_MAX_STREAMS: int = Field(
+        default=32,
+        title="OCR stream max streams",
+        description="Maximum number of counter streams every process watches at once",
+        type="integer",
+        ge=1,
+    )
+
+    OCR_JOB_CONCURRENCY: int = Field(
+        default=4,
+        title="OCR job concurrency",
+        description="Number of OCR jobs every process runs at once, the others wait in the database",
+        type="integer",
+        ge=1,
+    )
+
+    OCR_JOB_POLL_INTERVAL_SECONDS: float = Field(
+        default=2,
+        title="OCR job poll interval seconds",
+        description="How often every process looks for waiting OCR jobs, and the job event streams check for updates made by other processes",
+        type="number",
+        gt=0,
+    )
+
+    OCR_JOB_LEASE_SECONDS: int = Field(
+        default=300,
+        title="OCR job lease seconds",
+        description="Running OCR jobs claimed longer ago than this are taken over by another process",
+        type="integer",
+        ge=1,
+    )
+
+    OCR_JOB_MAX_ATTEMPTS: int = Field(
+        default=3,
+        title="OCR job max attempts",
+        description="Number of times an OCR job is claimed before it is failed",
+        type="integer",
+        ge=1,
+    )
+
     
 
 
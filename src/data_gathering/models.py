@@ -3,7 +3,7 @@
 
 from enum import Enum as PyEnum
 from pydantic import BaseModel, EmailStr, validator, Field
-from typing import Optional, Annotated
+from typing import Optional, Annotated, Literal
 import re
 import bcrypt
 from ..auth.models import RoleEnum, User
@@ -17,13 +17,60 @@ class OcrModelCreate(BaseModel):
     counter_id: str
     file_name: str
     collected_info: list[str] = []
+    # engine reading the digits of the detected fields
+    recognizer: Literal["easyocr", "seven_segment"] = "easyocr"
     created_at: datetime
     updated_at: datetime
 
 
+class OcrModelCascade(BaseModel):
+    # cheap stages tried before the full resolution detection, in this order
+    stages: list[Literal["roi_template", "downscaled"]] = []
+    # fields read with a lower confidence, or failing validation, go to the next stage (DEFAULT: OCR_CASCADE_MIN_CONFIDENCE)
+    min_confidence: float | None = Field(default=None, ge=0, le=1)
+    # recognizer of the cheap stages (DEFAULT: the recognizer of the model)
+    recognizer: Literal["easyocr", "seven_segment"] | None = None
+
+
+class OcrModelQualityGate(BaseModel):
+    # the photos of the counter are checked before inference, None for the OCR_QUALITY_* defaults
+    enabled: bool | None = None
+    # minimum pixels on the short side of a photo
+    min_side: int | None = Field(default=None, ge=0)
+    # minimum variance of the Laplacian, lower is blurrier
+    min_sharpness: float | None = Field(default=None, ge=0)
+    # minimum gray level of the brightest 1% of a photo
+    min_exposure: float | None = Field(default=None, ge=0, le=255)
+    # maximum fraction of blown out pixels
+    max_glare: float | None = Field(default=None, ge=0, le=1)
+
+
 class OcrModelInDB(OcrModelCreate):
     id: Optional[str] = Field(alias='_id', default=None)
     file_path: str | None = None
+    quantized_file_name: str | None = None
+    quantization_accuracy_delta: float | None = None
+    # field boxes learned from the detections of a fixed camera, see utils/roi_templates.py
+    roi_template: dict | None = None
+    cascade: OcrModelCascade | None = None
+    quality_gate: OcrModelQualityGate | None = None
+    # input size of the detection model found by the calibration, None for the default size of the model
+    input_size: int | None = None
+    # file_name calibrated, number of images, and the field accuracy at every input size tried
+    calibration: dict | None = None
+    # sha256 digest of the weights in the model store, see utils/model_store.py
+    file_digest: str | None = None
+    quantized_file_digest: str | None = None
+    # version of the weights in file_name, 0 until the first version is promoted
+    version: int = 0
+    # last version uploaded, rolled out (loaded and smoke tested) in the background
+    latest_version: int = 0
+    staged_file_name: str | None = None
+    staged_file_digest: str | None = None
+    rollout_status: Literal["loading", "failed"] | None = None
+    rollout_error: str | None = None
+    # weights of the version before, kept on disk to roll back to
+    previous_file_name: str | None = None
 
 class OcrModelUpdate(OcrModelCreate):
     file_path: str | None = None
@@ -31,6 +78,29 @@ class OcrModelUpdate(OcrModelCreate):
 class OcrModel(OcrModelCreate):
     id: Optional[str]
     file_path: str | None = None
+    quantized_file_name: str | None = None
+    quantization_accuracy_delta: float | None = None
+    # field boxes learned from the detections of a fixed camera, see utils/roi_templates.py
+    roi_template: dict | None = None
+    cascade: OcrModelCascade | None = None
+    quality_gate: OcrModelQualityGate | None = None
+    # input size of the detection model found by the calibration, None for the default size of the model
+    input_size: int | None = None
+    # file_name calibrated, number of images, and the field accuracy at every input size tried
+    calibration: dict | None = None
+    # sha256 digest of the weights in the model store, see utils/model_store.py
+    file_digest: str | None = None
+    quantized_file_digest: str | None = None
+    # version of the weights in file_name, 0 until the first version is promoted
+    version: int = 0
+    # last version uploaded, rolled out (loaded and smoke tested) in the background
+    latest_version: int = 0
+    staged_file_name: str | None = None
+    staged_file_digest: str | None = None
+    rollout_status: Literal["loading", "failed"] | None = None
+    rollout_error: str | None = None
+    # weights of the version before, kept on disk to roll back to
+    previous_file_name: str | None = None
 
 class OcrModelResponse(OcrModel):
     pass
@@ -42,6 +112,9 @@ class Data(BaseModel):
     flavor: str
     size: str
     collected_info_values: object
+    # label -> {"detection": confidence, "ocr": confidence, "digits": per digit confidences, "engine": recognizer,
+    # "stage": cascade stage that read it}, None for labels that weren't read
+    collected_info_confidences: Optional[dict] = None
     uploader_username: str
     created_at: datetime
     updated_at: datetime
@@ -53,7 +126,75 @@ class DataResponse(Data):
 class DataInDB(Data):
     id: Optional[str] = Field(alias='_id', default=None)
     file_url: Optional[str] = None
+    file_path: Optional[str] = None
 
 class DataUpdate(Data):
     pass
 
+class DataBatchItemResponse(BaseModel):
+    # position of the image in the batch upload
+    index: int
+    data: DataResponse | None = None
+    error: str | None = None
+    # why the quality gate rejected the photo (small, blurry, dark, glare, undecodable), and its scores
+    quality_problems: list[str] | None = None
+    quality_scores: dict[str, int | float] | None = None
+
+
+class OcrJob(BaseModel):
+    # an upload whose OCR runs in the background, see POST /data/jobs
+    counter_id: str
+    flavor: str
+    size: str
+    uploader_username: str
+    # the image, stored before the job is accepted so it can be resumed after a restart
+    file_path: str
+    status: Literal["queued", "running", "done", "failed"] = "queued"
+    # set once the job is done
+    data_id: str | None = None
+    error: str | None = None
+    attempts: int = 0
+    created_at: datetime
+    updated_at: datetime
+
+class OcrJobInDB(OcrJob):
+    id: Optional[str] = Field(alias='_id', default=None)
+    # process running the job and when it claimed it, the job is resumed by another process once the claim is too old
+    claimed_by: str | None = None
+    claimed_at: datetime | None = None
+
+class OcrJobResponse(OcrJob):
+    id: str
+    data: DataResponse | None = None
+
+
+class CounterStreamCreate(BaseModel):
+    counter_id: str
+    flavor: str
+    size: str
+    # video file or directory of images on the server, camera device index, or stream URL (e.g. rtsp://...)
+    source: str
+    # frames sampled per second of the stream (DEFAULT: OCR_STREAM_SAMPLE_FPS)
+    sample_fps: float | None = Field(default=None, gt=0)
+    # fraction of a CPU core the frame reader may spend on the stream (DEFAULT: OCR_STREAM_CPU_BUDGET)
+    cpu_budget: float | None = Field(default=None, gt=0, le=1)
+
+class CounterStreamResponse(CounterStreamCreate):
+    id: str
+    uploader_username: str
+    status: Literal["running", "ended", "failed", "stopped"]
+    error: str | None = None
+    started_at: datetime
+    # frames sampled by the reader, and sent to OCR because the display changed
+    frames_sampled: int = 0
+    frames_changed: int = 0
+    position_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    wall_seconds: float = 0.0
+    # frames read by OCR: written as data, equal to the last reading of the counter, unread,
+    # rejected by the quality gate, failed
+    readings: int = 0
+    duplicates: int = 0
+    unread: int = 0
+    rejected: int = 0
+    ocr_errors: int = 0
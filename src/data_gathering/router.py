@@ -2,11 +2,12 @@
 # Defining the API endpoints go here and calling the service layer
 
 
-from typing import Annotated
+from typing import Annotated, Literal
 
 from fastapi import APIRouter, Depends, status, HTTPException
 from fastapi import FastAPI, File, UploadFile, Form, BackgroundTasks
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import Field
 
 from ..models import ResponseModel
@@ -25,13 +26,14 @@ async def upload_ocr_model(
     ocr_model_file: UploadFile = File(...),
     collected_info: list[str] = [],
     counter_id: str = None,
+    recognizer: Literal["easyocr", "seven_segment"] = "easyocr",
     current_user: User = Depends(get_current_user)
 ):
     if current_user.role == RoleEnum.WORKER:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
     
     collected_info = collected_info[0].split(',') if collected_info[0] else []
-    ocr_model = await data_gathering_service.upload_ocr_model(ocr_model_file, counter_id, collected_info, background_tasks)
+    ocr_model = await data_gathering_service.upload_ocr_model(ocr_model_file, counter_id, collected_info, background_tasks, recognizer)
 
     return ResponseModel(
         data=ocr_model,
@@ -49,6 +51,30 @@ def get_ocr_models_ids(counter_id: str | None):
         status="success",
     )
 
+@router.get("/ocr-models/stats", response_model=ResponseModel[list[dict]])
+def get_ocr_models_stats(current_user: User = Depends(get_current_user)):
+    if current_user.role == RoleEnum.WORKER:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    stats = data_gathering_service.get_ocr_models_stats()
+
+    return ResponseModel(
+        data=stats,
+        message="models stats retrieved successfully",
+        status="success",
+    )
+
+@router.get("/ocr-cache/stats", response_model=ResponseModel[dict])
+def get_ocr_result_cache_stats(current_user: User = Depends(get_current_user)):
+    if current_user.role == RoleEnum.WORKER:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    stats = data_gathering_service.get_ocr_result_cache_stats()
+
+    return ResponseModel(
+        data=stats,
+        message="OCR cache stats retrieved successfully",
+        status="success",
+    )
+
 @router.get("/ocr-models/{ocr_model_id}", response_model=ResponseModel[OcrModelResponse])
 async def get_model(ocr_model_id: str):
     ocr_model = await data_gathering_service.get_ocr_model(ocr_model_id)
@@ -66,17 +92,71 @@ async def get_model_file(ocr_model_id: str):
     return FileResponse(file_path)
 
 
+@router.put("/ocr-models/{ocr_model_id}/cascade", response_model=ResponseModel[OcrModelResponse])
+def update_ocr_model_cascade(
+    ocr_model_id: str,
+    cascade: OcrModelCascade | None = None,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role == RoleEnum.WORKER:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    ocr_model = data_gathering_service.update_ocr_model_cascade(ocr_model_id, cascade)
+
+    return ResponseModel(
+        data=ocr_model,
+        message="model cascade updated successfully",
+        status="success",
+    )
+
+
+@router.put("/ocr-models/{ocr_model_id}/quality-gate", response_model=ResponseModel[OcrModelResponse])
+def update_ocr_model_quality_gate(
+    ocr_model_id: str,
+    quality_gate: OcrModelQualityGate | None = None,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role == RoleEnum.WORKER:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    ocr_model = data_gathering_service.update_ocr_model_quality_gate(ocr_model_id, quality_gate)
+
+    return ResponseModel(
+        data=ocr_model,
+        message="model quality gate updated successfully",
+        status="success",
+    )
+
+
+@router.post("/ocr-models/{ocr_model_id}/calibrate", response_model=ResponseModel[OcrModelResponse], status_code=status.HTTP_202_ACCEPTED)
+def calibrate_ocr_model(
+    ocr_model_id: str,
+    background_tasks: BackgroundTasks,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role == RoleEnum.WORKER:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    # the input size and accuracies are set on the model once the calibration is done
+    ocr_model = data_gathering_service.start_ocr_model_calibration(ocr_model_id, background_tasks)
+
+    return ResponseModel(
+        data=ocr_model,
+        message="model calibration started",
+        status="success",
+    )
+
+
 @router.put("/ocr_models/{ocr_model_id}", response_model=ResponseModel[OcrModelResponse])
-async def update_ocr_model(
+def update_ocr_model(
     ocr_model_id: str,
+    background_tasks: BackgroundTasks,
     counter_id: str,
-    collected_info: list[str],
+    collected_info: list[str] = [],
     ocr_model_file: UploadFile | None = None,
     current_user: User = Depends(get_current_user)
 ):
     if current_user.role == RoleEnum.WORKER:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
-    ocr_model = data_gathering_service.update_ocr_model(ocr_model_id, counter_id, collected_info, ocr_model_file)
+    collected_info = collected_info[0].split(',') if collected_info and collected_info[0] else []
+    ocr_model = data_gathering_service.update_ocr_model(background_tasks, ocr_model_id, counter_id, collected_info, ocr_model_file)
 
     return ResponseModel(
         data=ocr_model,
@@ -113,6 +193,62 @@ async def upload_data(
         status="success",
     )
 
+@router.post("/data/batch", response_model=ResponseModel[list[DataBatchItemResponse]], status_code=status.HTTP_201_CREATED)
+async def upload_data_batch(
+    background_tasks: BackgroundTasks,
+    data_files: Annotated[list[UploadFile], File(...)],
+    counter_ids: Annotated[list[str], Form(...)],
+    flavors: Annotated[list[str], Form(...)],
+    sizes: Annotated[list[str], Form(...)],
+    current_user: User = Depends(get_current_user),
+):
+    # one counter_id, flavor and size per image, in the order of the images
+    data = await data_gathering_service.upload_data_batch(data_files, counter_ids, flavors, sizes, current_user, background_tasks)
+
+    return ResponseModel(
+        data=data,
+        message=f"{sum(item.data is not None for item in data)} of {len(data)} data uploaded successfully",
+        status="success",
+    )
+
+@router.post("/data/jobs", response_model=ResponseModel[OcrJobResponse], status_code=status.HTTP_202_ACCEPTED)
+async def submit_data_job(
+    data_file: Annotated[UploadFile, File(...)],
+    counter_id: Annotated[str, Form(...)],
+    flavor: Annotated[str, Form(...)],
+    size: Annotated[str, Form(...)],
+    current_user: User = Depends(get_current_user),
+):
+    # returns once the image is stored, the result is then read from GET /data/jobs/{id} or its events
+    ocr_job = await data_gathering_service.submit_ocr_job(data_file, counter_id, flavor, size, current_user)
+
+    return ResponseModel(
+        data=ocr_job,
+        message="data job accepted",
+        status="success",
+    )
+
+@router.get("/data/jobs/{ocr_job_id}", response_model=ResponseModel[OcrJobResponse])
+def get_data_job(ocr_job_id: str, current_user: User = Depends(get_current_user)):
+    ocr_job = data_gathering_service.get_ocr_job(ocr_job_id, current_user)
+
+    return ResponseModel(
+        data=ocr_job,
+        message="data job retrieved successfully",
+        status="success",
+    )
+
+@router.get("/data/jobs/{ocr_job_id}/events", response_class=StreamingResponse)
+async def get_data_job_events(ocr_job_id: str, current_user: User = Depends(get_current_user)):
+    # server-sent events, the stream ends with a done or failed event holding the job and its data
+    ocr_job = await run_in_threadpool(data_gathering_service.get_ocr_job, ocr_job_id, current_user)
+
+    return StreamingResponse(
+        data_gathering_service.stream_ocr_job(ocr_job, current_user),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 
 # TODO FIXME: This endpoint is not working
 # @router.get("/data", response_model=ResponseModel[list[DataResponse]])
@@ -140,6 +276,59 @@ async def upload_data(
 #         status="success",
 #     )
 
+@router.post("/streams", response_model=ResponseModel[CounterStreamResponse], status_code=status.HTTP_201_CREATED)
+async def start_counter_stream(stream: CounterStreamCreate, current_user: User = Depends(get_current_user)):
+    if current_user.role == RoleEnum.WORKER:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    counter_stream = await data_gathering_service.start_counter_stream(stream, current_user)
+
+    return ResponseModel(
+        data=counter_stream,
+        message="stream started successfully",
+        status="success",
+    )
+
+@router.post("/streams/video", response_model=ResponseModel[CounterStreamResponse], status_code=status.HTTP_201_CREATED)
+async def start_video_stream(
+    video_file: Annotated[UploadFile, File(...)],
+    counter_id: Annotated[str, Form(...)],
+    flavor: Annotated[str, Form(...)],
+    size: Annotated[str, Form(...)],
+    sample_fps: Annotated[float | None, Form(gt=0)] = None,
+    current_user: User = Depends(get_current_user),
+):
+    if current_user.role == RoleEnum.WORKER:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    counter_stream = await data_gathering_service.start_video_stream(video_file, counter_id, flavor, size, sample_fps, current_user)
+
+    return ResponseModel(
+        data=counter_stream,
+        message="video stream started successfully",
+        status="success",
+    )
+
+@router.get("/streams", response_model=ResponseModel[list[CounterStreamResponse]])
+def get_counter_streams(current_user: User = Depends(get_current_user)):
+    counter_streams = data_gathering_service.get_counter_streams()
+
+    return ResponseModel(
+        data=counter_streams,
+        message="streams retrieved successfully",
+        status="success",
+    )
+
+@router.delete("/streams/{stream_id}", response_model=ResponseModel[CounterStreamResponse])
+def stop_counter_stream(stream_id: str, current_user: User = Depends(get_current_user)):
+    if current_user.role == RoleEnum.WORKER:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    counter_stream = data_gathering_service.stop_counter_stream(stream_id)
+
+    return ResponseModel(
+        data=counter_stream,
+        message="stream stopped successfully",
+        status="success",
+    )
+
 @router.get("/data/{data_id}", response_model=ResponseModel[DataResponse])
 def get_data(data_id: str):
     data = data_gathering_service.get_data(data_id)
@@ -9,6 +9,7 @@ from ..database import Database
 from pymongo.errors import DuplicateKeyError
 from bson.objectid import ObjectId
 from bson.errors import InvalidId
+from pymongo import ReturnDocument
 from ..utils.utils import db_to_dict
 from datetime import datetime
 
@@ -77,6 +78,25 @@ class OcrModelDB():
         ocr_models = self.collection.find()
         return [OcrModelInDB(**db_to_dict(ocr_model)) for ocr_model in ocr_models]
     
+    def get_ocr_models_versions(self) -> list[OcrModelInDB]:
+        """
+        Get all ocr_models from the database, without their ROI templates, to check which
+        versions of the weights are in use.
+
+        Returns:
+            list[OcrModelInDB]: the ocr_models that were retrieved
+        """
+        ocr_models = self.collection.find({}, {"roi_template": 0})
+        return [OcrModelInDB(**db_to_dict(ocr_model)) for ocr_model in ocr_models]
+
+    def is_ocr_model_digest_used(self, digest: str) -> bool:
+        """Whether any ocr_model still uses the weights with this digest."""
+        return self.collection.count_documents({"$or": [
+            {"file_digest": digest},
+            {"staged_file_digest": digest},
+            {"quantized_file_digest": digest},
+        ]}, limit=1) > 0
+
     def get_ocr_models_by_counter_id(self, counter_id: str) -> list[OcrModelInDB]:
         """
         Get all ocr_models from the database.
@@ -88,6 +108,16 @@ class OcrModelDB():
         ocr_models = self.collection.find({"counter_id": counter_id})
         return [OcrModelInDB(**db_to_dict(ocr_model)) for ocr_model in ocr_models]
     
+    def get_ocr_models_by_counter_ids(self, counter_ids: list[str]) -> list[OcrModelInDB]:
+        """
+        Get the ocr_models of several counters from the database in one query.
+
+        Returns:
+            list[OcrModelInDB]: the ocr_models that were retrieved, in insertion order
+        """
+        ocr_models = self.collection.find({"counter_id": {"$in": counter_ids}}).sort("_id", 1)
+        return [OcrModelInDB(**db_to_dict(ocr_model)) for ocr_model in ocr_models]
+
     def update_ocr_model(self, ocr_model_id: str, ocr_model: OcrModelUpdate) -> OcrModelInDB:
         """
         Update a ocr_model in the database.
@@ -103,7 +133,8 @@ class OcrModelDB():
             HTTPException: if the ocr_model does not exist, or data validation fails
         """
         try:
-            ocr_model_in_db = ocr_model.model_dump()
+            # the weights only change through a rollout, see stage_ocr_model_version
+            ocr_model_in_db = ocr_model.model_dump(exclude={"file_name", "file_path", "created_at"})
             # Check if the counter exists
             counter = self.db.get_collection('counters').find_one({"_id": ObjectId(ocr_model_in_db['counter_id'])})
             if counter is None:
@@ -114,6 +145,236 @@ class OcrModelDB():
         
         return self.get_ocr_model(ocr_model_id)
     
+    def update_ocr_model_quantization(
+            self,
+            ocr_model_id: str,
+            quantized_file_name: str,
+            accuracy_delta: float | None,
+            file_name: str | None = None,
+            quantized_file_digest: str | None = None,
+    ):
+        """
+        Record the quantized variant of a ocr_model and its accuracy delta against the original model.
+
+        Args:
+            ocr_model_id (str): the identifier of the ocr_model
+            quantized_file_name (str): the file name of the quantized variant
+            accuracy_delta (float | None): the accuracy lost by quantizing, None if it couldn't be measured
+            file_name (str | None): the weights that were quantized, nothing is recorded if another version was promoted since
+            quantized_file_digest (str | None): the digest of the quantized variant in the model store
+
+        Raises:
+            HTTPException: if the ocr_model id is invalid
+        """
+        try:
+            query = {"_id": ObjectId(ocr_model_id)}
+            if file_name is not None:
+                query["file_name"] = file_name
+            self.collection.update_one(
+                query,
+                {"$set": {
+                    "quantized_file_name": quantized_file_name,
+                    "quantization_accuracy_delta": accuracy_delta,
+                    "quantized_file_digest": quantized_file_digest,
+                }},
+            )
+        except InvalidId as e:
+            raise HTTPException(status_code=400, detail="Invalid ocr_model id")
+
+    def update_ocr_model_quality_gate(self, ocr_model_id: str, quality_gate: dict | None) -> OcrModelInDB:
+        """
+        Set the quality gate thresholds of the photos read by a ocr_model, or remove them.
+        The OCR results don't depend on them, so results cached before are still reused.
+
+        Args:
+            ocr_model_id (str): the identifier of the ocr_model
+            quality_gate (dict | None): the thresholds
+
+        Returns:
+            OcrModelInDB: the updated ocr_model
+
+        Raises:
+            HTTPException: if the ocr_model id is invalid or the ocr_model is not found
+        """
+        try:
+            self.collection.update_one({"_id": ObjectId(ocr_model_id)}, {"$set": {"quality_gate": quality_gate}})
+        except InvalidId as e:
+            raise HTTPException(status_code=400, detail="Invalid ocr_model id")
+        return self.get_ocr_model(ocr_model_id)
+
+    def update_ocr_model_calibration(self, ocr_model_id: str, input_size: int | None, calibration: dict, file_name: str):
+        """
+        Record the input size a ocr_model was calibrated to.
+
+        Args:
+            ocr_model_id (str): the identifier of the ocr_model
+            input_size (int | None): the smallest accurate input size, None to use the default size of the model
+            calibration (dict): the images and accuracies the input size was chosen on
+            file_name (str): the weights that were calibrated, nothing is recorded if another version was promoted since
+
+        Raises:
+            HTTPException: if the ocr_model id is invalid
+        """
+        try:
+            self.collection.update_one(
+                {"_id": ObjectId(ocr_model_id), "file_name": file_name},
+                {"$set": {"input_size": input_size, "calibration": calibration}},
+            )
+        except InvalidId as e:
+            raise HTTPException(status_code=400, detail="Invalid ocr_model id")
+
+    def update_ocr_model_roi_template(self, ocr_model_id: str, roi_template: dict | None):
+        """
+        Store the ROI template learned for a ocr_model, or remove it.
+
+        Args:
+            ocr_model_id (str): the identifier of the ocr_model
+            roi_template (dict | None): the learned template
+
+        Raises:
+            HTTPException: if the ocr_model id is invalid
+        """
+        try:
+            self.collection.update_one({"_id": ObjectId(ocr_model_id)}, {"$set": {"roi_template": roi_template}})
+        except InvalidId as e:
+            raise HTTPException(status_code=400, detail="Invalid ocr_model id")
+
+    def next_ocr_model_version(self, ocr_model_id: str) -> int:
+        """
+        Reserve the number of a new version of a ocr_model.
+
+        Raises:
+            HTTPException: if the ocr_model id is invalid or the ocr_model is not found
+        """
+        try:
+            ocr_model = self.collection.find_one_and_update(
+                {"_id": ObjectId(ocr_model_id)},
+                {"$inc": {"latest_version": 1}},
+                return_document=ReturnDocument.AFTER,
+            )
+        except InvalidId as e:
+            raise HTTPException(status_code=400, detail="Invalid ocr_model id")
+        if ocr_model is None:
+            raise HTTPException(status_code=404, detail="OcrModel not found")
+        return ocr_model["latest_version"]
+
+    def stage_ocr_model_version(self, ocr_model_id: str, version: int, file_name: str, file_digest: str) -> OcrModelInDB:
+        """
+        Record the weights of a new version of a ocr_model, to be rolled out. The current version
+        keeps serving until the new one is promoted, except for the first version of a ocr_model.
+
+        Args:
+            ocr_model_id (str): the identifier of the ocr_model
+            version (int): the number reserved with next_ocr_model_version
+            file_name (str): the file name of the weights of the version
+            file_digest (str): the digest of the weights in the model store
+
+        Returns:
+            OcrModelInDB: the ocr_model
+
+        Raises:
+            HTTPException: if the ocr_model id is invalid or the ocr_model is not found
+        """
+        try:
+            self.collection.update_one(
+                {"_id": ObjectId(ocr_model_id), "latest_version": version},
+                {"$set": {
+                    "staged_file_name": file_name,
+                    "staged_file_digest": file_digest,
+                    "rollout_status": "loading",
+                    "rollout_error": None,
+                }},
+            )
+            # there is no other version to serve the requests until the first one is promoted
+            self.collection.update_one(
+                {"_id": ObjectId(ocr_model_id), "version": 0},
+                {"$set": {"file_name": file_name, "file_path": f"ocr-models/{file_name}", "file_digest": file_digest}},
+            )
+        except InvalidId as e:
+            raise HTTPException(status_code=400, detail="Invalid ocr_model id")
+        return self.get_ocr_model(ocr_model_id)
+
+    def promote_ocr_model_version(self, ocr_model_id: str, version: int) -> OcrModelInDB | None:
+        """
+        Atomically make a staged version the one serving the requests of a ocr_model. The
+        quantized variant and the calibrated input size belonged to the version before, and are dropped.
+
+        Args:
+            ocr_model_id (str): the identifier of the ocr_model
+            version (int): the staged version
+
+        Returns:
+            OcrModelInDB | None: the ocr_model as it was before the promotion, or None if a newer
+            version was staged in the meantime
+
+        Raises:
+            HTTPException: if the ocr_model id is invalid
+        """
+        try:
+            ocr_model = self.collection.find_one_and_update(
+                {"_id": ObjectId(ocr_model_id), "latest_version": version, "staged_file_name": {"$ne": None}},
+                [{"$set": {
+                    "previous_file_name": {"$cond": [{"$eq": ["$file_name", "$staged_file_name"]}, "$previous_file_name", "$file_name"]},
+                    "file_name": "$staged_file_name",
+                    "file_path": {"$concat": ["ocr-models/", "$staged_file_name"]},
+                    "file_digest": "$staged_file_digest",
+                    "version": version,
+                    "staged_file_name": None,
+                    "staged_file_digest": None,
+                    "rollout_status": None,
+                    "rollout_error": None,
+                    "quantized_file_name": None,
+                    "quantization_accuracy_delta": None,
+                    "quantized_file_digest": None,
+                    "input_size": None,
+                    "calibration": None,
+                    "updated_at": datetime.now(),
+                }}],
+                return_document=ReturnDocument.BEFORE,
+            )
+        except InvalidId as e:
+            raise HTTPException(status_code=400, detail="Invalid ocr_model id")
+        return None if ocr_model is None else OcrModelInDB(**db_to_dict(ocr_model))
+
+    def fail_ocr_model_rollout(self, ocr_model_id: str, version: int, error: str):
+        """
+        Record that a staged version of a ocr_model couldn't be loaded or failed its smoke inference.
+
+        Raises:
+            HTTPException: if the ocr_model id is invalid
+        """
+        try:
+            self.collection.update_one(
+                {"_id": ObjectId(ocr_model_id), "latest_version": version},
+                {"$set": {"rollout_status": "failed", "rollout_error": error}},
+            )
+        except InvalidId as e:
+            raise HTTPException(status_code=400, detail="Invalid ocr_model id")
+
+    def update_ocr_model_cascade(self, ocr_model_id: str, cascade: dict | None) -> OcrModelInDB:
+        """
+        Set the inference cascade of a ocr_model, or remove it.
+        The update time changes too, so results cached with the previous cascade aren't reused.
+
+        Args:
+            ocr_model_id (str): the identifier of the ocr_model
+            cascade (dict | None): the cascade stages and thresholds
+
+        Returns:
+            OcrModelInDB: the updated ocr_model
+
+        Raises:
+            HTTPException: if the ocr_model id is invalid or the ocr_model is not found
+        """
+        try:
+            self.collection.update_one(
+                {"_id": ObjectId(ocr_model_id)},
+                {"$set": {"cascade": cascade, "updated_at": datetime.now()}},
+            )
+        except InvalidId as e:
+            raise HTTPException(status_code=400, detail="Invalid ocr_model id")
+        return self.get_ocr_model(ocr_model_id)
+
     def delete_ocr_model(self, ocr_model_id: str):
         """
         Delete a ocr_model from the database.
@@ -176,6 +437,42 @@ class DataDB:
         
         return DataResponse(**db_to_dict(data_in_db))
     
+    def add_data_many(self, data: list[DataInDB]) -> list[DataResponse]:
+        """
+        Add several data to the database with a single insert, checking that their ocr_models,
+        counters and uploaders exist with one query each.
+
+        Args:
+            data (list[DataInDB]): the data to be added
+
+        Returns:
+            list[DataResponse]: the data that were added, in the same order
+
+        Raises:
+            HTTPException: if any ocr_model, counter or uploader doesn't exist, nothing is added then
+        """
+        if len(data) == 0:
+            return []
+        data_in_db = [data_obj.model_dump(exclude={"id"}) for data_obj in data]
+        try:
+            ocr_model_ids = {ObjectId(data_obj['ocr_model_id']) for data_obj in data_in_db}
+            if self.db.get_collection('ocr_models').count_documents({"_id": {"$in": list(ocr_model_ids)}}) != len(ocr_model_ids):
+                raise HTTPException(status_code=400, detail="ocr_model not found")
+        except InvalidId as e:
+            raise HTTPException(status_code=400, detail="Invalid ocr_model id")
+        try:
+            counter_ids = {ObjectId(data_obj['counter_id']) for data_obj in data_in_db}
+            if self.db.get_collection('counters').count_documents({"_id": {"$in": list(counter_ids)}}) != len(counter_ids):
+                raise HTTPException(status_code=400, detail="counter not found")
+        except InvalidId as e:
+            raise HTTPException(status_code=400, detail="Invalid counter id")
+        uploaders = {data_obj['uploader_username'] for data_obj in data_in_db}
+        if self.db.get_collection('users').count_documents({"username": {"$in": list(uploaders)}}) != len(uploaders):
+            raise HTTPException(status_code=400, detail="uploader not found")
+
+        inserted_ids = self.collection.insert_many(data_in_db).inserted_ids
+        return [DataResponse(**db_to_dict({**data_obj, "_id": inserted_id})) for data_obj, inserted_id in zip(data_in_db, inserted_ids)]
+
     def get_data(self, data_id: str) -> DataResponse:
         """
         Get a data from the database.
@@ -217,6 +514,17 @@ class DataDB:
         data = self.collection.find({"counter_id": counter_id})
         return [DataInDB(**db_to_dict(data)) for data in data]
     
+    def get_latest_data_by_counter_id(self, counter_id: str, limit: int) -> list[DataInDB]:
+        """
+        Get the most recent data of a counter from the database.
+
+        Returns:
+            list[DataInDB]: at most limit data, the newest first
+        
+        """
+        data = self.collection.find({"counter_id": counter_id}).sort("created_at", -1).limit(limit)
+        return [DataInDB(**db_to_dict(data)) for data in data]
+    
     def get_data_by_date(self, date: datetime) -> list[DataInDB]:
         """
         Get all data from the database.
@@ -291,3 +599,141 @@ class DataDB:
             raise HTTPException(status_code=404, detail="Data not found")
 
 
+
+class OcrJobDB:
+
+    def __init__(self):
+        self.db = Database()
+        self.collection = self.db.get_collection('ocr_jobs')
+
+    def add_ocr_job(self, ocr_job: OcrJobInDB) -> OcrJobInDB:
+        """
+        Add a new queued ocr_job to the database.
+
+        Args:
+            ocr_job (OcrJobInDB): the ocr_job to be added
+
+        Returns:
+            OcrJobInDB: the ocr_job that was added
+        """
+        ocr_job_in_db = ocr_job.model_dump(exclude={"id"})
+        ocr_job_in_db["_id"] = self.collection.insert_one(ocr_job_in_db).inserted_id
+        return OcrJobInDB(**db_to_dict(ocr_job_in_db))
+
+    def get_ocr_job(self, ocr_job_id: str) -> OcrJobInDB:
+        """
+        Get a ocr_job from the database.
+
+        Args:
+            ocr_job_id (str): the identifier of the ocr_job to be retrieved
+
+        Returns:
+            OcrJobInDB: the ocr_job that was retrieved
+
+        Raises:
+            HTTPException: if the ocr_job does not exist
+        """
+        try:
+            ocr_job = self.collection.find_one({"_id": ObjectId(ocr_job_id)})
+            if ocr_job is None:
+                raise HTTPException(status_code=404, detail="OcrJob not found")
+        except InvalidId as e:
+            raise HTTPException(status_code=400, detail="Invalid ocr_job id")
+        return OcrJobInDB(**db_to_dict(ocr_job))
+
+    def claim_ocr_job(
+            self,
+            claimed_by: str,
+            stale_before: datetime,
+            max_attempts: int,
+            ocr_job_id: str | None = None,
+            running_ids: list[str] | None = None,
+    ) -> OcrJobInDB | None:
+        """
+        Atomically claim a queued ocr_job, or a running one whose claim is older than stale_before
+        (its process died), so that only one process runs it.
+
+        Args:
+            claimed_by (str): the process claiming the job
+            stale_before (datetime): claims older than this are taken over
+            max_attempts (int): jobs that were claimed this many times are left alone
+            ocr_job_id (str | None): the job to claim, or None for the oldest claimable job
+            running_ids (list[str] | None): the jobs the claiming process is running, never claimed again
+
+        Returns:
+            OcrJobInDB | None: the claimed ocr_job, or None if there is nothing to claim
+        """
+        query = {
+            "$or": [{"status": "queued"}, {"status": "running", "claimed_at": {"$lt": stale_before}}],
+            "attempts": {"$lt": max_attempts},
+        }
+        if running_ids:
+            query["_id"] = {"$nin": [ObjectId(running_id) for running_id in running_ids]}
+        if ocr_job_id is not None:
+            if ocr_job_id in (running_ids or []):
+                return None
+            query["_id"] = ObjectId(ocr_job_id)
+        now = datetime.now()
+        ocr_job = self.collection.find_one_and_update(
+            query,
+            {"$set": {"status": "running", "claimed_by": claimed_by, "claimed_at": now, "updated_at": now}, "$inc": {"attempts": 1}},
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+        return None if ocr_job is None else OcrJobInDB(**db_to_dict(ocr_job))
+
+    def renew_ocr_job_claim(self, ocr_job_id: str, claimed_by: str) -> bool:
+        """
+        Keep the claim of a running ocr_job fresh, so it isn't taken over while it runs.
+
+        Returns:
+            bool: False if another process took the job over, or it is no longer running
+        """
+        now = datetime.now()
+        return self.collection.update_one(
+            {"_id": ObjectId(ocr_job_id), "claimed_by": claimed_by, "status": "running"},
+            {"$set": {"claimed_at": now, "updated_at": now}},
+        ).modified_count > 0
+
+    def finish_ocr_job(self, ocr_job_id: str, claimed_by: str, data_id: str | None = None, error: str | None = None):
+        """Mark a claimed ocr_job done with its data, or failed with an error, unless another process took it over."""
+        self.collection.update_one(
+            {"_id": ObjectId(ocr_job_id), "claimed_by": claimed_by, "status": "running"},
+            {"$set": {
+                "status": "failed" if error is not None else "done",
+                "data_id": data_id,
+                "error": error,
+                "updated_at": datetime.now(),
+            }},
+        )
+
+    def requeue_ocr_job(self, ocr_job_id: str, claimed_by: str, max_attempts: int, error: str) -> str | None:
+        """
+        Give back a claimed ocr_job that could not run yet (e.g. the OCR was overloaded), so it is claimed
+        again later. The attempt counts: a job that used its max_attempts is failed with the error instead.
+
+        Returns:
+            str | None: the new status of the ocr_job, or None if another process took it over
+        """
+        claim = {"_id": ObjectId(ocr_job_id), "claimed_by": claimed_by, "status": "running"}
+        now = datetime.now()
+        requeued = self.collection.update_one(
+            {**claim, "attempts": {"$lt": max_attempts}},
+            {"$set": {"status": "queued", "claimed_by": None, "claimed_at": None, "error": error, "updated_at": now}},
+        )
+        if requeued.modified_count > 0:
+            return "queued"
+        failed = self.collection.update_one(claim, {"$set": {"status": "failed", "error": error, "updated_at": now}})
+        return "failed" if failed.modified_count > 0 else None
+
+    def fail_abandoned_ocr_jobs(self, stale_before: datetime, max_attempts: int) -> int:
+        """
+        Fail the running ocr_jobs whose every attempt was abandoned, e.g. an image that crashes the workers.
+
+        Returns:
+            int: the number of ocr_jobs that were failed
+        """
+        return self.collection.update_many(
+            {"status": "running", "claimed_at": {"$lt": stale_before}, "attempts": {"$gte": max_attempts}},
+            {"$set": {"status": "failed", "error": "The job was abandoned too many times", "updated_at": datetime.now()}},
+        ).modified_count
@@ -7,17 +7,31 @@
 from typing import Annotated
 
 from fastapi import Depends, HTTPException, status, UploadFile, File, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
 
 from .models import *
 from ..auth.schemas import UsersDB
 from ..auth.models import User, RoleEnum
 
-from .utils import upload_image_to_cloudinary, write_data_entry_to_gsheet
-from ..utils.ocr_model import get_digits_from_image, add_model, get_model, delete_model
-from datetime import datetime
-from .schemas import DataDB, OcrModelDB
+from .utils import upload_image_to_cloudinary, write_data_entry_to_gsheet, get_data_file_path, save_data_file, read_data_file, save_upload_file
+from ..exceptions import ImageQualityError
+from ..utils.frame_streams import FrameStreams
+from ..utils.image_quality import measure_quality, quality_problems
+from ..utils.inference_executor import InferenceExecutor
+from ..utils.metrics import OCR_QUALITY_REJECTIONS
+from ..utils.model_store import ModelStore, write_atomically
+from ..utils.result_cache import ResultCache
+from ..utils.roi_templates import learn_roi_template
+from datetime import datetime, timedelta
+from .schemas import DataDB, OcrJobDB, OcrModelDB
+from ..config import APP_SETTINGS
 
+import asyncio
 import os
+import socket
+import time
+import uuid
+from collections import defaultdict, deque
 
 
 
@@ -26,36 +40,258 @@ async def upload_ocr_model(
         counter_id: str,
         collected_info: list[str],
         background_tasks: BackgroundTasks,
+        recognizer: str = "easyocr",
 ) -> OcrModel:
     OCR_MODEL_DB = OcrModelDB()
     ocr_model: OcrModel = OCR_MODEL_DB.add_ocr_model(OcrModelInDB(
         counter_id=counter_id,
         file_name=ocr_model_file.filename,
         collected_info=collected_info,
+        recognizer=recognizer,
         created_at=datetime.now(),
         updated_at=datetime.now(),
         file_path=None,
     ))
 
 
-    model_id = ocr_model.id
-    model_name = f"model_{model_id}_counter_{counter_id}_{ocr_model_file.filename}"
+    # reading, hashing and storing the weights takes a while, off the event loop
+    ocr_model = await run_in_threadpool(stage_ocr_model_version, ocr_model.id, counter_id, ocr_model_file, background_tasks)
     
-    # store the file in the server in a folder called 'ocr-models'
-    if not os.path.exists('ocr-models'):
-        os.makedirs('ocr-models')
-    with open(f'ocr-models/{model_name}', 'wb') as f:
-        f.write(ocr_model_file.file.read())
-    
-    # background task to load the model
-    background_tasks.add_task(add_model, model_name)
+    return OcrModel(**ocr_model.dict())
 
-    ocr_model.file_name = model_name
-    ocr_model.file_path = f'ocr-models/{model_name}'
-    background_tasks.add_task(OCR_MODEL_DB.update_ocr_model, model_id, OcrModelUpdate(**ocr_model.dict()))
-    
+def stage_ocr_model_version(
+        model_id: str,
+        counter_id: str,
+        model_file: UploadFile,
+        background_tasks: BackgroundTasks,
+) -> OcrModelInDB:
+    """
+    Store uploaded weights as a new version of an OCR model, and roll it out in the background.
+    Every version has its own file, so the workers can keep serving the current one meanwhile.
+    The weights go to the model store, where the other processes and nodes get them from.
+    """
+    OCR_MODEL_DB = OcrModelDB()
+    version = OCR_MODEL_DB.next_ocr_model_version(model_id)
+    model_name = f"model_{model_id}_counter_{counter_id}_v{version}_{model_file.filename}"
+
+    contents = model_file.file.read()
+    digest = ModelStore().put(contents)
+    # the node cache of this node gets the weights right away, in the folder called 'ocr-models'
+    write_atomically(f'ocr-models/{model_name}', contents)
+
+    ocr_model = OCR_MODEL_DB.stage_ocr_model_version(model_id, version, model_name, digest)
+    background_tasks.add_task(roll_out_ocr_model, model_id, counter_id, version, model_name, digest)
+    return ocr_model
+
+async def roll_out_ocr_model(model_id: str, counter_id: str, version: int, model_name: str, digest: str):
+    """
+    Load a new version of an OCR model in the inference workers and smoke test it, then promote
+    it. Images already submitted to the previous version finish on it before it is released.
+    """
+    OCR_MODEL_DB = OcrModelDB()
+    data = DataDB().get_latest_data_by_counter_id(counter_id, 1)
+    smoke_image = next((d.file_path for d in data if d.file_path and os.path.exists(d.file_path)), None)
+    try:
+        await run_in_threadpool(ModelStore().ensure, model_name, digest)
+        await InferenceExecutor().preload_model(model_name, smoke_image)
+    except Exception as e:
+        print(f"Rolling out version {version} of OCR model {model_id} failed: {e}")
+        OCR_MODEL_DB.fail_ocr_model_rollout(model_id, version, str(e))
+        return
+
+    previous = OCR_MODEL_DB.promote_ocr_model_version(model_id, version)
+    if previous is None:
+        print(f"Version {version} of OCR model {model_id} was replaced by a newer version before its promotion")
+        return
+    print(f"Promoted version {version} of OCR model {model_id}")
+
+    if previous.file_name != model_name:
+        for file_name in [previous.file_name, previous.quantized_file_name]:
+            if file_name:
+                await InferenceExecutor().release_model(file_name)
+        # the version before is kept to roll back to, older ones are removed
+        remove_ocr_model_files(previous.previous_file_name, previous.quantized_file_name)
+    if APP_SETTINGS.OCR_QUANTIZATION_ENABLED:
+        await quantize_ocr_model(model_id, counter_id, model_name)
+    if APP_SETTINGS.OCR_CALIBRATION_ENABLED:
+        # after the quantization, so the variant that serves the requests is calibrated
+        await calibrate_ocr_model(model_id)
+
+def remove_ocr_model_files(*file_names: str | None):
+    """Remove weights from 'ocr-models', with their ONNX exports."""
+    for file_name in file_names:
+        if not file_name:
+            continue
+        for path in [f'ocr-models/{file_name}', f'ocr-models/{file_name}.onnx']:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+async def quantize_ocr_model(model_id: str, counter_id: str, model_name: str):
+    # calibrate on the latest readings of the counter that are still stored on this server
+    data = DataDB().get_latest_data_by_counter_id(counter_id, APP_SETTINGS.OCR_QUANTIZATION_CALIBRATION_IMAGES)
+    calibration_image_paths = [d.file_path for d in data if d.file_path and os.path.exists(d.file_path)]
+    try:
+        quantization = await InferenceExecutor().quantize_model(model_name, calibration_image_paths)
+    except Exception as e:
+        print(f"Quantizing OCR model {model_name} failed: {e}")
+        return
+    quantized_file_name = quantization["quantized_file_name"]
+    with open(f'ocr-models/{quantized_file_name}', 'rb') as f:
+        quantized_file_digest = ModelStore().put(f.read())
+    OcrModelDB().update_ocr_model_quantization(
+        model_id,
+        quantized_file_name,
+        quantization["accuracy_delta"],
+        model_name,
+        quantized_file_digest,
+    )
+
+async def calibrate_ocr_model(model_id: str):
+    """
+    Find the smallest input size at which the version of an OCR model serving the requests reads
+    the latest stored images of its counter as well as at full size, and use it from then on.
+    The readings stored with the images, corrected or not, are taken as the truth.
+    """
+    ocr_model = OcrModelDB().get_ocr_model(model_id)
+    data = DataDB().get_latest_data_by_counter_id(ocr_model.counter_id, APP_SETTINGS.OCR_CALIBRATION_IMAGES)
+    samples = [
+        (d.file_path, d.collected_info_values) for d in data
+        if d.file_path and os.path.exists(d.file_path) and isinstance(d.collected_info_values, dict)
+    ]
+    model_name = get_inference_model_name(ocr_model)
+    try:
+        await ensure_ocr_model_file(ocr_model, model_name)
+        calibration = await InferenceExecutor().calibrate_model(model_name, samples, ocr_model.recognizer)
+    except Exception as e:
+        print(f"Calibrating OCR model {model_name} failed: {e}")
+        return
+    input_size = calibration.pop("input_size")
+    print(f"Calibrated OCR model {model_id} to input size {input_size}")
+    OcrModelDB().update_ocr_model_calibration(
+        model_id,
+        input_size,
+        {**calibration, "file_name": model_name, "calibrated_at": datetime.now()},
+        ocr_model.file_name,
+    )
+
+def start_ocr_model_calibration(model_id: str, background_tasks: BackgroundTasks) -> OcrModel:
+    ocr_model = OcrModelDB().get_ocr_model(model_id)
+    background_tasks.add_task(calibrate_ocr_model, model_id)
     return OcrModel(**ocr_model.dict())
 
+# ocr model id -> detections of its latest photos that went through the detection model
+roi_samples = defaultdict(lambda: deque(maxlen=APP_SETTINGS.OCR_ROI_LEARN_SAMPLES))
+
+def get_ocr_options(ocr_model: OcrModelInDB) -> dict:
+    """Options of the OCR model passed to the inference workers with every image."""
+    options = {"recognizer": ocr_model.recognizer}
+    if ocr_model.input_size is not None:
+        options["input_size"] = ocr_model.input_size
+    if ocr_model.cascade is not None and ocr_model.cascade.stages:
+        options["cascade"] = ocr_model.cascade.dict(exclude_none=True)
+    if APP_SETTINGS.OCR_ROI_TEMPLATES_ENABLED:
+        options.update({"roi_template": ocr_model.roi_template, "learn_roi_template": True})
+    return options
+
+def record_roi_sample(ocr_model: OcrModelInDB, sample: dict):
+    """
+    Keep the detections of a photo, and once the latest photos of the counter all have their
+    fields at the same place, store them as the ROI template of the OCR model.
+    """
+    samples = roi_samples[ocr_model.id]
+    samples.append(sample)
+    if len(samples) < APP_SETTINGS.OCR_ROI_LEARN_SAMPLES:
+        return
+    roi_template = learn_roi_template(list(samples), APP_SETTINGS.OCR_ROI_MIN_IOU)
+    if roi_template is not None:
+        print(f"Learned a ROI template for OCR model {ocr_model.id}: {roi_template['boxes']}")
+        OcrModelDB().update_ocr_model_roi_template(ocr_model.id, roi_template)
+        samples.clear()
+
+def get_ocr_result_cache_stats() -> dict:
+    return ResultCache().stats()
+
+def get_inference_model_name(ocr_model: OcrModelInDB) -> str:
+    """The quantized variant of the model if it is accurate enough, otherwise the original model."""
+    if (
+        APP_SETTINGS.OCR_QUANTIZATION_ENABLED
+        and ocr_model.quantized_file_name
+        and ocr_model.quantization_accuracy_delta is not None
+        and ocr_model.quantization_accuracy_delta <= APP_SETTINGS.OCR_QUANTIZATION_MAX_ACCURACY_DELTA
+    ):
+        return ocr_model.quantized_file_name
+    return ocr_model.file_name
+
+def get_inference_model_digest(ocr_model: OcrModelInDB, model_name: str) -> str | None:
+    """The digest of the weights of model_name in the model store, None for models uploaded before the store."""
+    if model_name == ocr_model.quantized_file_name:
+        return ocr_model.quantized_file_digest
+    if model_name == ocr_model.staged_file_name:
+        return ocr_model.staged_file_digest
+    return ocr_model.file_digest
+
+async def ensure_ocr_model_file(ocr_model: OcrModelInDB, model_name: str):
+    """Fetch the weights from the model store if this node doesn't have them yet."""
+    digest = get_inference_model_digest(ocr_model, model_name)
+    if digest is not None:
+        await run_in_threadpool(ModelStore().ensure, model_name, digest)
+
+# file name -> digest of the versions of the OCR models known to this process
+synced_ocr_model_files = None
+ocr_model_sync_task = None
+
+async def sync_ocr_models():
+    """
+    Warm up the versions of the OCR models staged or promoted by any process or node, and
+    release the versions that were replaced or deleted, from the workers of this process.
+    """
+    global synced_ocr_model_files
+    ocr_models = await run_in_threadpool(OcrModelDB().get_ocr_models_versions)
+    in_use = dict()
+    for ocr_model in ocr_models:
+        for model_name in [get_inference_model_name(ocr_model), ocr_model.staged_file_name]:
+            if model_name:
+                in_use[model_name] = get_inference_model_digest(ocr_model, model_name)
+    if synced_ocr_model_files is None:
+        # the models in use at startup are warmed up by InferenceExecutor().warm_up
+        synced_ocr_model_files = in_use
+        return
+
+    for model_name, digest in in_use.items():
+        if model_name in synced_ocr_model_files:
+            continue
+        # failures aren't retried, the model is then loaded when it is used
+        synced_ocr_model_files[model_name] = digest
+        try:
+            if digest is not None:
+                await run_in_threadpool(ModelStore().ensure, model_name, digest)
+            await InferenceExecutor().preload_model(model_name)
+        except Exception as e:
+            print(f"Warming up OCR model {model_name} failed: {e}")
+    for model_name in [name for name in synced_ocr_model_files if name not in in_use]:
+        del synced_ocr_model_files[model_name]
+        await InferenceExecutor().release_model(model_name)
+
+async def run_ocr_model_sync():
+    while True:
+        try:
+            await sync_ocr_models()
+        except Exception as e:
+            print(f"Syncing the OCR models failed: {e}")
+        await asyncio.sleep(APP_SETTINGS.OCR_MODEL_SYNC_INTERVAL_SECONDS)
+
+def start_ocr_model_sync():
+    """Poll the OCR models in the background, so every process follows the uploads made through any of them."""
+    global ocr_model_sync_task
+    if APP_SETTINGS.OCR_MODEL_SYNC_INTERVAL_SECONDS > 0:
+        ocr_model_sync_task = asyncio.ensure_future(run_ocr_model_sync())
+
+def stop_ocr_model_sync():
+    if ocr_model_sync_task is not None:
+        ocr_model_sync_task.cancel()
+
 def get_ocr_models_ids(counter_id: str | None) -> list[OcrModel]:
     if counter_id is None:
         ocr_models = OcrModelDB().get_ocr_models()
@@ -65,10 +301,21 @@ def get_ocr_models_ids(counter_id: str | None) -> list[OcrModel]:
 
     return ocr_models
 
+def get_ocr_models_stats() -> list[dict]:
+    return InferenceExecutor().get_model_stats()
+
 async def get_ocr_model(model_id: str) -> OcrModel | str:
     ocr_model = OcrModelDB().get_ocr_model(model_id)
     return OcrModel(**ocr_model.dict())
 
+def update_ocr_model_cascade(model_id: str, cascade: OcrModelCascade | None) -> OcrModel:
+    ocr_model = OcrModelDB().update_ocr_model_cascade(model_id, None if cascade is None else cascade.dict())
+    return OcrModel(**ocr_model.dict())
+
+def update_ocr_model_quality_gate(model_id: str, quality_gate: OcrModelQualityGate | None) -> OcrModel:
+    ocr_model = OcrModelDB().update_ocr_model_quality_gate(model_id, None if quality_gate is None else quality_gate.dict())
+    return OcrModel(**ocr_model.dict())
+
 def update_ocr_model(
         background_tasks: BackgroundTasks,
         model_id: str,
@@ -76,29 +323,30 @@ def update_ocr_model(
         collected_info: list[str],
         model_file: UploadFile | None,
 ) -> OcrModel:
-    ocr_model = OcrModelDB().update_ocr_model(
+    OCR_MODEL_DB = OcrModelDB()
+    current = OCR_MODEL_DB.get_ocr_model(model_id)
+    ocr_model = OCR_MODEL_DB.update_ocr_model(
         model_id,
-        OcrModelUpdate(
-            counter_id=counter_id,
-            collected_info=collected_info,
-            updated_at=datetime.now(),
-        )
+        OcrModelUpdate(**{
+            **current.dict(),
+            "counter_id": counter_id,
+            "collected_info": collected_info,
+            "updated_at": datetime.now(),
+        })
     )
     if model_file:
-        model_name = f"model_{model_id}_counter_{counter_id}_{model_file.filename}"
-        # store the file in the server in a folder called 'ocr-models'
-        if not os.path.exists('ocr-models'):
-            os.makedirs('ocr-models')
-        with open(f'ocr-models/{model_name}', 'wb') as f:
-            f.write(model_file.file.read())
-        ocr_model.file_name = model_file.filename
-        ocr_model.file_path = f'ocr-models/{model_name}'
-        background_tasks.add_task(add_model, model_name)
+        # the current version keeps serving until the new one is loaded and promoted
+        ocr_model = stage_ocr_model_version(model_id, counter_id, model_file, background_tasks)
     return OcrModel(**ocr_model.dict())
 
 def delete_ocr_model(model_id: str):
-    model = OcrModelDB().delete_ocr_model(model_id)
-    delete_model(model.file_name)
+    OCR_MODEL_DB = OcrModelDB()
+    model = OCR_MODEL_DB.delete_ocr_model(model_id)
+    remove_ocr_model_files(model.file_name, model.staged_file_name, model.previous_file_name, model.quantized_file_name)
+    # the same weights may have been uploaded for another model
+    for digest in {model.file_digest, model.staged_file_digest, model.quantized_file_digest}:
+        if digest is not None and not OCR_MODEL_DB.is_ocr_model_digest_used(digest):
+            ModelStore().delete(digest)
     
 
 async def upload_data(
@@ -111,39 +359,547 @@ async def upload_data(
         background_tasks: BackgroundTasks,
 ) -> DataResponse:
         
-        # store the file in the server in a folder called 'data'
-        if not os.path.exists('data'):
-            os.makedirs('data')
-        with open(f'data/{data_file.filename}', 'wb') as f:
-            f.write(data_file.file.read())
-            file_path = f'data/{data_file.filename}'
+        # the image stays in memory for inference, it is stored in the 'data' folder in the background
+        contents = await data_file.read()
+        file_path = get_data_file_path(contents, data_file.filename)
         
+        data_obj = await read_and_add_data(contents, file_path, counter_id, flavor, size, current_user.username)
+        background_tasks.add_task(save_data_file, file_path, contents)
+        background_tasks.add_task(upload_image_and_write_data_to_gsheet, file_path, data_obj)
+        return DataResponse(**data_obj.dict())
+
+def get_quality_thresholds(ocr_model: OcrModelInDB) -> dict | None:
+    """The quality gate thresholds of the photos read by an OCR model, None if they aren't checked."""
+    quality_gate = ocr_model.quality_gate.dict(exclude_none=True) if ocr_model.quality_gate is not None else dict()
+    if not quality_gate.pop("enabled", APP_SETTINGS.OCR_QUALITY_GATE_ENABLED):
+        return None
+    return {
+        "min_side": APP_SETTINGS.OCR_QUALITY_MIN_SIDE,
+        "min_sharpness": APP_SETTINGS.OCR_QUALITY_MIN_SHARPNESS,
+        "min_exposure": APP_SETTINGS.OCR_QUALITY_MIN_EXPOSURE,
+        "max_glare": APP_SETTINGS.OCR_QUALITY_MAX_GLARE,
+        **quality_gate,
+    }
+
+def check_image_quality(ocr_model: OcrModelInDB, contents: bytes) -> ImageQualityError | None:
+    """
+    Check that a photo can be read before it is queued for inference, in a few milliseconds.
+
+    Returns:
+        ImageQualityError | None: the rejection, telling the operator what to fix, None if the photo passes
+    """
+    thresholds = get_quality_thresholds(ocr_model)
+    if thresholds is None:
+        return None
+    scores = measure_quality(contents)
+    problems = quality_problems(scores, thresholds)
+    if not problems:
+        return None
+    for problem in problems:
+        OCR_QUALITY_REJECTIONS.labels(problem).inc()
+    return ImageQualityError(problems, scores)
+
+async def read_counters(ocr_model: OcrModelInDB, images: list[bytes]) -> list[dict | HTTPException]:
+    """
+    Read the counter values of images with an OCR model, from the result cache, or through the
+    inference workers, where the images are queued together. Photos failing the quality gate
+    are rejected without taking a slot in the queue.
+
+    Returns:
+        list: the results of every image, or the HTTPException it failed with
+    """
+    model_name = get_inference_model_name(ocr_model)
+    # re-submitted photos get the result of their first upload, as long as the model and its input size didn't change
+    model_key = f"{ocr_model.id}:{model_name}:{ocr_model.updated_at.isoformat()}:{ocr_model.input_size}"
+    results = [None] * len(images)
+    if APP_SETTINGS.OCR_RESULT_CACHE_SIZE > 0:
+        results = [await run_in_threadpool(ResultCache().get, contents, model_key) for contents in images]
+    missing = [i for i, image_results in enumerate(results) if image_results is None]
+    for i in missing:
+        results[i] = await run_in_threadpool(check_image_quality, ocr_model, images[i])
+    missing = [i for i, image_results in enumerate(results) if image_results is None]
+    if len(missing) == 0:
+        return results
+
+    await ensure_ocr_model_file(ocr_model, model_name)
+    start = time.perf_counter()
+    options = get_ocr_options(ocr_model)
+    try:
+        read = await InferenceExecutor().get_digits_from_images([images[i] for i in missing], model_name, [options] * len(missing))
+    except HTTPException as e:
+        read = [e] * len(missing)
+    inference_seconds = time.perf_counter() - start
+    for i, image_results in zip(missing, read):
+        if isinstance(image_results, Exception):
+            results[i] = image_results if isinstance(image_results, HTTPException) else HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(image_results))
+            continue
+        sample = image_results.pop("roi_sample", None)
+        if sample is not None:
+            record_roi_sample(ocr_model, sample)
+        if APP_SETTINGS.OCR_RESULT_CACHE_SIZE > 0:
+            await run_in_threadpool(ResultCache().set, images[i], model_key, image_results, inference_seconds)
+        results[i] = image_results
+    return results
+
+async def read_and_add_data(
+        contents: bytes,
+        file_path: str,
+        counter_id: str,
+        flavor: str,
+        size: str,
+        uploader_username: str,
+) -> DataResponse:
+        """Read the counter values of an uploaded image and add them to the database."""
         ocr_models = OcrModelDB().get_ocr_models_by_counter_id(counter_id)
         if len(ocr_models) == 0:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No OCR models found for this counter")
         ocr_model = ocr_models[0]
         
-        model_name = ocr_model.file_name
-        try:
-            results = get_digits_from_image(file_path, model_name)
-        except Exception as e:
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+        results = (await read_counters(ocr_model, [contents]))[0]
+        if isinstance(results, HTTPException):
+            raise results
         print(results)
 
         
-        data_obj = DataDB().add_data(DataInDB(
+        return DataDB().add_data(DataInDB(
             counter_id=counter_id,
             ocr_model_id=ocr_model.id,
             flavor=flavor,
             size=size,
-            collected_info_values=results,
-            uploader_username=current_user.username,
+            collected_info_values=results["values"],
+            collected_info_confidences=results["confidences"],
+            uploader_username=uploader_username,
             created_at=datetime.now(),
             updated_at=datetime.now(),
             file_url=None,
+            file_path=file_path,
         ))
-        background_tasks.add_task(upload_image_and_write_data_to_gsheet, file_path, data_obj)
-        return DataResponse(**data_obj.dict())
+
+async def upload_data_batch(
+        data_files: list[UploadFile],
+        counter_ids: list[str],
+        flavors: list[str],
+        size_values: list[str],
+        current_user: User,
+        background_tasks: BackgroundTasks,
+) -> list[DataBatchItemResponse]:
+    """
+    Upload several images at once, e.g. the counters of a line at the end of a shift. The images
+    of every OCR model are read together, and the readings are added with a single insert.
+
+    Returns:
+        list[DataBatchItemResponse]: the data, or the error, of every image, in the same order
+    """
+    if not len(data_files) == len(counter_ids) == len(flavors) == len(size_values):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Every image needs a counter_id, a flavor and a size")
+    if len(data_files) > APP_SETTINGS.DATA_BATCH_MAX_IMAGES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"At most {APP_SETTINGS.DATA_BATCH_MAX_IMAGES} images can be uploaded at once")
+
+    contents = [await data_file.read() for data_file in data_files]
+    file_paths = [get_data_file_path(image, data_file.filename) for image, data_file in zip(contents, data_files)]
+    responses = [DataBatchItemResponse(index=i) for i in range(len(data_files))]
+
+    # counter id -> its OCR model, the first one as in upload_data
+    ocr_models = dict()
+    for ocr_model in OcrModelDB().get_ocr_models_by_counter_ids(list(set(counter_ids))):
+        ocr_models.setdefault(ocr_model.counter_id, ocr_model)
+    # ocr model id -> indexes of its images
+    groups = defaultdict(list)
+    for i, counter_id in enumerate(counter_ids):
+        if counter_id in ocr_models:
+            groups[ocr_models[counter_id].id].append(i)
+        else:
+            responses[i].error = "No OCR models found for this counter"
+
+    read = []
+    # one model at a time, so every model gets the free slots of the submission queue for its batches
+    for indexes in groups.values():
+        try:
+            results = await read_counters(ocr_models[counter_ids[indexes[0]]], [contents[i] for i in indexes])
+        except HTTPException as e:
+            results = [e] * len(indexes)
+        for i, image_results in zip(indexes, results):
+            if isinstance(image_results, HTTPException):
+                responses[i].error = image_results.detail
+                if isinstance(image_results, ImageQualityError):
+                    responses[i].quality_problems = list(image_results.problems)
+                    responses[i].quality_scores = image_results.scores
+            else:
+                read.append((i, image_results))
+
+    now = datetime.now()
+    data_objs = DataDB().add_data_many([
+        DataInDB(
+            counter_id=counter_ids[i],
+            ocr_model_id=ocr_models[counter_ids[i]].id,
+            flavor=flavors[i],
+            size=size_values[i],
+            collected_info_values=results["values"],
+            collected_info_confidences=results["confidences"],
+            uploader_username=current_user.username,
+            created_at=now,
+            updated_at=now,
+            file_url=None,
+            file_path=file_paths[i],
+        )
+        for i, results in read
+    ])
+    for (i, _), data_obj in zip(read, data_objs):
+        responses[i].data = data_obj
+        background_tasks.add_task(save_data_file, file_paths[i], contents[i])
+        background_tasks.add_task(upload_image_and_write_data_to_gsheet, file_paths[i], data_obj)
+    return responses
+
+# written in the claims of the OCR jobs run by this process
+ocr_job_worker_id = f"{socket.gethostname()}:{os.getpid()}"
+# ocr job id -> task, of the OCR jobs run by this process
+running_ocr_jobs = dict()
+# ocr job id -> event set when this process updates the job, waited for by its event streams
+ocr_job_updates = dict()
+ocr_job_claim_lock = None
+ocr_job_poll_task = None
+# the claim_ocr_jobs tasks started by uploads and finished jobs, the event loop only keeps weak references to its tasks
+ocr_job_claim_tasks = set()
+
+async def submit_ocr_job(
+        data_file: UploadFile,
+        counter_id: str,
+        flavor: str,
+        size: str,
+        current_user: User,
+) -> OcrJobResponse:
+    """
+    Accept an upload whose OCR runs in the background. The image is stored and the job is
+    added to the database before returning, so the job is resumed if the process restarts.
+    """
+    contents = await data_file.read()
+    file_path = get_data_file_path(contents, data_file.filename)
+    ocr_models = OcrModelDB().get_ocr_models_by_counter_id(counter_id)
+    if len(ocr_models) == 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No OCR models found for this counter")
+    # the operator learns right away that the photo must be retaken, not once the job ran
+    rejection = await run_in_threadpool(check_image_quality, ocr_models[0], contents)
+    if rejection is not None:
+        raise rejection
+    await run_in_threadpool(save_data_file, file_path, contents)
+
+    ocr_job = OcrJobDB().add_ocr_job(OcrJobInDB(
+        counter_id=counter_id,
+        flavor=flavor,
+        size=size,
+        uploader_username=current_user.username,
+        file_path=file_path,
+        created_at=datetime.now(),
+        updated_at=datetime.now(),
+    ))
+    start_claiming_ocr_jobs()
+    return OcrJobResponse(**ocr_job.dict())
+
+def start_claiming_ocr_jobs():
+    task = asyncio.ensure_future(claim_ocr_jobs())
+    ocr_job_claim_tasks.add(task)
+    task.add_done_callback(ocr_job_claim_tasks.discard)
+
+def notify_ocr_job_update(ocr_job_id: str):
+    event = ocr_job_updates.pop(ocr_job_id, None)
+    if event is not None:
+        event.set()
+
+async def claim_ocr_jobs():
+    """Start the oldest queued (or abandoned) OCR jobs, as long as this process has free job slots."""
+    global ocr_job_claim_lock
+    if ocr_job_claim_lock is None:
+        ocr_job_claim_lock = asyncio.Lock()
+    async with ocr_job_claim_lock:
+        stale_before = datetime.now() - timedelta(seconds=APP_SETTINGS.OCR_JOB_LEASE_SECONDS)
+        while len(running_ocr_jobs) < APP_SETTINGS.OCR_JOB_CONCURRENCY:
+            ocr_job = await run_in_threadpool(
+                OcrJobDB().claim_ocr_job,
+                ocr_job_worker_id,
+                stale_before,
+                APP_SETTINGS.OCR_JOB_MAX_ATTEMPTS,
+                running_ids=list(running_ocr_jobs),
+            )
+            if ocr_job is None:
+                return
+            running_ocr_jobs[ocr_job.id] = asyncio.ensure_future(run_ocr_job(ocr_job))
+            notify_ocr_job_update(ocr_job.id)
+
+async def renew_ocr_job_claim(ocr_job_id: str):
+    """Renew the claim of a running OCR job every third of its lease, so a long job isn't taken over."""
+    while True:
+        await asyncio.sleep(APP_SETTINGS.OCR_JOB_LEASE_SECONDS / 3)
+        try:
+            if not await run_in_threadpool(OcrJobDB().renew_ocr_job_claim, ocr_job_id, ocr_job_worker_id):
+                print(f"OCR job {ocr_job_id} was taken over by another process")
+                return
+        except Exception as e:
+            print(f"Renewing the claim of OCR job {ocr_job_id} failed: {e}")
+
+async def run_ocr_job(ocr_job: OcrJobInDB):
+    data_obj = None
+    requeued = False
+    renewal = asyncio.ensure_future(renew_ocr_job_claim(ocr_job.id))
+    try:
+        try:
+            contents = await run_in_threadpool(read_data_file, ocr_job.file_path)
+            data_obj = await read_and_add_data(contents, ocr_job.file_path, ocr_job.counter_id, ocr_job.flavor, ocr_job.size, ocr_job.uploader_username)
+        except Exception as e:
+            error = e.detail if isinstance(e, HTTPException) else str(e)
+            if isinstance(e, HTTPException) and e.status_code == status.HTTP_503_SERVICE_UNAVAILABLE:
+                # the OCR is overloaded, the job is claimed again by the next poll
+                print(f"OCR job {ocr_job.id} requeued: {error}")
+                job_status = await run_in_threadpool(OcrJobDB().requeue_ocr_job, ocr_job.id, ocr_job_worker_id, APP_SETTINGS.OCR_JOB_MAX_ATTEMPTS, error)
+                requeued = job_status == "queued"
+            else:
+                print(f"OCR job {ocr_job.id} failed: {error}")
+                await run_in_threadpool(OcrJobDB().finish_ocr_job, ocr_job.id, ocr_job_worker_id, error=error)
+        else:
+            await run_in_threadpool(OcrJobDB().finish_ocr_job, ocr_job.id, ocr_job_worker_id, data_obj.id)
+    finally:
+        renewal.cancel()
+        running_ocr_jobs.pop(ocr_job.id, None)
+        notify_ocr_job_update(ocr_job.id)
+        if not requeued:
+            start_claiming_ocr_jobs()
+    if data_obj is not None:
+        await run_in_threadpool(upload_image_and_write_data_to_gsheet, ocr_job.file_path, data_obj)
+
+async def run_ocr_job_poll():
+    while True:
+        try:
+            stale_before = datetime.now() - timedelta(seconds=APP_SETTINGS.OCR_JOB_LEASE_SECONDS)
+            await run_in_threadpool(OcrJobDB().fail_abandoned_ocr_jobs, stale_before, APP_SETTINGS.OCR_JOB_MAX_ATTEMPTS)
+            await claim_ocr_jobs()
+        except Exception as e:
+            print(f"Claiming the OCR jobs failed: {e}")
+        await asyncio.sleep(APP_SETTINGS.OCR_JOB_POLL_INTERVAL_SECONDS)
+
+def start_ocr_job_poll():
+    """Run the OCR jobs queued during bursts, and those left over by processes that stopped."""
+    global ocr_job_poll_task
+    ocr_job_poll_task = asyncio.ensure_future(run_ocr_job_poll())
+
+def stop_ocr_job_poll():
+    # the running jobs are claimed again once their claim is too old
+    if ocr_job_poll_task is not None:
+        ocr_job_poll_task.cancel()
+
+def get_ocr_job(ocr_job_id: str, current_user: User) -> OcrJobResponse:
+    ocr_job = OcrJobDB().get_ocr_job(ocr_job_id)
+    if current_user.role == RoleEnum.WORKER and ocr_job.uploader_username != current_user.username:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    data = DataDB().get_data(ocr_job.data_id) if ocr_job.data_id is not None else None
+    return OcrJobResponse(**ocr_job.dict(), data=data)
+
+async def stream_ocr_job(ocr_job: OcrJobResponse, current_user: User):
+    """
+    Server-sent events of an OCR job: an event with the job every time its status changes,
+    ending with the done or failed event. Jobs run by other processes are polled.
+    """
+    last_status = None
+    while True:
+        if ocr_job.status != last_status:
+            last_status = ocr_job.status
+            yield f"event: {ocr_job.status}\ndata: {ocr_job.model_dump_json()}\n\n"
+        if ocr_job.status in ["done", "failed"]:
+            return
+        event = ocr_job_updates.setdefault(ocr_job.id, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout=APP_SETTINGS.OCR_JOB_POLL_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            # keeps the connection open through proxies
+            yield ": keep-alive\n\n"
+        ocr_job = await run_in_threadpool(get_ocr_job, ocr_job.id, current_user)
+
+# stream id -> the stream and the state of its OCR, for the counter streams of this process
+counter_streams = dict()
+
+async def start_counter_stream(stream: CounterStreamCreate, current_user: User, uploaded_video: str | None = None) -> CounterStreamResponse:
+    """
+    Watch a counter camera or video, and add a reading every time its display changes, see
+    utils/frame_streams.py. The frames are read by OCR like uploaded photos. The uploaded_video
+    file is deleted once the stream stopped or ended.
+    """
+    if len(OcrModelDB().get_ocr_models_by_counter_id(stream.counter_id)) == 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No OCR models found for this counter")
+    if FrameStreams._instance is not None and FrameStreams().running() >= APP_SETTINGS.OCR_STREAM_MAX_STREAMS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"At most {APP_SETTINGS.OCR_STREAM_MAX_STREAMS} streams can be watched at once")
+    if stream.sample_fps is None:
+        stream.sample_fps = APP_SETTINGS.OCR_STREAM_SAMPLE_FPS
+    if stream.cpu_budget is None:
+        stream.cpu_budget = APP_SETTINGS.OCR_STREAM_CPU_BUDGET
+
+    # readings equal to the last one of the counter aren't added again
+    latest_data = DataDB().get_latest_data_by_counter_id(stream.counter_id, 1)
+    stream_id = uuid.uuid4().hex
+    counter_streams[stream_id] = {
+        "stream": stream,
+        "uploader_username": current_user.username,
+        "last_values": latest_data[0].collected_info_values if latest_data else None,
+        "pending": None,
+        "task": None,
+        "readings": 0,
+        "duplicates": 0,
+        "unread": 0,
+        "rejected": 0,
+        "ocr_errors": 0,
+        "uploaded_video": uploaded_video,
+        "finish_task": None,
+    }
+    FrameStreams().start(
+        stream_id,
+        {
+            "source": stream.source,
+            "sample_fps": stream.sample_fps,
+            "cpu_budget": stream.cpu_budget,
+            "min_changed_fraction": APP_SETTINGS.OCR_STREAM_MIN_CHANGED_FRACTION,
+        },
+        lambda contents, position: on_stream_frame(stream_id, contents),
+        lambda: on_stream_end(stream_id),
+    )
+    print(f"Watching stream {stream_id} of counter {stream.counter_id} from {stream.source}")
+    return get_counter_stream(stream_id)
+
+async def start_video_stream(
+        video_file: UploadFile,
+        counter_id: str,
+        flavor: str,
+        size: str,
+        sample_fps: float | None,
+        current_user: User,
+) -> CounterStreamResponse:
+    """Store an uploaded video of a counter in the 'data' folder, and read it as a stream."""
+    extension = os.path.splitext(video_file.filename or '')[1].lower() or '.mp4'
+    file_path = f'data/videos/{uuid.uuid4().hex}{extension}'
+    await run_in_threadpool(save_upload_file, file_path, video_file.file)
+    stream = CounterStreamCreate(counter_id=counter_id, flavor=flavor, size=size, source=file_path, sample_fps=sample_fps)
+    try:
+        return await start_counter_stream(stream, current_user, uploaded_video=file_path)
+    except Exception:
+        remove_file(file_path)
+        raise
+
+def remove_file(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def on_stream_end(stream_id: str):
+    state = counter_streams.get(stream_id)
+    if state is not None and state["finish_task"] is None:
+        state["finish_task"] = asyncio.ensure_future(finish_counter_stream(stream_id))
+
+async def finish_counter_stream(stream_id: str):
+    """Forget a stream that stopped or ended once its last changed frame was read, and delete its uploaded video."""
+    state = counter_streams[stream_id]
+    if state["task"] is not None:
+        await asyncio.wait([state["task"]])
+    counts = ", ".join(f"{state[key]} {key}" for key in ["readings", "duplicates", "unread", "rejected", "ocr_errors"])
+    print(f"Stream {stream_id} {FrameStreams().get_stats(stream_id).get('status')}: {counts}")
+    del counter_streams[stream_id]
+    FrameStreams().forget(stream_id)
+    if state["uploaded_video"] is not None:
+        await run_in_threadpool(remove_file, state["uploaded_video"])
+
+def on_stream_frame(stream_id: str, contents: bytes):
+    state = counter_streams.get(stream_id)
+    if state is None:
+        return
+    # only the latest changed frame waits for OCR, the ones before it are outdated
+    state["pending"] = contents
+    if state["task"] is None or state["task"].done():
+        state["task"] = asyncio.ensure_future(read_stream_frames(stream_id))
+
+async def read_stream_frames(stream_id: str):
+    state = counter_streams[stream_id]
+    while state["pending"] is not None:
+        contents, state["pending"] = state["pending"], None
+        try:
+            await read_stream_frame(stream_id, contents)
+        except Exception as e:
+            state["ocr_errors"] += 1
+            print(f"Reading a frame of stream {stream_id} failed: {e.detail if isinstance(e, HTTPException) else e}")
+
+async def read_stream_frame(stream_id: str, contents: bytes):
+    state = counter_streams[stream_id]
+    stream = state["stream"]
+    ocr_models = await run_in_threadpool(OcrModelDB().get_ocr_models_by_counter_id, stream.counter_id)
+    if len(ocr_models) == 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No OCR models found for this counter")
+    ocr_model = ocr_models[0]
+
+    results = (await read_counters(ocr_model, [contents]))[0]
+    if isinstance(results, HTTPException):
+        if results.status_code == status.HTTP_503_SERVICE_UNAVAILABLE:
+            # the OCR queue is full, try again in a moment unless a newer frame arrived meanwhile
+            if state["pending"] is None and FrameStreams().get_stats(stream_id).get("status") != "stopped":
+                state["pending"] = contents
+            await asyncio.sleep(1)
+            return
+        if results.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY:
+            # rejected by the quality gate, e.g. glare on the display, the next change is read
+            state["rejected"] += 1
+            return
+        raise results
+    if all(value is None for value in results["values"].values()):
+        # no field read, e.g. someone standing in front of the camera
+        state["unread"] += 1
+        return
+    if results["values"] == state["last_values"]:
+        state["duplicates"] += 1
+        return
+
+    file_path = get_data_file_path(contents, "frame.jpg")
+    data_obj = await run_in_threadpool(DataDB().add_data, DataInDB(
+        counter_id=stream.counter_id,
+        ocr_model_id=ocr_model.id,
+        flavor=stream.flavor,
+        size=stream.size,
+        collected_info_values=results["values"],
+        collected_info_confidences=results["confidences"],
+        uploader_username=state["uploader_username"],
+        created_at=datetime.now(),
+        updated_at=datetime.now(),
+        file_url=None,
+        file_path=file_path,
+    ))
+    state["last_values"] = results["values"]
+    state["readings"] += 1
+    await run_in_threadpool(save_data_file, file_path, contents)
+    await run_in_threadpool(upload_image_and_write_data_to_gsheet, file_path, data_obj)
+
+def get_counter_stream(stream_id: str) -> CounterStreamResponse:
+    state = counter_streams.get(stream_id)
+    if state is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Stream not found")
+    counts = {key: state[key] for key in ["readings", "duplicates", "unread", "rejected", "ocr_errors"]}
+    return CounterStreamResponse(
+        **state["stream"].dict(),
+        **FrameStreams().get_stats(stream_id),
+        **counts,
+        id=stream_id,
+        uploader_username=state["uploader_username"],
+    )
+
+def get_counter_streams() -> list[CounterStreamResponse]:
+    return [get_counter_stream(stream_id) for stream_id in counter_streams]
+
+def stop_counter_stream(stream_id: str) -> CounterStreamResponse:
+    get_counter_stream(stream_id)
+    FrameStreams().stop(stream_id)
+    counter_streams[stream_id]["pending"] = None
+    return get_counter_stream(stream_id)
+
+def stop_counter_streams():
+    if FrameStreams._instance is not None:
+        FrameStreams().shutdown()
+    # the reader is gone, so the streams won't report their end
+    for state in counter_streams.values():
+        if state["uploaded_video"] is not None:
+            remove_file(state["uploaded_video"])
+    counter_streams.clear()
 
 def get_data_ids(counter_id: str | None, flavor: str | None, size: str | None, uploader_username: str | None, start_date: str | None, end_date: str | None) -> list[DataResponse]:
     if counter_id:
@@ -178,11 +934,9 @@ def update_data(
     )
     if data_file:
         # store the file in the server in a folder called 'data'
-        if not os.path.exists('data'):
-            os.makedirs('data')
-        with open(f'data/{data_file.filename}', 'wb') as f:
-            f.write(data_file.file.read())
-            file_path = f'data/{data_file.filename}'
+        contents = data_file.file.read()
+        file_path = get_data_file_path(contents, data_file.filename)
+        save_data_file(file_path, contents)
         data.file_url = upload_image_to_cloudinary(file_path)
     return DataResponse(**data.dict())
 
@@ -7,7 +7,10 @@ import cloudinary.uploader
 import json
 from ..config import APP_SETTINGS
 import os
+import hashlib
+import shutil
 from ..utils.gsheet import get_gsheet_data, write_gsheet_data
+from ..utils.model_store import write_atomically
 from .models import DataInDB
 import datetime
 
@@ -52,6 +55,31 @@ def upload_image_to_cloudinary(file_path: str):
     # delete_file(file_path)
     return upload_result["secure_url"]
 
+def get_data_file_path(contents: bytes, file_name: str | None) -> str:
+    """
+    Content addressed path of an uploaded image in the 'data' folder, so uploads with the
+    same file name never overwrite each other, and the same photo is only stored once.
+    """
+    extension = os.path.splitext(file_name or '')[1].lower() or '.jpg'
+    return f'data/{hashlib.sha256(contents).hexdigest()}{extension}'
+
+def save_data_file(file_path: str, contents: bytes):
+    if os.path.exists(file_path):
+        return
+    # readers never see a partially written image, and uploads of the same photo don't collide
+    write_atomically(file_path, contents)
+
+def save_upload_file(file_path: str, upload_file):
+    """Copy a large uploaded file (e.g. a video) to disk in chunks, without holding it in memory."""
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    upload_file.seek(0)
+    with open(file_path, 'wb') as f:
+        shutil.copyfileobj(upload_file, f, 1 << 20)
+
+def read_data_file(file_path: str) -> bytes:
+    with open(file_path, 'rb') as f:
+        return f.read()
+
 def delete_file(file_path: str):
     os.remove(file_path)
     print("File deleted successfully: ", file_path)
@@ -50,5 +50,11 @@ class Database:
         self.db.users.create_index('email', unique=True)
         self.db.users.create_index('mobile', unique=True)
 
+        self.db.ocr_jobs.create_index([('status', 1), ('created_at', 1)])
+
+        if APP_SETTINGS.OCR_RESULT_CACHE_MONGO:
+            self.db.ocr_result_cache.create_index([('content_hash', 1), ('model_key', 1)], unique=True)
+            self.db.ocr_result_cache.create_index('created_at', expireAfterSeconds=APP_SETTINGS.OCR_RESULT_CACHE_TTL_SECONDS)
+
 
         print('Created indexes successfully')
@@ -1,21 +1,39 @@
-from fastapi import Request
+from fastapi import HTTPException, Request, status
 from fastapi.responses import JSONResponse
 from fastapi.exceptions import RequestValidationError
 
 
+class ImageQualityError(HTTPException):
+    """A photo rejected by the quality gate, see utils/image_quality.py."""
+
+    def __init__(self, problems: dict, scores: dict | None):
+        # problem (small, blurry, ...) -> what to fix
+        self.problems = problems
+        # the scores of measure_quality, None if the image can't be decoded
+        self.scores = scores
+        super().__init__(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Photo rejected, please retake it: {'; '.join(problems.values())}",
+        )
+
+
 async def custom_http_exception_handler(request, exc):
+    content = {
+        "status": "error",
+        "detail": "Internal server error" if exc.status_code == 500 else "Bad request",
+        "message": exc.detail,
+        "errors": [
+            {
+                "message": exc.detail,
+            }
+        ]
+    }
+    if isinstance(exc, ImageQualityError):
+        content["errors"] = [{"problem": problem, "message": message} for problem, message in exc.problems.items()]
+        content["scores"] = exc.scores
     return JSONResponse(
         status_code=exc.status_code,
-        content={
-            "status": "error",
-            "detail": "Internal server error" if exc.status_code == 500 else "Bad request",
-            "message": exc.detail,
-            "errors": [
-                {
-                    "message": exc.detail,
-                }
-            ]
-        },
+        content=content,
     )
 
 
@@ -1,6 +1,6 @@
 # root of the project, which inits the FastAPI app
 
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.exceptions import RequestValidationError
 from .routes import routes
 from .config import APP_SETTINGS
@@ -9,6 +9,9 @@ from .exceptions import custom_http_exception_handler, validation_exception_hand
 from .database import Database
 from contextlib import asynccontextmanager
 from .auth.service import create_admin_user
+from .utils.inference_executor import InferenceExecutor
+from .utils.metrics import render_metrics
+from .data_gathering.service import start_ocr_model_sync, stop_ocr_model_sync, start_ocr_job_poll, stop_ocr_job_poll, stop_counter_streams
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -21,10 +24,17 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         print("Error: Database connection failed")
         raise e
+    InferenceExecutor().start_warm_up() # Start the OCR inference worker processes and load the models in the background
+    start_ocr_model_sync() # Follow the OCR model versions uploaded through the other processes and nodes
+    start_ocr_job_poll() # Run the queued OCR jobs, and resume those of the processes that stopped
     
     yield
     # Code to be executed on application shutdown
     print("App is shutting down")
+    stop_counter_streams()
+    stop_ocr_job_poll()
+    stop_ocr_model_sync()
+    InferenceExecutor().shutdown()
 
 description = """
 This is the backend for the Behery project.
@@ -60,4 +70,11 @@ app.add_exception_handler(RequestValidationError, validation_exception_handler)
 
 @app.get("/")
 async def root():
-    return {"message": "Hello World from the root of the project"}
\ No newline at end of file
+    return {"message": "Hello World from the root of the project"}
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    # OCR timings, queue waits, batch sizes and cache hits, in the Prometheus text format
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
\ No newline at end of file
@@ -0,0 +1,5 @@
+# Imported by the forkserver of the inference workers with OCR_SHARED_MODELS, see shared_models.py
+
+from .shared_models import preload
+
+preload()
@@ -0,0 +1,187 @@
+# Reads the frames of counter cameras and video files, in the frame reader process
+#
+# Every stream is watched by its own thread, which samples frames and only sends one to OCR
+# once the counter display changed and settled. Each thread sleeps as much as it needs to stay
+# within its CPU budget, so a single process can watch many counters.
+
+import os
+
+# the budget of a stream is measured on its own thread, keep the decoders single threaded
+os.environ.setdefault("OPENCV_FFMPEG_CAPTURE_OPTIONS", "threads;1")
+
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# width of the grayscale thumbnails compared to detect a change of the display
+THUMBNAIL_WIDTH = 160
+# pixels whose gray level changed by more than this count as changed
+PIXEL_THRESHOLD = 25
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+JPEG_QUALITY = 90
+STATS_INTERVAL_SECONDS = 5
+
+
+def thumbnail(frame: np.ndarray) -> np.ndarray:
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    height = max(1, round(gray.shape[0] * THUMBNAIL_WIDTH / gray.shape[1]))
+    small = cv2.resize(gray, (THUMBNAIL_WIDTH, height), interpolation=cv2.INTER_AREA)
+    # sensor noise and compression artifacts shouldn't count as a change
+    return cv2.GaussianBlur(small, (3, 3), 0)
+
+
+def changed_fraction(a: np.ndarray, b: np.ndarray) -> float:
+    """Fraction of the pixels of two thumbnails that changed."""
+    if a.shape != b.shape:
+        return 1.0
+    return float(np.count_nonzero(cv2.absdiff(a, b) > PIXEL_THRESHOLD)) / a.size
+
+
+class VideoSource:
+    """
+    A video file, read as fast as the CPU budget allows, or a live camera (device index or URL)
+    sampled in real time.
+    """
+
+    def __init__(self, source: str):
+        self.live = not os.path.isfile(source)
+        self.capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+        if not self.capture.isOpened():
+            raise ValueError(f"Could not open the stream source {source}")
+        self.started_at = time.monotonic()
+
+    def position(self) -> float:
+        """Seconds into the stream of the last frame read."""
+        if self.live:
+            return time.monotonic() - self.started_at
+        return self.capture.get(cv2.CAP_PROP_POS_MSEC) / 1000
+
+    def read(self, at: float) -> np.ndarray | None:
+        """The first frame at or after `at` seconds into the stream, None at its end."""
+        # grab only demuxes and decodes, the frames skipped are never converted
+        while self.capture.grab():
+            if self.position() >= at:
+                ok, frame = self.capture.retrieve()
+                return frame if ok else None
+        return None
+
+    def close(self):
+        self.capture.release()
+
+
+class DirectorySource:
+    """A directory of images played as consecutive samples, a stand-in for a camera."""
+
+    def __init__(self, source: str):
+        self.paths = sorted(
+            os.path.join(source, name) for name in os.listdir(source) if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        self.index = 0
+
+    def position(self) -> float:
+        return float(self.index - 1)
+
+    def read(self, at: float) -> np.ndarray | None:
+        while self.index < len(self.paths):
+            frame = cv2.imread(self.paths[self.index])
+            self.index += 1
+            if frame is not None:
+                return frame
+        return None
+
+    def close(self):
+        pass
+
+
+def open_source(source: str) -> VideoSource | DirectorySource:
+    if os.path.isdir(source):
+        return DirectorySource(source)
+    return VideoSource(source)
+
+
+class StreamWatcher(threading.Thread):
+    """
+    Watches one stream. A sampled frame is sent to OCR when it differs from the last frame that
+    was, and the display settled, i.e. it looks like the sample before it.
+
+    config: {"source", "sample_fps", "cpu_budget" (fraction of a core), "min_changed_fraction"}
+    """
+
+    def __init__(self, stream_id: str, config: dict, send):
+        super().__init__(name=f"stream-{stream_id}", daemon=True)
+        self.stream_id = stream_id
+        self.config = config
+        self.send = send
+        self.stopped = threading.Event()
+        self.stats = {"frames_sampled": 0, "frames_changed": 0, "position_seconds": 0.0, "cpu_seconds": 0.0, "wall_seconds": 0.0}
+
+    def run(self):
+        error = None
+        try:
+            self.watch()
+        except Exception as e:
+            error = str(e)
+        self.send(("ended", self.stream_id, self.stats, error))
+
+    def watch(self):
+        source = open_source(self.config["source"])
+        interval = 1 / self.config["sample_fps"]
+        min_changed = self.config["min_changed_fraction"]
+        reference = previous = None
+        next_sample = 0.0
+        cpu_start, wall_start = time.thread_time(), time.monotonic()
+        stats_sent_at = wall_start
+        try:
+            while not self.stopped.is_set():
+                frame = source.read(next_sample)
+                if frame is None:
+                    return
+                position = source.position()
+                next_sample = position + interval
+                current = thumbnail(frame)
+                settled = previous is not None and changed_fraction(current, previous) < min_changed
+                if settled and (reference is None or changed_fraction(current, reference) >= min_changed):
+                    ok, jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+                    if ok:
+                        self.send(("frame", self.stream_id, jpeg.tobytes(), position))
+                        reference = current
+                        self.stats["frames_changed"] += 1
+                previous = current
+                self.stats["frames_sampled"] += 1
+                self.stats["position_seconds"] = position
+
+                cpu, wall = time.thread_time() - cpu_start, time.monotonic() - wall_start
+                self.stats["cpu_seconds"], self.stats["wall_seconds"] = cpu, wall
+                # sleep until the CPU time of the thread is within its budget of the time elapsed
+                delay = cpu / self.config["cpu_budget"] - wall
+                if delay > 0:
+                    self.stopped.wait(delay)
+                if time.monotonic() - stats_sent_at >= STATS_INTERVAL_SECONDS:
+                    self.send(("stats", self.stream_id, dict(self.stats)))
+                    stats_sent_at = time.monotonic()
+        finally:
+            source.close()
+
+
+def run_reader(commands, messages):
+    """
+    Main loop of the frame reader process: starts and stops stream watchers on the commands
+    ("start", stream_id, config) and ("stop", stream_id, None), until it gets None.
+    """
+    cv2.setNumThreads(1)
+    watchers = dict()
+    while True:
+        command = commands.get()
+        if command is None:
+            break
+        action, stream_id, config = command
+        watchers = {watcher_id: watcher for watcher_id, watcher in watchers.items() if watcher.is_alive()}
+        if action == "start":
+            watchers[stream_id] = StreamWatcher(stream_id, config, messages.put)
+            watchers[stream_id].start()
+        elif action == "stop" and stream_id in watchers:
+            watchers.pop(stream_id).stopped.set()
+    for watcher in watchers.values():
+        watcher.stopped.set()
@@ -0,0 +1,128 @@
+# Frame streams of counter cameras and video files, watched by a separate reader process
+#
+# The frames are decoded and compared in the frame reader process (see frame_reader.py), so the
+# API process never imports OpenCV. Only the frames where the counter display changed come back
+# to the API process, where they go through the OCR path like uploaded photos.
+
+import asyncio
+import multiprocessing
+import threading
+from datetime import datetime
+from typing import Callable
+
+
+def _run_reader(commands, messages):
+    from .frame_reader import run_reader
+    run_reader(commands, messages)
+
+
+class FrameStreams:
+    """
+    A singleton frame reader process watching the streams of this API process. The process is
+    started with the first stream.
+
+    Usage:
+    from utils.frame_streams import FrameStreams
+    FrameStreams().start(stream_id, config, on_frame)
+    stats = FrameStreams().get_stats(stream_id)
+    """
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = super(FrameStreams, cls).__new__(cls)
+            cls._instance.initialize_reader()
+        return cls._instance
+
+    def initialize_reader(self):
+        # spawn, so the reader doesn't inherit the event loop or open DB sockets
+        mp_context = multiprocessing.get_context('spawn')
+        self.commands = mp_context.Queue()
+        self.messages = mp_context.Queue()
+        self.process = mp_context.Process(target=_run_reader, args=(self.commands, self.messages), daemon=True)
+        self.process.start()
+        # stream id -> stats of the stream, as last reported by the reader
+        self.stats = dict()
+        # stream id -> called with (jpeg contents, position in seconds) for every changed frame
+        self.handlers = dict()
+        # stream id -> called once the reader let go of the stream, stopped or ended
+        self.end_handlers = dict()
+        self.loop = asyncio.get_running_loop()
+        # the messages of the reader are handed over to the event loop by a thread
+        self.listener = threading.Thread(target=self.listen, name="frame-streams", daemon=True)
+        self.listener.start()
+        print(f'Started the frame reader process {self.process.pid}')
+
+    def listen(self):
+        while True:
+            message = self.messages.get()
+            if message is None:
+                return
+            self.loop.call_soon_threadsafe(self.dispatch, message)
+
+    def dispatch(self, message: tuple):
+        kind, stream_id, *payload = message
+        if stream_id not in self.stats:
+            return
+        if kind == "frame":
+            # frames already queued when the stream was stopped are dropped
+            on_frame = self.handlers.get(stream_id)
+            if on_frame is not None:
+                contents, position = payload
+                on_frame(contents, position)
+        elif kind == "stats":
+            self.stats[stream_id].update(payload[0])
+        elif kind == "ended":
+            stats, error = payload
+            self.stats[stream_id].update(stats)
+            if self.stats[stream_id]["status"] == "running":
+                self.stats[stream_id]["status"] = "failed" if error is not None else "ended"
+            self.stats[stream_id]["error"] = error
+            self.handlers.pop(stream_id, None)
+            on_end = self.end_handlers.pop(stream_id, None)
+            if on_end is not None:
+                on_end()
+
+    def start(
+            self,
+            stream_id: str,
+            config: dict,
+            on_frame: Callable[[bytes, float], None],
+            on_end: Callable[[], None] | None = None,
+    ):
+        """
+        Start watching a stream, see frame_reader.StreamWatcher for the config. on_end is called
+        once the reader closed the stream, after it ended or was stopped.
+        """
+        self.stats[stream_id] = {"status": "running", "error": None, "started_at": datetime.now()}
+        self.handlers[stream_id] = on_frame
+        if on_end is not None:
+            self.end_handlers[stream_id] = on_end
+        self.commands.put(("start", stream_id, config))
+
+    def stop(self, stream_id: str):
+        if self.stats.get(stream_id, {}).get("status") == "running":
+            self.stats[stream_id]["status"] = "stopped"
+        self.handlers.pop(stream_id, None)
+        self.commands.put(("stop", stream_id, None))
+
+    def forget(self, stream_id: str):
+        """Drop the stats of a stream that stopped or ended."""
+        self.stats.pop(stream_id, None)
+        self.handlers.pop(stream_id, None)
+        self.end_handlers.pop(stream_id, None)
+
+    def get_stats(self, stream_id: str) -> dict:
+        return dict(self.stats.get(stream_id, {}))
+
+    def running(self) -> int:
+        return sum(stats["status"] == "running" for stats in self.stats.values())
+
+    def shutdown(self):
+        self.commands.put(None)
+        self.messages.put(None)
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        FrameStreams._instance = None
+        print('Frame reader process shut down')
@@ -0,0 +1,78 @@
+# Image quality gate, run in the API process before a photo is queued for inference
+#
+# Photos too small, blurry, dark or washed out by glare to be read are rejected right away
+# with their scores, so the operator can retake them without waiting for the OCR.
+
+import io
+
+import numpy as np
+
+# longest side of the grayscale copy the scores are measured on, so they don't depend on the
+# resolution of the photo. JPEGs are decoded at a reduced scale close to it, which takes milliseconds
+ANALYSIS_SIZE = 512
+# gray levels at or above this are blown out
+GLARE_LEVEL = 250
+# the exposure is the gray level of this percentile, so bright digits on a dark display still count
+EXPOSURE_PERCENTILE = 99
+
+
+def measure_quality(contents: bytes) -> dict | None:
+    """
+    Scores of a photo:
+        width, height: size of the photo in pixels
+        sharpness: variance of the Laplacian of the grayscale copy, blurry photos score low
+        exposure: gray level (0-255) of the brightest pixels, dark photos score low
+        glare: fraction of blown out pixels
+
+    Returns:
+        dict | None: the scores, or None if the image can't be decoded
+    """
+    from PIL import Image
+
+    try:
+        img = Image.open(io.BytesIO(contents))
+        width, height = img.size
+        img.draft('L', (ANALYSIS_SIZE, ANALYSIS_SIZE))
+        gray = img.convert('L')
+        gray.thumbnail((ANALYSIS_SIZE, ANALYSIS_SIZE), Image.BILINEAR)
+        pixels = np.asarray(gray, dtype=np.float32)
+    except Exception:
+        return None
+    if min(pixels.shape) < 3:
+        return None
+    laplacian = (
+        pixels[:-2, 1:-1] + pixels[2:, 1:-1] + pixels[1:-1, :-2] + pixels[1:-1, 2:]
+        - 4 * pixels[1:-1, 1:-1]
+    )
+    return {
+        "width": width,
+        "height": height,
+        "sharpness": round(float(laplacian.var()), 1),
+        "exposure": round(float(np.percentile(pixels, EXPOSURE_PERCENTILE)), 1),
+        "glare": round(float(np.count_nonzero(pixels >= GLARE_LEVEL)) / pixels.size, 4),
+    }
+
+
+def quality_problems(scores: dict | None, thresholds: dict) -> dict:
+    """
+    What is wrong with a photo, and what to do about it.
+
+    Args:
+        scores (dict | None): the scores of measure_quality
+        thresholds (dict): min_side, min_sharpness, min_exposure, max_glare
+
+    Returns:
+        dict: problem (undecodable, small, blurry, dark, glare) -> message, empty if the photo can be read
+    """
+    if scores is None:
+        return {"undecodable": "the image can't be decoded, upload a JPEG or PNG photo"}
+    problems = dict()
+    if min(scores["width"], scores["height"]) < thresholds["min_side"]:
+        problems["small"] = f"too small ({scores['width']}x{scores['height']} pixels, at least {thresholds['min_side']} on the short side), use the full camera resolution"
+    if scores["sharpness"] < thresholds["min_sharpness"]:
+        problems["blurry"] = f"blurry (sharpness {scores['sharpness']}, at least {thresholds['min_sharpness']}), hold the camera still and focus on the display"
+    if scores["exposure"] < thresholds["min_exposure"]:
+        problems["dark"] = f"too dark (exposure {scores['exposure']}, at least {thresholds['min_exposure']}), add light or turn on the flash"
+    if scores["glare"] > thresholds["max_glare"]:
+        problems["glare"] = f"glare ({scores['glare']:.0%} of the photo blown out, at most {thresholds['max_glare']:.0%}), change the angle of the camera"
+    return problems
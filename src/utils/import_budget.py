@@ -0,0 +1,51 @@
+# Import time budget check for the API process
+#
+# Usage (from the root directory of the project):
+#   python -m src.utils.import_budget --budget 1.0
+#
+# Imports the app in a fresh interpreter, and fails if it takes longer than the budget
+# or if it pulls in any of the heavy ML packages, which belong to the inference workers only.
+
+import argparse
+import json
+import subprocess
+import sys
+
+HEAVY_MODULES = ["torch", "torchvision", "cv2", "easyocr", "ultralytics", "models.yolo", "onnxruntime"]
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = [name for name in {heavy_modules!r} if name in sys.modules]
+print(json.dumps({{"seconds": elapsed, "heavy_modules": heavy}}))
+"""
+
+
+def measure_import(module: str) -> dict:
+    script = IMPORT_SCRIPT.format(module=module, heavy_modules=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True)
+    if output.returncode != 0:
+        print(output.stderr, file=sys.stderr)
+        sys.exit(f"Importing {module} failed")
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import time of the API process")
+    parser.add_argument("--module", default="src.main", help="module to import (default: src.main)")
+    parser.add_argument("--budget", type=float, default=1.0, help="maximum import time in seconds (default: 1.0)")
+    args = parser.parse_args()
+
+    result = measure_import(args.module)
+    result["module"] = args.module
+    result["budget"] = args.budget
+    result["ok"] = result["seconds"] <= args.budget and not result["heavy_modules"]
+    print(json.dumps(result))
+    if not result["ok"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+# Inference backends that run the YOLOv5 counter detection models
+#
+# Every backend takes a batch of images and returns, for every image, an array of
+# detections with one row per detected object: x1, y1, x2, y2 (normalized), confidence, class
+
+import json
+import os
+
+import cv2
+import numpy as np
+
+
+class InferenceBackend:
+    """Base class of the detection backends."""
+
+    # class index -> label name
+    names: dict = dict()
+    # memory used by the loaded weights, used by the model registry to bound the memory usage
+    nbytes: int = 0
+
+    def predict(self, imgs: list, size: int | None = None) -> list[np.ndarray]:
+        """
+        Args:
+            size (int | None): network input size, smaller sizes are faster but miss small objects.
+                Defaults to the size the model was trained or exported with.
+        """
+        raise NotImplementedError
+
+
+class TorchBackend(InferenceBackend):
+    """Runs a model loaded through the YOLOv5 torch hub wrapper (AutoShape)."""
+
+    def __init__(self, model):
+        self.model = model
+        self.names = dict(enumerate(model.names)) if isinstance(model.names, list) else model.names
+        tensors = list(model.parameters()) + list(model.buffers())
+        self.nbytes = sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+    def predict(self, imgs: list, size: int | None = None) -> list[np.ndarray]:
+        results = self.model(imgs, size=size or 640)
+        return [xyxyn.cpu().numpy() for xyxyn in results.xyxyn]
+
+
+class OnnxBackend(InferenceBackend):
+    """
+    Runs a YOLOv5 model exported to ONNX with ONNX Runtime on the CPU.
+    Preprocessing, NMS and box decoding mirror the YOLOv5 AutoShape wrapper, so the
+    detections match the torch backend.
+    """
+
+    def __init__(
+            self,
+            onnx_path: str,
+            conf_thres: float = 0.25,
+            iou_thres: float = 0.45,
+            max_det: int = 1000,
+            intra_op_num_threads: int = 0,
+    ):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_num_threads
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        batch_dim, _, height, width = self.session.get_inputs()[0].shape
+        # exports with a fixed batch size are run one image at a time
+        self.dynamic_batch = not isinstance(batch_dim, int)
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.names = {int(k): v for k, v in json.loads(metadata['names']).items()}
+        self.stride = int(metadata.get('stride', 32))
+        # exports with a fixed input size ignore the size asked for at prediction time, as do the
+        # exports made before their anchor grids were computed from the input shape
+        self.dynamic_size = not isinstance(height, int) and metadata.get('dynamic') == 'True'
+        imgsz = int(metadata.get('imgsz', 640))
+        self.input_size = (height, width) if isinstance(height, int) else (imgsz, imgsz)
+        self.conf_thres = conf_thres
+        self.iou_thres = iou_thres
+        self.max_det = max_det
+        self.nbytes = os.path.getsize(onnx_path)
+
+    def predict(self, imgs: list, size: int | None = None) -> list[np.ndarray]:
+        if len(imgs) == 0:
+            return []
+        input_size = self.input_size
+        if size is not None and self.dynamic_size:
+            size = max(self.stride, round(size / self.stride) * self.stride)
+            input_size = (size, size)
+        inputs, gains, pads = zip(*[letterbox(img, input_size) for img in imgs])
+        batch = np.stack(inputs)
+        if self.dynamic_batch:
+            outputs = self.session.run(None, {self.input_name: batch})[0]
+        else:
+            outputs = np.concatenate([self.session.run(None, {self.input_name: x[None]})[0] for x in batch])
+
+        detections = []
+        for img, output, gain, pad in zip(imgs, outputs, gains, pads):
+            det = non_max_suppression(output, self.conf_thres, self.iou_thres, self.max_det)
+            # undo the letterbox, then normalize by the original image size
+            det[:, [0, 2]] = (det[:, [0, 2]] - pad[0]) / gain
+            det[:, [1, 3]] = (det[:, [1, 3]] - pad[1]) / gain
+            height, width = img.shape[:2]
+            det[:, [0, 2]] = det[:, [0, 2]].clip(0, width) / width
+            det[:, [1, 3]] = det[:, [1, 3]].clip(0, height) / height
+            detections.append(det)
+        return detections
+
+
+def letterbox(img: np.ndarray, size: tuple[int, int]):
+    """
+    Resize an image to fit size (height, width) keeping its aspect ratio, pad the rest, and
+    convert it to a normalized CHW float array.
+
+    Returns:
+        tuple: the network input, the resize gain and the (left, top) padding
+    """
+    height, width = img.shape[:2]
+    gain = min(size[0] / height, size[1] / width)
+    new_width, new_height = round(width * gain), round(height * gain)
+    pad_x, pad_y = (size[1] - new_width) / 2, (size[0] - new_height) / 2
+    if (new_width, new_height) != (width, height):
+        img = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+    top, bottom = round(pad_y - 0.1), round(pad_y + 0.1)
+    left, right = round(pad_x - 0.1), round(pad_x + 0.1)
+    img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+    x = img.transpose(2, 0, 1).astype(np.float32) / 255
+    return np.ascontiguousarray(x), gain, (pad_x, pad_y)
+
+
+def non_max_suppression(prediction: np.ndarray, conf_thres: float, iou_thres: float, max_det: int) -> np.ndarray:
+    """
+    NumPy port of the YOLOv5 non max suppression for a single image.
+
+    Args:
+        prediction (np.ndarray): raw network output, one row per anchor: cx, cy, w, h, objectness, class scores...
+
+    Returns:
+        np.ndarray: one row per kept box: x1, y1, x2, y2, confidence, class
+    """
+    x = prediction[prediction[:, 4] > conf_thres]
+    if len(x) == 0:
+        return np.zeros((0, 6), dtype=np.float32)
+    scores = x[:, 5:] * x[:, 4:5]
+    cls = scores.argmax(1)
+    conf = scores[np.arange(len(scores)), cls]
+    keep = conf > conf_thres
+    x, cls, conf = x[keep], cls[keep], conf[keep]
+
+    boxes = np.empty((len(x), 4), dtype=np.float32)
+    boxes[:, 0] = x[:, 0] - x[:, 2] / 2
+    boxes[:, 1] = x[:, 1] - x[:, 3] / 2
+    boxes[:, 2] = x[:, 0] + x[:, 2] / 2
+    boxes[:, 3] = x[:, 1] + x[:, 3] / 2
+
+    order = conf.argsort()[::-1][:30000]
+    boxes, conf, cls = boxes[order], conf[order], cls[order]
+    # offset the boxes by class so that boxes of different classes never suppress each other
+    offset_boxes = boxes + cls[:, None] * 7680.0
+    areas = (offset_boxes[:, 2] - offset_boxes[:, 0]) * (offset_boxes[:, 3] - offset_boxes[:, 1])
+
+    kept = []
+    remaining = np.arange(len(offset_boxes))
+    while len(remaining) > 0 and len(kept) < max_det:
+        i = remaining[0]
+        kept.append(i)
+        rest = remaining[1:]
+        x1 = np.maximum(offset_boxes[i, 0], offset_boxes[rest, 0])
+        y1 = np.maximum(offset_boxes[i, 1], offset_boxes[rest, 1])
+        x2 = np.minimum(offset_boxes[i, 2], offset_boxes[rest, 2])
+        y2 = np.minimum(offset_boxes[i, 3], offset_boxes[rest, 3])
+        intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+        iou = intersection / (areas[i] + areas[rest] - intersection)
+        remaining = rest[iou <= iou_thres]
+
+    return np.concatenate([boxes[kept], conf[kept, None], cls[kept, None].astype(np.float32)], axis=1)
+
+
+def export_onnx(torch_model, onnx_path: str, input_size: int = 640, rtol: float = 1e-3, atol: float = 1e-3):
+    """
+    Export a model loaded through the YOLOv5 torch hub wrapper to ONNX, and check that ONNX Runtime
+    gives the same raw predictions as torch, at the export size and at half of it, since the export
+    takes any input size. The file is written atomically, so a worker never loads a partially
+    written export.
+
+    Raises:
+        ValueError: if the ONNX predictions don't match the torch predictions within rtol and atol
+    """
+    import onnx
+    import onnxruntime
+    import torch
+
+    # AutoShape -> DetectMultiBackend -> DetectionModel
+    detection_model = torch_model.model.model
+    detection_model.eval()
+    detection_model.float()
+    # the Detect layers only return the concatenated predictions when exporting, and only compute
+    # their anchor grids from the input shape when dynamic, otherwise the grids of the dry run are
+    # traced into the graph as constants, as in yolov5 export.py
+    detect_layers = [module for module in detection_model.modules() if hasattr(module, 'anchor_grid')]
+    for detect_layer in detect_layers:
+        detect_layer.export = True
+        detect_layer.dynamic = True
+    stride = int(max(getattr(detection_model, 'stride', torch.tensor([32])).max(), 32))
+
+    check_size = max(stride, input_size // 2 // stride * stride)
+    dummy_input = torch.rand(1, 3, input_size, input_size)
+    check_inputs = [dummy_input, torch.rand(1, 3, check_size, check_size)]
+    tmp_path = f'{onnx_path}.tmp'
+    try:
+        with torch.no_grad():
+            torch_outputs = []
+            for check_input in check_inputs:
+                torch_output = detection_model(check_input)
+                torch_output = torch_output[0] if isinstance(torch_output, (tuple, list)) else torch_output
+                torch_outputs.append(torch_output.numpy())
+            torch.onnx.export(
+                detection_model,
+                dummy_input,
+                tmp_path,
+                opset_version=12,
+                input_names=['images'],
+                output_names=['output0'],
+                # dynamic height and width let the cascade detect on downscaled images
+                dynamic_axes={'images': {0: 'batch', 2: 'height', 3: 'width'}, 'output0': {0: 'batch', 1: 'anchors'}},
+            )
+    finally:
+        for detect_layer in detect_layers:
+            detect_layer.export = False
+            detect_layer.dynamic = False
+
+    names = torch_model.names
+    if isinstance(names, list):
+        names = dict(enumerate(names))
+    onnx_model = onnx.load(tmp_path)
+    for key, value in {'names': json.dumps(names), 'stride': str(stride), 'imgsz': str(input_size), 'dynamic': 'True'}.items():
+        meta = onnx_model.metadata_props.add()
+        meta.key, meta.value = key, value
+    onnx.save(onnx_model, tmp_path)
+
+    session = onnxruntime.InferenceSession(tmp_path, providers=['CPUExecutionProvider'])
+    max_diff = 0.0
+    for check_input, torch_output in zip(check_inputs, torch_outputs):
+        onnx_output = session.run(None, {'images': check_input.numpy()})[0]
+        size = check_input.shape[-1]
+        if onnx_output.shape != torch_output.shape:
+            os.remove(tmp_path)
+            raise ValueError(f"OCR: ONNX export of {onnx_path} gives {onnx_output.shape} predictions at size {size} instead of {torch_output.shape}")
+        diff = float(np.abs(onnx_output - torch_output).max())
+        if not np.allclose(onnx_output, torch_output, rtol=rtol, atol=atol):
+            os.remove(tmp_path)
+            raise ValueError(f"OCR: ONNX export of {onnx_path} differs from torch at size {size} by {diff}")
+        max_diff = max(max_diff, diff)
+    os.replace(tmp_path, onnx_path)
+    print(f"OCR: Exported {onnx_path} (max difference from torch: {max_diff:.2e})")
+
+
+def quantize_onnx(onnx_path: str, quantized_path: str, calibration_imgs: list):
+    """
+    Quantize an ONNX export to INT8. With calibration images the activations are statically
+    quantized using ranges measured on those images, otherwise only the weights are quantized
+    (dynamic quantization). The file is written atomically.
+    """
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static
+
+    tmp_path = f'{quantized_path}.tmp'
+    if len(calibration_imgs) == 0:
+        quantize_dynamic(onnx_path, tmp_path, weight_type=QuantType.QUInt8)
+    else:
+        fp32_model = OnnxBackend(onnx_path)
+
+        class ImagesDataReader(CalibrationDataReader):
+            def __init__(self):
+                self.inputs = iter([letterbox(img, fp32_model.input_size)[0][None] for img in calibration_imgs])
+
+            def get_next(self):
+                x = next(self.inputs, None)
+                return None if x is None else {fp32_model.input_name: x}
+
+        quantize_static(
+            onnx_path,
+            tmp_path,
+            ImagesDataReader(),
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+        )
+    os.replace(tmp_path, quantized_path)
+
+
+def detections_agreement(reference: np.ndarray, candidate: np.ndarray, iou_thres: float = 0.5) -> float:
+    """
+    Fraction of the reference detections that the candidate also found, with the same class
+    and an IoU of at least iou_thres. Extra candidate detections count against it too.
+    """
+    if len(reference) == 0 and len(candidate) == 0:
+        return 1.0
+    matched = 0
+    used = set()
+    for ref in reference:
+        for i, cand in enumerate(candidate):
+            if i in used or int(cand[5]) != int(ref[5]):
+                continue
+            x1, y1 = max(ref[0], cand[0]), max(ref[1], cand[1])
+            x2, y2 = min(ref[2], cand[2]), min(ref[3], cand[3])
+            intersection = max(x2 - x1, 0) * max(y2 - y1, 0)
+            union = (ref[2] - ref[0]) * (ref[3] - ref[1]) + (cand[2] - cand[0]) * (cand[3] - cand[1]) - intersection
+            if union > 0 and intersection / union >= iou_thres:
+                matched += 1
+                used.add(i)
+                break
+    return matched / max(len(reference), len(candidate))
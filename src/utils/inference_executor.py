@@ -0,0 +1,349 @@
+# Process pool that runs the OCR models away from the event loop
+
+import asyncio
+import multiprocessing
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+from fastapi import HTTPException, status
+
+from ..config import APP_SETTINGS
+from . import metrics
+
+
+def _init_worker():
+    if APP_SETTINGS.OCR_SHARED_MODELS:
+        from .shared_models import init_forked_worker
+        init_forked_worker()
+    from . import ocr_model
+
+
+def _warm_up_worker():
+    import os
+    from .ocr_model import warm_up
+    warm_up()
+    return os.getpid()
+
+
+def _get_digits_from_images(images: list[bytes], model_name: str, options: list[dict]):
+    from .ocr_model import get_digits_from_images, models, timings
+    from .shared_models import process_memory
+    with timings.stage("total"):
+        results = get_digits_from_images(images, model_name, options)
+    # the model registry stats, memory usage and stage timings of the worker travel back with every batch
+    return results, {**models.stats(), "memory": process_memory()}, timings.drain()
+
+
+def _preload_model(model_file_name: str, smoke_image: str | None):
+    from .ocr_model import preload_model
+    return preload_model(model_file_name, smoke_image)
+
+
+def _release_model(model_file_name: str):
+    from .ocr_model import release_model
+    return release_model(model_file_name)
+
+
+def _quantize_model(model_file_name: str, calibration_image_paths: list[str]):
+    from .ocr_model import quantize_model
+    return quantize_model(model_file_name, calibration_image_paths)
+
+
+def _calibrate_model(model_file_name: str, samples: list[tuple[str, dict]], recognizer: str):
+    from .ocr_model import calibrate_model
+    return calibrate_model(
+        model_file_name,
+        samples,
+        recognizer,
+        APP_SETTINGS.OCR_CALIBRATION_SIZES,
+        APP_SETTINGS.OCR_CALIBRATION_MAX_ACCURACY_DROP,
+    )
+
+
+class ModelBatcher:
+    """
+    Collects the images sent to one OCR model within a short time window and
+    runs them through the model as a single batch, then hands every caller
+    its own result back.
+
+    A batch is sent to the workers when it reaches max_batch_size images, or
+    max_wait seconds after its first image arrived, whichever comes first.
+    """
+
+    def __init__(self, executor: "InferenceExecutor", model_name: str, max_batch_size: int, max_wait: float):
+        self.executor = executor
+        self.model_name = model_name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.items = []
+        self.flush_handle = None
+        # the batches sent to the workers, the event loop only keeps weak references to its tasks
+        self.tasks = set()
+
+    async def predict(self, image: bytes, options: dict) -> dict:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.items.append((image, options, future, time.perf_counter()))
+        if len(self.items) >= self.max_batch_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.max_wait, self.flush)
+        return await future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        items, self.items = self.items, []
+        if items:
+            task = asyncio.ensure_future(self.run_batch(items))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run_batch(self, items: list):
+        images = [image for image, _, _, _ in items]
+        options = [image_options for _, image_options, _, _ in items]
+        sent_at = time.perf_counter()
+        try:
+            results, model_stats, stage_timings = await self.executor.run(_get_digits_from_images, images, self.model_name, options)
+            self.executor.model_stats[model_stats["pid"]] = model_stats
+            # the time the batch spent in the pool without a free worker is what the worker didn't measure
+            worker_seconds = sum(seconds for stage, seconds in stage_timings if stage == "total")
+            pool_wait = max(time.perf_counter() - sent_at - worker_seconds, 0)
+            queue_waits = [sent_at - enqueued_at + pool_wait for _, _, _, enqueued_at in items]
+            metrics.observe_batch(self.model_name, len(items), stage_timings, queue_waits)
+        except Exception as e:
+            results = [e] * len(items)
+        for (_, _, future, _), result in zip(items, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+class InferenceExecutor:
+    """
+    A singleton process pool that runs OCR inference outside of the API process.
+    Every worker process holds its own copy of the OCR models, and at most
+    OCR_QUEUE_SIZE jobs can be waiting or running at the same time.
+
+    Usage:
+    from utils.inference_executor import InferenceExecutor
+    results = await InferenceExecutor().get_digits_from_images(images, model_name, options)
+
+    raises:
+        HTTPException: if the submission queue is full
+    """
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = super(InferenceExecutor, cls).__new__(cls)
+            cls._instance.initialize_pool()
+        return cls._instance
+
+    def create_pool(self) -> ProcessPoolExecutor:
+        # spawn, so the workers don't inherit the event loop or open DB sockets
+        mp_context = multiprocessing.get_context('spawn')
+        if APP_SETTINGS.OCR_SHARED_MODELS:
+            # forked from a clean process that loaded the models once, see shared_models.py
+            mp_context = multiprocessing.get_context('forkserver')
+            mp_context.set_forkserver_preload([f'{__package__}.forkserver_preload'])
+        return ProcessPoolExecutor(
+            max_workers=APP_SETTINGS.OCR_WORKERS,
+            mp_context=mp_context,
+            initializer=_init_worker,
+        )
+
+    def initialize_pool(self):
+        self.pool = self.create_pool()
+        self.queue_size = APP_SETTINGS.OCR_QUEUE_SIZE
+        self.pending = 0
+        self.batchers = dict()
+        # worker pid -> model registry stats, as of the last batch that worker ran
+        self.model_stats = dict()
+        # model name -> images submitted to it that didn't get their result yet
+        self.in_flight = Counter()
+        self.warm_up_task = None
+        print(f'Started OCR inference pool with {APP_SETTINGS.OCR_WORKERS} workers')
+
+    @contextmanager
+    def reserve(self, slots: int = 1):
+        """
+        Take slots in the submission queue for the duration of the block.
+
+        Raises:
+            HTTPException: if the submission queue doesn't have that many free slots
+        """
+        if self.pending + slots > self.queue_size:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="OCR queue is full, please try again later")
+        self.pending += slots
+        try:
+            yield
+        finally:
+            self.pending -= slots
+
+    async def run(self, fn, *args):
+        """
+        Run fn(*args) in one of the worker processes.
+
+        Raises:
+            BrokenProcessPool: if a worker died (e.g. killed for using too much memory), the jobs
+            running in the pool fail and the pool is replaced for the next ones
+        """
+        loop = asyncio.get_running_loop()
+        pool = self.pool
+        try:
+            return await loop.run_in_executor(pool, fn, *args)
+        except BrokenProcessPool:
+            self.replace_pool(pool)
+            raise
+
+    def replace_pool(self, broken_pool: ProcessPoolExecutor):
+        """Start a new pool in place of a broken one, and warm it up."""
+        if self.pool is not broken_pool:
+            # another job that ran in the broken pool already replaced it
+            return
+        print('OCR inference pool broken, a worker died, starting a new one')
+        broken_pool.shutdown(wait=False, cancel_futures=True)
+        self.pool = self.create_pool()
+        self.model_stats.clear()
+        if self.warm_up_task is not None:
+            self.warm_up_task.cancel()
+        self.start_warm_up()
+
+    def get_batcher(self, model_name: str) -> ModelBatcher:
+        if model_name not in self.batchers:
+            self.batchers[model_name] = ModelBatcher(
+                self,
+                model_name,
+                max_batch_size=APP_SETTINGS.OCR_BATCH_MAX_SIZE,
+                max_wait=APP_SETTINGS.OCR_BATCH_MAX_WAIT_MS / 1000,
+            )
+        return self.batchers[model_name]
+
+    async def get_digits_from_images(self, images: list[bytes], model_name: str, options: list[dict]) -> list[dict | Exception]:
+        """
+        Read the counters of several images with the same model, given as the contents of the uploaded
+        files. The images are decoded in the workers, they never touch the disk on the way. They are
+        queued together, so they are sent to the workers in as few batches as OCR_BATCH_MAX_SIZE allows.
+        More images than the submission queue has free slots for are queued in turns.
+
+        Args:
+            options (list[dict]): options of the OCR model for every image, see ocr_model.get_digits_from_images
+
+        Returns:
+            list: the digits ("values") and confidences ("confidences") of every label of every image,
+            or the exception it raised
+
+        Raises:
+            HTTPException: if the submission queue is full
+        """
+        batcher = self.get_batcher(model_name)
+        start = time.perf_counter()
+
+        async def predict(image: bytes, image_options: dict | None) -> dict:
+            results = await batcher.predict(image, image_options or dict())
+            metrics.OCR_REQUEST_SECONDS.labels(model_name).observe(time.perf_counter() - start)
+            return results
+
+        items = list(zip(images, options))
+        results = []
+        while len(results) < len(items):
+            # as many images as there are free slots, the queue is shared with the other uploads
+            chunk = items[len(results):len(results) + max(self.queue_size - self.pending, 1)]
+            with self.reserve(len(chunk)):
+                self.in_flight[model_name] += len(chunk)
+                try:
+                    results += await asyncio.gather(
+                        *[predict(image, image_options) for image, image_options in chunk],
+                        return_exceptions=True,
+                    )
+                finally:
+                    self.in_flight[model_name] -= len(chunk)
+                    if self.in_flight[model_name] == 0:
+                        del self.in_flight[model_name]
+        return results
+
+    async def warm_up(self):
+        # one job per worker, submitted together so that every worker process gets started
+        jobs = [self.run(_warm_up_worker) for _ in range(APP_SETTINGS.OCR_WORKERS)]
+        for result in await asyncio.gather(*jobs, return_exceptions=True):
+            if isinstance(result, Exception):
+                print(f'OCR worker warm up failed: {result}')
+            else:
+                print(f'OCR worker {result} warmed up')
+
+    def start_warm_up(self):
+        """Warm up the workers in the background, without delaying the app startup."""
+        self.warm_up_task = asyncio.ensure_future(self.warm_up())
+
+    async def run_on_every_worker(self, fn, *args, max_rounds: int = 3) -> set[int]:
+        """
+        Run fn(*args) in every worker. The pool can't target a worker, so jobs are submitted
+        together, one per worker, until every worker ran one or max_rounds is reached.
+        fn must return the pid of its worker.
+
+        Returns:
+            set[int]: the pids of the workers that ran fn
+
+        Raises:
+            Exception: the first exception raised by fn
+        """
+        pids = set()
+        for _ in range(max_rounds):
+            results = await asyncio.gather(*[self.run(fn, *args) for _ in range(APP_SETTINGS.OCR_WORKERS)])
+            pids.update(results)
+            if len(pids) >= APP_SETTINGS.OCR_WORKERS:
+                break
+        return pids
+
+    async def preload_model(self, model_name: str, smoke_image: str | None = None):
+        """
+        Load a new model version in the workers and smoke test it, before it serves requests.
+        A background job, so it doesn't take a slot in the submission queue of the uploads.
+
+        Raises:
+            Exception: if the model can't be loaded or its smoke inference fails
+        """
+        pids = await self.run_on_every_worker(_preload_model, model_name, smoke_image)
+        print(f'OCR model {model_name} loaded by workers {sorted(pids)}')
+
+    async def release_model(self, model_name: str, timeout: float = 60.0):
+        """Unload a model version from the workers, once the images submitted to it got their results."""
+        deadline = time.monotonic() + timeout
+        while self.in_flight[model_name] > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.in_flight[model_name] > 0:
+            # the entry is dropped by the last of them, a worker unloading the model loads it again for them
+            print(f'OCR model {model_name} still has {self.in_flight[model_name]} images in flight after {timeout}s, releasing it anyway')
+        self.batchers.pop(model_name, None)
+        # a worker the release doesn't reach evicts the model from its cache once it goes unused
+        pids = await self.run_on_every_worker(_release_model, model_name)
+        print(f'OCR model {model_name} released by workers {sorted(pids)}')
+
+    async def quantize_model(self, model_file_name: str, calibration_image_paths: list[str]) -> dict:
+        # a background job, so it doesn't take a slot in the submission queue of the uploads
+        return await self.run(_quantize_model, model_file_name, calibration_image_paths)
+
+    async def calibrate_model(self, model_file_name: str, samples: list[tuple[str, dict]], recognizer: str) -> dict:
+        """
+        Find the smallest input size of a model that reads the stored images of its counter as
+        well as the largest one, see ocr_model.calibrate_model. A background job, like quantize_model.
+        """
+        return await self.run(_calibrate_model, model_file_name, samples, recognizer)
+
+    def get_model_stats(self) -> list[dict]:
+        return list(self.model_stats.values())
+
+    def shutdown(self):
+        if self.warm_up_task is not None:
+            self.warm_up_task.cancel()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        InferenceExecutor._instance = None
+        print('OCR inference pool shut down')
@@ -0,0 +1,56 @@
+# Prometheus metrics of the OCR path, served on /metrics
+#
+# The stage timings are measured in the inference workers (see utils/stage_timings.py)
+# and added here when their batch comes back to the API process.
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+OCR_STAGE_SECONDS = Histogram(
+    "ocr_stage_seconds",
+    "Time spent in each stage of the OCR path, per model. Stages run once per batch, image or field.",
+    ["stage", "model"],
+    buckets=LATENCY_BUCKETS,
+)
+OCR_QUEUE_WAIT_SECONDS = Histogram(
+    "ocr_queue_wait_seconds",
+    "Time an image waited for its batch to fill and for a free inference worker",
+    ["model"],
+    buckets=LATENCY_BUCKETS,
+)
+OCR_REQUEST_SECONDS = Histogram(
+    "ocr_request_seconds",
+    "Time to read the counters of an uploaded image, from submission to result, cache hits excluded",
+    ["model"],
+    buckets=LATENCY_BUCKETS,
+)
+OCR_BATCH_SIZE = Histogram(
+    "ocr_batch_size",
+    "Number of images in the batches sent to the inference workers",
+    ["model"],
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+OCR_QUALITY_REJECTIONS = Counter(
+    "ocr_quality_rejections",
+    "Photos rejected by the quality gate before inference, per problem (a photo can have several)",
+    ["problem"],
+)
+OCR_RESULT_CACHE_LOOKUPS = Counter(
+    "ocr_result_cache_lookups",
+    "Lookups in the OCR result cache",
+    ["result"],
+)
+
+
+def observe_batch(model_name: str, batch_size: int, stage_timings: list[tuple[str, float]], queue_waits: list[float]):
+    OCR_BATCH_SIZE.labels(model_name).observe(batch_size)
+    for stage, seconds in stage_timings:
+        OCR_STAGE_SECONDS.labels(stage, model_name).observe(seconds)
+    for seconds in queue_waits:
+        OCR_QUEUE_WAIT_SECONDS.labels(model_name).observe(seconds)
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """The metrics in the Prometheus text format, and its content type."""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,108 @@
+# Bounded, least recently used cache of loaded OCR models
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+
+
+class ModelRegistry:
+    """
+    Loads OCR models on first use and keeps only the most recently used ones in memory.
+    When more than max_models models are loaded, or their total size goes over max_bytes,
+    the least recently used models are evicted. A limit of 0 means no limit.
+
+    Usage:
+    registry = ModelRegistry(loader=load_model, sizer=model_size, max_models=8)
+    model = registry.get('model_file_name')
+    """
+
+    def __init__(
+            self,
+            loader: Callable[[str], Any],
+            sizer: Callable[[Any], int],
+            max_models: int = 0,
+            max_bytes: int = 0,
+    ):
+        self.loader = loader
+        self.sizer = sizer
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        # model name -> (model, size in bytes), ordered from least to most recently used
+        self.models = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+
+    def __contains__(self, model_name: str) -> bool:
+        return model_name in self.models
+
+    def keys(self) -> list[str]:
+        return list(self.models.keys())
+
+    def get(self, model_name: str):
+        """
+        Get a model, loading it if it is not in memory yet.
+
+        Raises:
+            Exception: whatever the loader raises if the model can't be loaded
+        """
+        with self.lock:
+            if model_name in self.models:
+                self.hits += 1
+                self.models.move_to_end(model_name)
+                return self.models[model_name][0]
+            self.misses += 1
+            return self.add(model_name)
+
+    def add(self, model_name: str):
+        """Load a model, replacing any loaded model with the same name."""
+        with self.lock:
+            start = time.perf_counter()
+            model = self.loader(model_name)
+            load_time = time.perf_counter() - start
+            self.load_seconds += load_time
+            self.models[model_name] = (model, self.sizer(model))
+            self.models.move_to_end(model_name)
+            print(f"OCR: Loaded model {model_name} in {load_time:.2f}s")
+            self.evict(keep=model_name)
+            return model
+
+    def remove(self, model_name: str):
+        with self.lock:
+            self.models.pop(model_name, None)
+
+    def total_bytes(self) -> int:
+        return sum(size for _, size in self.models.values())
+
+    def is_over_budget(self) -> bool:
+        if self.max_models and len(self.models) > self.max_models:
+            return True
+        if self.max_bytes and self.total_bytes() > self.max_bytes:
+            return True
+        return False
+
+    def evict(self, keep: str | None = None):
+        with self.lock:
+            while self.is_over_budget():
+                model_name = next(iter(self.models))
+                if model_name == keep:
+                    break
+                self.models.pop(model_name)
+                self.evictions += 1
+                print(f"OCR: Evicted model {model_name}")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "pid": os.getpid(),
+                "loaded_models": list(self.models.keys()),
+                "loaded_bytes": self.total_bytes(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "load_seconds": round(self.load_seconds, 3),
+            }
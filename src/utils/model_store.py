@@ -0,0 +1,164 @@
+# Content addressed store of the OCR model weights, shared by every process and node
+#
+# Uploaded weights are stored once in the blob store, under their sha256 digest. Every node
+# keeps the weights it uses in 'ocr-models' (the node cache), fetched from the store on first
+# use and checked against their digest, where the inference workers load them from.
+
+import hashlib
+import os
+import threading
+
+from ..config import APP_SETTINGS
+
+
+def sha256_digest(contents: bytes) -> str:
+    return hashlib.sha256(contents).hexdigest()
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_atomically(path: str, contents: bytes):
+    """Write to a temporary file first, so no process ever reads a partially written file."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(contents)
+    os.replace(tmp_path, path)
+
+
+class BlobStore:
+    """Base class of the blob stores, blobs are immutable and named by the sha256 digest of their contents."""
+
+    def put(self, contents: bytes) -> str:
+        """Store contents, if they aren't stored yet, and return their digest."""
+        raise NotImplementedError
+
+    def get(self, digest: str) -> bytes:
+        """
+        Raises:
+            FileNotFoundError: if there is no blob with this digest
+        """
+        raise NotImplementedError
+
+    def delete(self, digest: str):
+        raise NotImplementedError
+
+
+class LocalBlobStore(BlobStore):
+    """Blobs in a directory, which nodes can share through a network file system."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def put(self, contents: bytes) -> str:
+        digest = sha256_digest(contents)
+        if not os.path.exists(self.path(digest)):
+            write_atomically(self.path(digest), contents)
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        with open(self.path(digest), 'rb') as f:
+            return f.read()
+
+    def delete(self, digest: str):
+        try:
+            os.remove(self.path(digest))
+        except OSError:
+            pass
+
+
+class GridFSBlobStore(BlobStore):
+    """Blobs in MongoDB GridFS, so every node that reaches the database gets the weights."""
+
+    def __init__(self, bucket_name: str = 'ocr_model_blobs'):
+        from gridfs import GridFSBucket
+        from ..database import Database
+
+        self.bucket = GridFSBucket(Database().db, bucket_name=bucket_name)
+
+    def put(self, contents: bytes) -> str:
+        digest = sha256_digest(contents)
+        if next(self.bucket.find({"filename": digest}).limit(1), None) is None:
+            self.bucket.upload_from_stream(digest, contents)
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        from gridfs.errors import NoFile
+
+        try:
+            return self.bucket.open_download_stream_by_name(digest).read()
+        except NoFile:
+            raise FileNotFoundError(f"No blob {digest} in GridFS")
+
+    def delete(self, digest: str):
+        for blob in self.bucket.find({"filename": digest}):
+            self.bucket.delete(blob._id)
+
+
+class ModelStore:
+    """
+    A singleton giving access to the blob store of the weights and to the node cache.
+
+    Usage:
+    from utils.model_store import ModelStore
+    digest = ModelStore().put(contents)
+    path = ModelStore().ensure(file_name, digest)
+
+    raises:
+        ValueError: if weights fetched from the store don't match their digest
+    """
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = super(ModelStore, cls).__new__(cls)
+            cls._instance.initialize_store()
+        return cls._instance
+
+    def initialize_store(self):
+        if APP_SETTINGS.OCR_MODEL_STORE == 'gridfs':
+            self.blobs = GridFSBlobStore()
+        else:
+            self.blobs = LocalBlobStore(APP_SETTINGS.OCR_MODEL_STORE_DIR)
+        self.directory = 'ocr-models'
+        # file name -> digest of the files of the node cache checked by this process
+        self.verified = dict()
+        self.lock = threading.Lock()
+
+    def put(self, contents: bytes) -> str:
+        return self.blobs.put(contents)
+
+    def delete(self, digest: str):
+        self.blobs.delete(digest)
+
+    def ensure(self, file_name: str, digest: str) -> str:
+        """
+        Make sure the node cache holds the weights of file_name, fetching them from the store if
+        they are missing or don't match their digest.
+
+        Returns:
+            str: the path of the weights in the node cache
+        """
+        path = os.path.join(self.directory, file_name)
+        if self.verified.get(file_name) == digest and os.path.exists(path):
+            return path
+        with self.lock:
+            if os.path.exists(path) and file_digest(path) == digest:
+                self.verified[file_name] = digest
+                return path
+            contents = self.blobs.get(digest)
+            if sha256_digest(contents) != digest:
+                raise ValueError(f"OCR: Weights of {file_name} in the model store don't match their digest")
+            write_atomically(path, contents)
+            self.verified[file_name] = digest
+            print(f"Fetched OCR model {file_name} from the model store")
+        return path
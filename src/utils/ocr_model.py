@@ -1,122 +1,822 @@
-import torch
+# torch and easyocr are heavy to import, so they are imported on first use.
+# This module is only imported by the inference worker processes, never by the API process.
 import cv2
 import numpy as np
-import easyocr
 
+import io
 import sys
 import os
-# model names are located in ocr-models folder
+from dataclasses import dataclass
+
+from ..config import APP_SETTINGS
+from .model_registry import ModelRegistry
+from .inference_backends import InferenceBackend, TorchBackend, OnnxBackend, export_onnx, quantize_onnx, detections_agreement
+from .roi_templates import roi_sample, align_to_template, template_boxes
+from .seven_segment import read_seven_segment
+from .stage_timings import timings
+# model files are located in ocr-models folder
 if not os.path.exists('ocr-models'):
     os.mkdir('ocr-models')
-model_names = os.listdir('ocr-models')
-print(model_names)
 
-models = dict()
-for model_name in model_names:
-    model = torch.hub.load('ultralytics/yolov5', 'custom', path=f'ocr-models/{model_name}', force_reload=False, trust_repo=True)
-    models[model_name] = model
 
+def get_yolov5_repo_dir() -> str | None:
+    """Local copy of the ultralytics/yolov5 repo, either configured or left in the torch hub cache by an earlier download."""
+    import torch
+
+    if APP_SETTINGS.OCR_YOLOV5_REPO_DIR:
+        return APP_SETTINGS.OCR_YOLOV5_REPO_DIR
+    cached_repo_dir = os.path.join(torch.hub.get_dir(), 'ultralytics_yolov5_master')
+    if os.path.isdir(cached_repo_dir):
+        return cached_repo_dir
+    return None
+
+def list_model_files() -> list[str]:
+    """Uploaded model weights, without the files derived from them (e.g. ONNX exports)."""
+    return [f for f in os.listdir('ocr-models') if not f.endswith('.onnx')]
+
+def load_torch_model(model_file_name: str):
+    import torch
+
+    repo_dir = get_yolov5_repo_dir()
+    if repo_dir is not None:
+        # loading from a local directory never touches the network
+        return torch.hub.load(repo_dir, 'custom', path=f'ocr-models/{model_file_name}', source='local')
+    if not APP_SETTINGS.OCR_ALLOW_DOWNLOADS:
+        raise ValueError("OCR: No local copy of the YOLOv5 repo found, set OCR_YOLOV5_REPO_DIR or enable OCR_ALLOW_DOWNLOADS")
+    return torch.hub.load('ultralytics/yolov5', 'custom', path=f'ocr-models/{model_file_name}', force_reload=False, trust_repo=True)
+
+def load_onnx_model(model_file_name: str) -> OnnxBackend:
+    """
+    Load the ONNX export of a model, exporting it first if there is no export yet, or
+    if the weights were uploaded again after the export. The export is cached next to the weights.
+    """
+    model_path = f'ocr-models/{model_file_name}'
+    onnx_path = f'{model_path}.onnx'
+    if not os.path.exists(onnx_path) or os.path.getmtime(onnx_path) < os.path.getmtime(model_path):
+        export_onnx(load_torch_model(model_file_name), onnx_path)
+    return OnnxBackend(onnx_path)
+
+def quantize_model(model_file_name: str, calibration_image_paths: list[str]) -> dict:
+    """
+    Quantize a model to INT8, calibrated on stored images of its counter, and measure how much
+    its detections on those images differ from the FP32 model.
+
+    Returns:
+        dict: the quantized model file name, and the accuracy delta (None if there were no images to measure it on)
+    """
+    fp32_model = load_onnx_model(model_file_name)
+    calibration_imgs = []
+    for image_path in calibration_image_paths:
+        img = decode_image(image_path)
+        if img is not None:
+            calibration_imgs.append(fit_image(img))
+
+    quantized_file_name = f'{model_file_name}.int8.onnx'
+    quantize_onnx(f'ocr-models/{model_file_name}.onnx', f'ocr-models/{quantized_file_name}', calibration_imgs)
+    models.remove(quantized_file_name)
+
+    accuracy_delta = None
+    if calibration_imgs:
+        int8_model = OnnxBackend(f'ocr-models/{quantized_file_name}')
+        agreements = [
+            detections_agreement(fp32_det, int8_det)
+            for fp32_det, int8_det in zip(fp32_model.predict(calibration_imgs), int8_model.predict(calibration_imgs))
+        ]
+        accuracy_delta = 1 - sum(agreements) / len(agreements)
+    print(f"OCR: Quantized {model_file_name} on {len(calibration_imgs)} images, accuracy delta: {accuracy_delta}")
+    return {"quantized_file_name": quantized_file_name, "accuracy_delta": accuracy_delta}
+
+def calibrate_model(
+        model_file_name: str,
+        samples: list[tuple[str, dict]],
+        recognizer_name: str,
+        sizes: list[int],
+        max_accuracy_drop: float,
+) -> dict:
+    """
+    Find the smallest input size of a model that reads the fields of stored images of its counter
+    about as well as the largest size. The images are read at every size, from the largest down,
+    until the share of fields whose digits match the accepted readings drops by more than
+    max_accuracy_drop.
+
+    Args:
+        samples (list[tuple[str, dict]]): the path of every image, and its readings (label -> digits)
 
+    Returns:
+        dict: the input size (None if it can't be calibrated), the field accuracy at every size tried,
+        and the number of images
+    """
+    model = models.get(model_file_name)
+    imgs, readings = [], []
+    for image_path, values in samples:
+        img = decode_image(image_path)
+        if img is not None:
+            imgs.append(fit_image(img))
+            readings.append(values)
+    fields = sum(value is not None for values in readings for value in values.values())
+    calibration = {"input_size": None, "accuracies": dict(), "images": len(imgs)}
+    # exports with a fixed input size can't run at another size
+    if fields == 0 or not getattr(model, "dynamic_size", True):
+        return calibration
 
-reader = easyocr.Reader(['en'])
+    reference = None
+    for size in sorted(set(sizes), reverse=True):
+        matched = 0
+        for img, values, detections in zip(imgs, readings, model_predict_batch(imgs, model_file_name, size=size)):
+            read = read_counters(img, detections, recognizer_name, input_size=size)["values"]
+            matched += sum(value is not None and read.get(label) == str(value) for label, value in values.items())
+        accuracy = matched / fields
+        calibration["accuracies"][str(size)] = accuracy
+        if reference is None:
+            reference = accuracy
+        elif accuracy < reference - max_accuracy_drop:
+            break
+        calibration["input_size"] = size
+    print(f"OCR: Calibrated {model_file_name} on {len(imgs)} images, input size {calibration['input_size']}, accuracies {calibration['accuracies']}")
+    # the calibration isn't part of any batch
+    timings.drain()
+    return calibration
 
-def add_model(model_file_name: str):
-    model = torch.hub.load('ultralytics/yolov5', 'custom', path=f'ocr-models/{model_file_name}', force_reload=False, trust_repo=True)
-    models[model_file_name] = model
+def load_model(model_file_name: str) -> InferenceBackend:
+    if not os.path.exists(f'ocr-models/{model_file_name}'):
+        raise ValueError(f"OCR: OCR model {model_file_name} not found")
+    if model_file_name.endswith('.onnx'):
+        # quantized variants only exist as ONNX
+        return OnnxBackend(f'ocr-models/{model_file_name}')
+    if APP_SETTINGS.OCR_INFERENCE_BACKEND == 'onnx':
+        try:
+            return load_onnx_model(model_file_name)
+        except Exception as e:
+            # e.g. onnxruntime isn't installed, or the export doesn't match torch
+            print(f"OCR: Could not use the ONNX backend for {model_file_name}, falling back to torch: {e}")
+    return TorchBackend(load_torch_model(model_file_name))
+
+# models are loaded on first use, and only the most recently used ones are kept in memory
+models = ModelRegistry(
+    loader=load_model,
+    sizer=lambda backend: backend.nbytes,
+    max_models=APP_SETTINGS.OCR_MODEL_CACHE_MAX_MODELS,
+    max_bytes=APP_SETTINGS.OCR_MODEL_CACHE_MAX_MB * 1024 * 1024,
+)
+
+reader = None
+
+def get_reader():
+    global reader
+    if reader is None:
+        import easyocr
+
+        # In recognizer only mode the YOLO crops are fed straight to the recognition network,
+        # so the CRAFT text detector weights are never loaded
+        reader = easyocr.Reader(
+            ['en'],
+            detector=not APP_SETTINGS.OCR_RECOGNIZER_ONLY,
+            model_storage_directory=APP_SETTINGS.OCR_EASYOCR_MODEL_DIR or None,
+            download_enabled=APP_SETTINGS.OCR_ALLOW_DOWNLOADS,
+        )
+    return reader
+
+def warm_up():
+    """Load the OCR reader and the most recently uploaded models, so the first uploads don't pay for it."""
+    get_reader()
+    model_files = sorted(list_model_files(), key=lambda f: os.path.getmtime(f'ocr-models/{f}'), reverse=True)
+    for model_file_name in model_files[:APP_SETTINGS.OCR_WARM_UP_MODELS]:
+        try:
+            models.get(model_file_name)
+        except Exception as e:
+            print(f"OCR: Could not warm up model {model_file_name}: {e}")
+
+def preload_model(model_file_name: str, smoke_image: str | None = None) -> int:
+    """
+    Load a new model version and check that it runs before it serves any request, on a recent
+    photo of its counter if there is one, otherwise on a blank image.
+
+    Returns:
+        int: the pid of the worker
+
+    Raises:
+        Exception: if the model can't be loaded or its smoke inference fails
+    """
+    model = models.get(model_file_name)
+    if len(model.names) == 0:
+        raise ValueError(f"OCR: Model {model_file_name} has no labels")
+    img = decode_image(smoke_image) if smoke_image is not None else None
+    if img is None:
+        img = np.full((800, 800, 3), 114, dtype=np.uint8)
+    detections = model_predict_batch([fit_image(img)], model_file_name)[0]
+    print(f"OCR: Smoke inference of {model_file_name} detected {detections.labels()}")
+    # the smoke inference isn't part of any batch
+    timings.drain()
+    return os.getpid()
+
+def release_model(model_file_name: str) -> int:
+    """Unload a model version that no longer serves requests, its files are kept."""
+    models.remove(model_file_name)
+    return os.getpid()
 
 def delete_model(model_file_name: str):
-    models.pop(model_file_name)
+    models.remove(model_file_name)
+    for path in [f'./ocr-models/{model_file_name}', f'./ocr-models/{model_file_name}.onnx', f'./ocr-models/{model_file_name}.int8.onnx']:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+
+
+
+# (reduction factor, imread flag) of the decode time downscaling of JPEG images, largest first
+REDUCED_DECODE_FLAGS = [
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+]
+
+def decode_flag(image: bytes | str) -> int:
+    """
+    The imread flag decoding a JPEG image at the smallest scale that still has OCR_IMAGE_MAX_SIDE
+    pixels on its longest side, the JPEG decoder then skips the detail that would be resized away.
+    """
+    if not APP_SETTINGS.OCR_REDUCED_DECODE:
+        return cv2.IMREAD_COLOR
+    from PIL import Image
+
     try:
-        os.remove(f'./ocr-models/{model_file_name}')
-    except OSError:
-        pass
+        # only the header is read
+        with Image.open(io.BytesIO(image) if isinstance(image, bytes) else image) as header:
+            if header.format != 'JPEG':
+                return cv2.IMREAD_COLOR
+            longest_side = max(header.size)
+    except Exception:
+        return cv2.IMREAD_COLOR
+    for factor, flag in REDUCED_DECODE_FLAGS:
+        if longest_side // factor >= APP_SETTINGS.OCR_IMAGE_MAX_SIDE:
+            return flag
+    return cv2.IMREAD_COLOR
 
+def decode_image(image: bytes | str | np.ndarray) -> np.ndarray | None:
+    """
+    Decode an image held in memory (the uploaded file contents), or read it from a path.
+    Large JPEG photos are decoded at a reduced resolution, see decode_flag.
 
+    Returns:
+        np.ndarray | None: the BGR image, or None if it can't be decoded
+    """
+    if isinstance(image, np.ndarray):
+        return image
+    if isinstance(image, str):
+        return cv2.imread(image, decode_flag(image))
+    return cv2.imdecode(np.frombuffer(image, dtype=np.uint8), decode_flag(image))
 
+def fit_image(img: np.ndarray) -> np.ndarray:
+    """
+    Downscale an image, keeping its aspect ratio, so its longest side is at most OCR_IMAGE_MAX_SIDE.
+    The detection backends letterbox it to their input size and return boxes relative to it.
+    """
+    height, width = img.shape[:2]
+    scale = APP_SETTINGS.OCR_IMAGE_MAX_SIDE / max(height, width)
+    if scale >= 1:
+        return img
+    return cv2.resize(img, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
 
 
-def get_digits_from_image(image_path, model_name):
-    img, labels, cord, model_names = model_predict(image_path, model_name)
-    print(f"get_digits_from_image: Detected labels: {labels}")
-    print(f"get_digits_from_image: Detected model_names: {model_names}")
-    img, bounding_boxes = get_bounding_boxes(img, labels, cord)
-    cropped_images = crop_image(img, bounding_boxes)
-    results = dict()
-    for model_name in model_names:
-        results[model_name] = None
-    for label, image in cropped_images.items():
-        result, preprocessed_image = ocr_predict(image)
-        if len(result) == 0:
+def get_digits_from_image(image: bytes | str | np.ndarray, model_name, options: dict | None = None):
+    result = get_digits_from_images([image], model_name, [options or dict()])[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def get_digits_from_images(images: list, model_name: str, options: list[dict] | None = None) -> list:
+    """
+    Read the counters of several images using a single forward pass of the detection model.
+    Each image is either the encoded file contents, a path, or an already decoded image.
+
+    Args:
+        options (list[dict] | None): per image options of the OCR model of its counter:
+            roi_template: crop the fields at the template boxes if the image lines up with it, instead of detecting them
+            learn_roi_template: return the detections of the image as "roi_sample", to learn a template from
+            recognizer: name of the recognizer reading the digits of the fields (default: easyocr)
+            cascade: cheap stages tried before the full detection, see cascade_stages
+            input_size: input size of the detection model found by calibrate_model (default: that of the model)
+
+    Returns:
+        list: for every image, either a dict with the digits ("values") and the detection and
+        OCR confidences ("confidences") of every label, or the exception raised while reading it
+    """
+    options = options or [dict() for _ in images]
+    decoded_images = []
+    for image in images:
+        with timings.stage("decode"):
+            img = decode_image(image)
+        if img is None:
+            decoded_images.append(ValueError("OCR: Could not decode the image"))
+            continue
+        with timings.stage("resize"):
+            decoded_images.append(fit_image(img))
+
+    all_results = [img if isinstance(img, Exception) else None for img in decoded_images]
+    # labels every image still has to read, None until a stage read it
+    pending = [None for _ in images]
+    for stage in CASCADE_STAGES:
+        to_read = [
+            i for i, results in enumerate(all_results)
+            if not isinstance(results, Exception) and stage in cascade_stages(options[i]) and pending[i] != set()
+        ]
+        if not to_read:
+            continue
+        stage_detections = detect_stage_fields(stage, [decoded_images[i] for i in to_read], [options[i] for i in to_read], model_name)
+        for i, detections in zip(to_read, stage_detections):
+            if detections is None:
+                continue
+            try:
+                if isinstance(detections, Exception):
+                    raise detections
+                cascade = options[i].get("cascade")
+                recognizer = options[i].get("recognizer", "easyocr")
+                if stage != "full" and cascade and cascade.get("recognizer"):
+                    recognizer = cascade["recognizer"]
+                results = read_counters(decoded_images[i], detections.select(pending[i]), recognizer, stage, options[i].get("input_size"))
+                all_results[i] = merge_results(all_results[i], results)
+                if stage == "full" or not cascade:
+                    # the full detection is the last stage, and without a cascade the ROI template is trusted as is
+                    pending[i] = set()
+                else:
+                    pending[i] = escalated_labels(all_results[i], cascade.get("min_confidence", APP_SETTINGS.OCR_CASCADE_MIN_CONFIDENCE))
+                    if pending[i]:
+                        print(f"OCR: Escalating {sorted(pending[i])} from the {stage} stage")
+                if stage == "full" and options[i].get("learn_roi_template"):
+                    boxes = dict(zip(detections.labels(), detections.boxes))
+                    all_results[i]["roi_sample"] = roi_sample(decoded_images[i], boxes, list(detections.names.values()))
+            except Exception as e:
+                # only this image fails, the other images of the batch are often other uploads
+                print(f"OCR: Reading an image failed in the {stage} stage: {e}")
+                all_results[i] = e
+    return all_results
+
+# cheaper stages first, "full" reads the fields found by the detection model on the whole image
+CASCADE_STAGES = ["roi_template", "downscaled", "full"]
+
+def cascade_stages(options: dict) -> list[str]:
+    """
+    Stages an image goes through. With a cascade, options["cascade"] is a dict of:
+        stages: cheap stages to try first, "roi_template" and/or "downscaled"
+        min_confidence: fields read with a lower detection or OCR confidence are escalated to the next stage
+        recognizer: recognizer of the cheap stages (default: that of the OCR model)
+    Without a cascade, images that line up with the ROI template skip the detection model.
+    """
+    cascade = options.get("cascade")
+    if cascade:
+        return [stage for stage in CASCADE_STAGES if stage in cascade.get("stages", [])] + ["full"]
+    return (["roi_template"] if options.get("roi_template") else []) + ["full"]
+
+def detect_stage_fields(stage: str, imgs: list, options: list[dict], model_name: str) -> list["Detections | Exception | None"]:
+    """
+    The detections of a stage for every image, as detect_fields. If the batch fails, the images
+    are detected one by one, so only the images that fail get their exception.
+    """
+    try:
+        return detect_fields(stage, imgs, options, model_name)
+    except Exception as e:
+        if len(imgs) == 1:
+            return [e]
+        print(f"OCR: Detecting a batch of {len(imgs)} images failed in the {stage} stage, detecting them one by one: {e}")
+    stage_detections = []
+    for img, image_options in zip(imgs, options):
+        try:
+            stage_detections += detect_fields(stage, [img], [image_options], model_name)
+        except Exception as e:
+            stage_detections.append(e)
+    return stage_detections
+
+def detect_fields(stage: str, imgs: list, options: list[dict], model_name: str) -> list["Detections | None"]:
+    """The detections of a stage for every image, None for the images the stage can't handle."""
+    if stage == "roi_template":
+        with timings.stage("roi_template"):
+            return [template_detections(img, image_options.get("roi_template")) for img, image_options in zip(imgs, options)]
+    if stage == "downscaled":
+        return model_predict_batch(imgs, model_name, size=APP_SETTINGS.OCR_CASCADE_DOWNSCALED_SIZE, stage="detect_downscaled")
+    predict = model_predict_tiled if APP_SETTINGS.OCR_TILED_DETECTION else model_predict_batch
+    # the images of a batch share their model, their input size only differs while it is being calibrated
+    sizes = [image_options.get("input_size") for image_options in options]
+    detections = [None for _ in imgs]
+    for size in set(sizes):
+        indexes = [i for i, image_size in enumerate(sizes) if image_size == size]
+        for i, image_detections in zip(indexes, predict([imgs[i] for i in indexes], model_name, size=size)):
+            detections[i] = image_detections
+    return detections
+
+def merge_results(previous: dict | None, results: dict) -> dict:
+    """Results of a stage, with the fields it couldn't read kept from the previous stages."""
+    if previous is None:
+        return results
+    for label, value in results["values"].items():
+        if value is not None or label not in previous["values"]:
+            previous["values"][label] = value
+            previous["confidences"][label] = results["confidences"][label]
+    return previous
+
+def escalated_labels(results: dict, min_confidence: float) -> set[str]:
+    """Labels that weren't read, were read with a low confidence, or fail the validation rules."""
+    labels = set(invalid_labels(results["values"]))
+    for label, confidence in results["confidences"].items():
+        if confidence is None or min(confidence["detection"], confidence["ocr"]) < min_confidence:
+            labels.add(label)
+    return labels
+
+# (smaller, larger): the value of the first label can't be greater than that of the second
+VALIDATION_RULES = [
+    ("Good Production", "Total Production"),
+]
+
+def invalid_labels(values: dict) -> list[str]:
+    """Labels whose values break a validation rule."""
+    labels = []
+    for smaller, larger in VALIDATION_RULES:
+        try:
+            if int(values[smaller]) > int(values[larger]):
+                labels += [smaller, larger]
+        except (KeyError, TypeError, ValueError):
+            continue
+    return labels
+
+def template_detections(img: np.ndarray, template: dict | None) -> "Detections | None":
+    """The fields of a ROI template as detections, or None if there is no template or the image doesn't line up with it."""
+    if not template:
+        return None
+    score, shift = align_to_template(img, template)
+    if score < APP_SETTINGS.OCR_ROI_MIN_ALIGNMENT_SCORE:
+        print(f"OCR: Image doesn't line up with the ROI template (score {score:.2f}), detecting the fields")
+        return None
+    names = dict(enumerate(template["names"]))
+    boxes = template_boxes(template, shift, img.shape)
+    print(f"OCR: Image lines up with the ROI template (score {score:.2f}, shift {shift}), skipping detection")
+    return Detections(
+        boxes=np.array(list(boxes.values()), dtype=np.int32).reshape(-1, 4),
+        # the alignment score stands in for the detection confidence
+        confidences=np.full(len(boxes), score, dtype=np.float32),
+        classes=np.array([template["names"].index(label) for label in boxes], dtype=np.int64),
+        names=names,
+    )
+
+def read_counters(
+        img: np.ndarray,
+        detections: "Detections",
+        recognizer_name: str = "easyocr",
+        stage: str = "full",
+        input_size: int | None = None,
+) -> dict:
+    print(f"get_digits_from_image: Detected labels: {detections.labels()}")
+    with timings.stage("crop"):
+        cropped_images = crop_image(img, detections)
+    detection_confidences = detections.confidences_by_label()
+    values = dict.fromkeys(detections.names.values())
+    confidences = dict.fromkeys(detections.names.values())
+    for label, prediction in get_recognizer(recognizer_name).recognize(cropped_images, input_size).items():
+        if prediction is None:
             print(f"OCR: No text detected in {label}")
             continue
-        results[label] = result[0]
-    print(f"OCR: Predicted results: {results}")
-    return results
+        values[label] = prediction["digits"]
+        confidences[label] = {
+            "detection": detection_confidences[label],
+            "ocr": prediction["confidence"],
+            "digits": prediction["digit_confidences"],
+            "engine": prediction["engine"],
+            "stage": stage,
+        }
+    print(f"OCR: Predicted results: {values}")
+    return {"values": values, "confidences": confidences}
+
+
+
+@dataclass
+class Detections:
+    """
+    Decoded detections of one image, at most one per label.
 
+    boxes: (n, 4) int array of x1, y1, x2, y2 pixel coordinates, clipped to the image
+    confidences: (n,) float array
+    classes: (n,) int array, indexes into names
+    names: class index -> label name
+    """
+    boxes: np.ndarray
+    confidences: np.ndarray
+    classes: np.ndarray
+    names: dict
 
+    def labels(self) -> list[str]:
+        return [self.names[int(c)] for c in self.classes]
 
-def model_predict(image_path, model_name: str):
-    model = get_model(model_name)
-    img = cv2.imread(image_path)
-    img = cv2.resize(img, (800, 800))
-    results = model([img])
-    print(f"OCR: Predicted {len(results.xyxyn[0])} objects")
-    print(f"OCR: Predicted labels: {results.names}")
+    def confidences_by_label(self) -> dict:
+        return {self.names[int(c)]: float(conf) for c, conf in zip(self.classes, self.confidences)}
+
+    def select(self, labels: set[str] | None) -> "Detections":
+        """The detections of the given labels only, all of them if labels is None."""
+        if labels is None:
+            return self
+        keep = np.array([label in labels for label in self.labels()], dtype=bool).reshape(-1)
+        return Detections(self.boxes[keep], self.confidences[keep], self.classes[keep], self.names)
+
+    def __len__(self) -> int:
+        return len(self.classes)
+
+
+def model_predict_batch(imgs: list, model_name: str, size: int | None = None, stage: str = "detect") -> list[Detections]:
+    """
+    Run the detection model once over a batch of images, already downscaled by fit_image.
+    With a size, the model runs on a downscaled copy, the boxes are still in image pixels.
+    The time it takes is recorded as the given stage.
+
+    Returns:
+        list[Detections]: the decoded detections of every image, in the same order as imgs
+    """
+    with timings.stage("load_model"):
+        model = get_model(model_name)
+    with timings.stage(stage):
+        predictions = model.predict(imgs, size=size)
+    print(f"OCR: Predicted a batch of {len(imgs)} images, {[len(det) for det in predictions]} objects")
     # {0: 'Bottle Discharge', 1: 'Perform infeed', 2: 'Total rejected containers'}
-    # i want to get 'Bottle Discharge', 'Perform infeed', 'Total rejected containers' and store them in a list
-    model_names = results.names.values()
-    results.print()
-    labels, cord = results.xyxyn[0][:, -1], results.xyxyn[0][:, :-1]
-    return img, labels, cord, model_names
+    print(f"OCR: Predicted labels: {model.names}")
+    with timings.stage("decode_detections"):
+        return [decode_detections(det, img.shape, model.names) for img, det in zip(imgs, predictions)]
 
-def get_model(model_name: str):
+def tile_origins(length: int, tile_size: int, step: int) -> list[int]:
+    """Offsets of the tiles along one side, the last tile ends at the edge of the image."""
+    if length <= tile_size:
+        return [0]
+    return list(range(0, length - tile_size, step)) + [length - tile_size]
 
-    if model_name not in models:
-        raise ValueError(f"OCR: OCR model {model_name} not found, available models: {model_names}")
-    print(f"OCR: Using model {model_name}")
-    return models[model_name]
+def image_tiles(img_shape: tuple, tile_size: int, overlap: float) -> list[tuple[int, int, int, int]]:
+    """x1, y1, x2, y2 of the overlapping tiles covering an image."""
+    height, width = img_shape[:2]
+    step = max(1, round(tile_size * (1 - overlap)))
+    return [
+        (x, y, min(x + tile_size, width), min(y + tile_size, height))
+        for y in tile_origins(height, tile_size, step)
+        for x in tile_origins(width, tile_size, step)
+    ]
 
+def merge_tile_detections(det: np.ndarray, min_overlap: float = 0.3) -> np.ndarray:
+    """
+    One detection per class: its most confident box, grown to cover the boxes of the same class
+    overlapping it, i.e. the parts of a display cut by the tile edges.
 
-    
+    Args:
+        det (np.ndarray): one row per detection: x1, y1, x2, y2 (normalized), confidence, class
+        min_overlap (float): minimum intersection of two boxes, over the area of the smaller one, to merge them
+    """
+    merged = []
+    for cls in np.unique(det[:, 5]):
+        boxes = det[det[:, 5] == cls]
+        boxes = boxes[np.argsort(-boxes[:, 4], kind='stable')]
+        best = boxes[0].copy()
+        for box in boxes[1:]:
+            intersection = (
+                max(0, min(best[2], box[2]) - max(best[0], box[0]))
+                * max(0, min(best[3], box[3]) - max(best[1], box[1]))
+            )
+            smaller = min((best[2] - best[0]) * (best[3] - best[1]), (box[2] - box[0]) * (box[3] - box[1]))
+            if smaller > 0 and intersection / smaller >= min_overlap:
+                best[:2] = np.minimum(best[:2], box[:2])
+                best[2:4] = np.maximum(best[2:4], box[2:4])
+        merged.append(best)
+    return np.array(merged, dtype=np.float32).reshape(-1, 6)
 
+def model_predict_tiled(imgs: list, model_name: str, size: int | None = None) -> list[Detections]:
+    """
+    Run the detection model on the whole images (at the given input size), and on overlapping
+    OCR_TILE_SIZE tiles of them at that input size, so displays that are small in a photo
+    aren't shrunk with it. The boxes of the tiles are mapped back to the image, and those of the
+    same label merged.
 
-def get_bounding_boxes(img, labels, cord):
+    Returns:
+        list[Detections]: the decoded detections of every image, in the same order as imgs
+    """
+    tile_size = APP_SETTINGS.OCR_TILE_SIZE
+    with timings.stage("load_model"):
+        model = get_model(model_name)
+    tiles = [image_tiles(img.shape, tile_size, APP_SETTINGS.OCR_TILE_OVERLAP) for img in imgs]
+    with timings.stage("detect"):
+        predictions = model.predict(imgs, size=size)
+    with timings.stage("detect_tiles"):
+        tile_predictions = iter(model.predict(
+            [img[y1:y2, x1:x2] for img, img_tiles in zip(imgs, tiles) for x1, y1, x2, y2 in img_tiles],
+            size=tile_size,
+        ))
+    print(f"OCR: Predicted a batch of {len(imgs)} images in {sum(map(len, tiles))} tiles")
 
-    x_shape, y_shape = img.shape[1], img.shape[0]
-    bounding_boxes = dict()
-    for i in range(len(labels)):
-        row = cord[i]
-        x1, y1, x2, y2 = int(row[0]*x_shape), int(row[1]*y_shape), int(row[2]*x_shape), int(row[3]*y_shape)
-        # bgr = (0, 255, 0)
-        # cv2.rectangle(img, (x1, y1), (x2, y2), bgr, 2)
-        # cv2.putText(img, model.names[int(labels[i])], (x1, y1), cv2.FONT_HERSHEY_SIMPLEX, 0.9, bgr, 2)
+    with timings.stage("decode_detections"):
+        results = []
+        for img, img_tiles, det in zip(imgs, tiles, predictions):
+            height, width = img.shape[:2]
+            rows = [np.asarray(det, dtype=np.float32).reshape(-1, 6)]
+            for x1, y1, x2, y2 in img_tiles:
+                tile_det = np.asarray(next(tile_predictions), dtype=np.float32).reshape(-1, 6).copy()
+                # normalized to the tile, then to the image
+                tile_det[:, [0, 2]] = (tile_det[:, [0, 2]] * (x2 - x1) + x1) / width
+                tile_det[:, [1, 3]] = (tile_det[:, [1, 3]] * (y2 - y1) + y1) / height
+                rows.append(tile_det)
+            results.append(decode_detections(merge_tile_detections(np.concatenate(rows)), img.shape, model.names))
+        return results
 
-        bounding_boxes[model.names[int(labels[i])]] = [x1, y1, x2, y2]
-    
-    return img, bounding_boxes
+def get_model(model_name: str) -> InferenceBackend:
 
-def crop_image(image, bounding_boxes):
+    print(f"OCR: Using model {model_name}")
+    return models.get(model_name)
+
+
+def decode_detections(det: np.ndarray, img_shape: tuple, names: dict, top_padding: float = 0.0125) -> Detections:
+    """
+    Turn the normalized detections of an image into pixel boxes, keeping only the most confident box of each label.
+
+    Args:
+        det (np.ndarray): one row per detection: x1, y1, x2, y2 (normalized), confidence, class
+        img_shape (tuple): shape of the image the detections were made on
+        top_padding (float): fraction of the image height added above every box, the digits often stick out
+            of the top of the detected box (10 pixels of the 800x800 images the models were first used on)
+
+    Returns:
+        Detections: the decoded detections
+    """
+    det = np.asarray(det, dtype=np.float32).reshape(-1, 6)
+    # most confident first, so np.unique picks the best box of every class
+    det = det[np.argsort(-det[:, 4], kind='stable')]
+    classes, best = np.unique(det[:, 5].astype(np.int64), return_index=True)
+    det = det[best]
+
+    height, width = img_shape[:2]
+    boxes = (det[:, :4] * np.array([width, height, width, height], dtype=np.float32)).astype(np.int32)
+    boxes[:, 1] -= round(top_padding * height)
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, width)
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, height)
+    return Detections(boxes=boxes, confidences=det[:, 4], classes=classes, names=names)
+
+def crop_image(image, detections: Detections) -> dict:
     cropped_images = dict()
-    for label, cord in bounding_boxes.items():
-        x1, y1, x2, y2 = cord
-        crop_img = image[y1-10:y2, x1:x2]
-        # cv2.imshow(label, crop_img)
-        # cv2.waitKey(0)
-        # cv2.destroyAllWindows()
-        cropped_images[label] = crop_img
+    for label, (x1, y1, x2, y2) in zip(detections.labels(), detections.boxes):
+        if x2 <= x1 or y2 <= y1:
+            continue
+        cropped_images[label] = image[y1:y2, x1:x2]
 
     return cropped_images
 
-def ocr_predict(img):
-   
-   preprocessed_image = preprocess_image(img)
-   result = reader.readtext(preprocessed_image, detail=0, allowlist='0123456789')
-   return result, preprocessed_image
+class Recognizer:
+    """
+    Reads the digits of the cropped fields of an image.
+
+    recognize returns, for every label, None if no digits were found, or a dict with the
+    digits, their confidence, the confidence of every digit (None if the engine doesn't
+    report it) and the name of the engine that read them. input_size is the calibrated input
+    size of the detection model, engines that resize the crops scale them with it.
+    """
+    name = ""
+
+    def recognize(self, cropped_images: dict, input_size: int | None = None) -> dict:
+        raise NotImplementedError
+
+    def prediction(self, digits: str, confidence: float, digit_confidences: list[float] | None = None) -> dict:
+        return {"digits": digits, "confidence": confidence, "digit_confidences": digit_confidences, "engine": self.name}
+
+
+class EasyOcrRecognizer(Recognizer):
+    """The general purpose EasyOCR reader, restricted to digits."""
+    name = "easyocr"
+
+    def recognize(self, cropped_images: dict, input_size: int | None = None) -> dict:
+        results = dict()
+        for label, prediction in ocr_predict_batch(cropped_images, input_size).items():
+            results[label] = None if prediction is None else self.prediction(*prediction)
+        return results
+
+
+class SevenSegmentRecognizer(Recognizer):
+    """
+    Decodes seven segment displays by checking which segments are lit, see utils/seven_segment.py.
+    Fields read with a confidence below min_confidence are read again by the fallback recognizer.
+    """
+    name = "seven_segment"
+
+    def __init__(self, fallback: Recognizer | None, min_confidence: float):
+        self.fallback = fallback
+        self.min_confidence = min_confidence
+
+    def recognize(self, cropped_images: dict, input_size: int | None = None) -> dict:
+        results = dict()
+        with timings.stage("seven_segment"):
+            for label, img in cropped_images.items():
+                prediction = read_seven_segment(img)
+                results[label] = None if prediction is None else self.prediction(*prediction)
+
+        unsure = {
+            label: cropped_images[label] for label, prediction in results.items()
+            if prediction is None or prediction["confidence"] < self.min_confidence
+        }
+        if unsure and self.fallback is not None:
+            print(f"OCR: Seven segment decoding unsure about {list(unsure.keys())}, falling back to {self.fallback.name}")
+            results.update(self.fallback.recognize(unsure, input_size))
+        return results
+
+
+recognizers = dict()
+
+def get_recognizer(name: str) -> Recognizer:
+    if name not in recognizers:
+        if name == "easyocr":
+            recognizers[name] = EasyOcrRecognizer()
+        elif name == "seven_segment":
+            recognizers[name] = SevenSegmentRecognizer(
+                fallback=get_recognizer("easyocr"),
+                min_confidence=APP_SETTINGS.OCR_SEVEN_SEGMENT_MIN_CONFIDENCE,
+            )
+        else:
+            raise ValueError(f"OCR: Unknown recognizer {name}")
+    return recognizers[name]
+
+def ocr_predict_batch(cropped_images: dict, input_size: int | None = None) -> dict:
+    """
+    Recognize the digits of all the cropped regions of an image with a single EasyOCR call.
+
+    Args:
+        cropped_images (dict): label -> cropped region of the image
+        input_size (int | None): calibrated input size of the detection model, see preprocess_size
+
+    Returns:
+        dict: label -> (digits, confidence), or None if no text was detected in the region
+    """
+    if len(cropped_images) == 0:
+        return dict()
+    labels = list(cropped_images.keys())
+    width, height = preprocess_size(input_size)
+    with timings.stage("preprocess"):
+        preprocessed_images = [preprocess_image(cropped_images[label], (width, height)) for label in labels]
+    if APP_SETTINGS.OCR_RECOGNIZER_ONLY:
+        with timings.stage("easyocr"):
+            return recognize_batch(labels, preprocessed_images)
+    # every preprocessed image has the same size, so they can be stacked into one batch
+    with timings.stage("easyocr"):
+        batch_results = get_reader().readtext_batched(
+            preprocessed_images,
+            n_width=width,
+            n_height=height,
+            allowlist='0123456789',
+            batch_size=len(preprocessed_images),
+        )
+    results = dict()
+    for label, result in zip(labels, batch_results):
+        if len(result) == 0:
+            results[label] = None
+            continue
+        # keep the first detected text
+        _, digits, confidence = result[0]
+        results[label] = (digits, float(confidence))
+    return results
+
+def recognize_batch(labels: list[str], preprocessed_images: list) -> dict:
+    """
+    Run only the EasyOCR recognition network on the preprocessed regions, skipping text detection.
+    The regions are stacked vertically into one image and each of them is used as a text box.
+
+    Returns:
+        dict: label -> (digits, confidence), or None if no text was recognized in the region
+    """
+    # the preprocessed images all have the same size
+    height, width = preprocessed_images[0].shape[:2]
+    stacked_image = np.vstack(preprocessed_images)
+    horizontal_list = [[0, width, i * height, (i + 1) * height] for i in range(len(preprocessed_images))]
+    batch_results = get_reader().recognize(
+        stacked_image,
+        horizontal_list=horizontal_list,
+        free_list=[],
+        allowlist='0123456789',
+        batch_size=len(preprocessed_images),
+        detail=1,
+    )
+    results = dict.fromkeys(labels)
+    for box, digits, confidence in batch_results:
+        # the top edge of the text box tells which region it was read from
+        label = labels[int(box[0][1]) // height]
+        if digits and results[label] is None:
+            results[label] = (digits, float(confidence))
+    return results
+
+# width and height of the crops fed to EasyOCR, at the default input size of the detection model
+PREPROCESS_SIZE = (400, 200)
+DEFAULT_INPUT_SIZE = 640
+# height of the input of the EasyOCR recognition network, smaller crops would be upscaled back to it
+MIN_PREPROCESS_HEIGHT = 64
+
+def preprocess_size(input_size: int | None) -> tuple[int, int]:
+    """The size of the crops fed to EasyOCR, scaled with the calibrated input size of the detection model."""
+    if input_size is None:
+        return PREPROCESS_SIZE
+    height = max(MIN_PREPROCESS_HEIGHT, round(PREPROCESS_SIZE[1] * input_size / DEFAULT_INPUT_SIZE))
+    return round(height * PREPROCESS_SIZE[0] / PREPROCESS_SIZE[1]), height
 
-def preprocess_image(img):
+def preprocess_image(img, size: tuple[int, int] = PREPROCESS_SIZE):
     gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
     black_hat = cv2.morphologyEx(gray, cv2.MORPH_BLACKHAT, cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3)))
     dilated = cv2.dilate(black_hat, (1, 1), iterations=1)
-    resized = cv2.resize(dilated, (400, 200))
+    resized = cv2.resize(dilated, size)
 
     return resized
\ No newline at end of file
@@ -0,0 +1,115 @@
+# Cache of OCR results, so re-submitted photos don't go through inference again
+
+import hashlib
+import threading
+from datetime import datetime
+
+from cachetools import LRUCache
+
+from ..config import APP_SETTINGS
+from ..database import Database
+from .metrics import OCR_RESULT_CACHE_LOOKUPS
+
+
+def content_hash(contents: bytes) -> str:
+    return hashlib.sha256(contents).hexdigest()
+
+
+class ResultCache:
+    """
+    A singleton cache of OCR results keyed by the content of the uploaded image and the OCR model
+    (id and version) that read it. Entries live in a bounded in-process LRU cache, and optionally
+    in a MongoDB collection whose entries expire after OCR_RESULT_CACHE_TTL_SECONDS.
+
+    Only identical files get a cached result. Photos of a fixed counter look the same whatever
+    digits they show, so similar looking photos can't share a result.
+
+    Usage:
+    from utils.result_cache import ResultCache
+    results = ResultCache().get(contents, model_key)
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __new__(cls, *args, **kwargs):
+        # the cache is used from the threadpool, so two threads may create it at once
+        with cls._instance_lock:
+            if cls._instance is None:
+                instance = super(ResultCache, cls).__new__(cls)
+                instance.initialize_cache()
+                cls._instance = instance
+        return cls._instance
+
+    def initialize_cache(self):
+        self.cache = LRUCache(maxsize=APP_SETTINGS.OCR_RESULT_CACHE_SIZE)
+        self.collection = Database().get_collection('ocr_result_cache') if APP_SETTINGS.OCR_RESULT_CACHE_MONGO else None
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        # cachetools caches aren't thread safe, the database calls are made without it
+        self.lock = threading.Lock()
+
+    def lookup(self, digest: str, model_key: str) -> dict | None:
+        with self.lock:
+            entry = self.cache.get((digest, model_key))
+        if entry is not None:
+            return entry
+        if self.collection is not None:
+            entry = self.collection.find_one({"content_hash": digest, "model_key": model_key})
+            if entry is not None:
+                with self.lock:
+                    self.cache[(digest, model_key)] = entry
+                return entry
+        return None
+
+    def get(self, contents: bytes, model_key: str) -> dict | None:
+        """
+        Get the cached OCR results of an image read by a model.
+
+        Args:
+            contents (bytes): the uploaded image
+            model_key (str): identifies the OCR model and its version
+
+        Returns:
+            dict | None: the cached results, or None if the image wasn't read by this model before
+        """
+        entry = self.lookup(content_hash(contents), model_key)
+        if entry is None:
+            with self.lock:
+                self.misses += 1
+            OCR_RESULT_CACHE_LOOKUPS.labels("miss").inc()
+            return None
+        with self.lock:
+            self.hits += 1
+            self.saved_seconds += entry["inference_seconds"]
+        OCR_RESULT_CACHE_LOOKUPS.labels("hit").inc()
+        return entry["results"]
+
+    def set(self, contents: bytes, model_key: str, results: dict, inference_seconds: float):
+        digest = content_hash(contents)
+        entry = {
+            "content_hash": digest,
+            "model_key": model_key,
+            "results": results,
+            "inference_seconds": inference_seconds,
+            "created_at": datetime.now(),
+        }
+        with self.lock:
+            self.cache[(digest, model_key)] = entry
+        if self.collection is not None:
+            self.collection.update_one(
+                {"content_hash": digest, "model_key": model_key},
+                {"$set": entry},
+                upsert=True,
+            )
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "saved_inference_seconds": round(self.saved_seconds, 3),
+            }
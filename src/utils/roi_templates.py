@@ -0,0 +1,111 @@
+# Region of interest templates for counters photographed by a fixed camera
+#
+# When the counter fields are detected at the same place in every photo of a counter, their
+# boxes are learned as a template. Photos that line up with the template are cropped directly,
+# without running the detection model.
+
+import numpy as np
+
+# size of the grayscale thumbnails used to check the alignment of a photo with a template
+THUMBNAIL_SIZE = 64
+# the template is matched with this margin cut off, so photos shifted by up to that many thumbnail pixels still match
+ALIGNMENT_MARGIN = 4
+# the boxes of the samples and templates are in pixels of the photo resized to this square,
+# whatever its resolution and aspect ratio
+TEMPLATE_SIZE = 800
+
+
+def thumbnail(img: np.ndarray) -> np.ndarray:
+    import cv2
+
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (THUMBNAIL_SIZE, THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA)
+
+
+def roi_sample(img: np.ndarray, boxes: dict, names: list[str]) -> dict:
+    """A photo's detections, in the form the templates are learned from."""
+    height, width = img.shape[:2]
+    scale = np.array([TEMPLATE_SIZE / width, TEMPLATE_SIZE / height] * 2)
+    return {
+        "thumbnail": thumbnail(img).flatten().tolist(),
+        "boxes": {label: [int(v) for v in np.rint(np.asarray(box) * scale)] for label, box in boxes.items()},
+        "names": names,
+    }
+
+
+def box_iou(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """IoU of every box in a with the box b."""
+    x1, y1 = np.maximum(a[:, 0], b[0]), np.maximum(a[:, 1], b[1])
+    x2, y2 = np.minimum(a[:, 2], b[2]), np.minimum(a[:, 3], b[3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    union = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-9), 0)
+
+
+def learn_roi_template(samples: list[dict], min_iou: float) -> dict | None:
+    """
+    Learn a template from the detections of recent photos of a counter.
+
+    Returns:
+        dict | None: the template, or None if the same labels weren't detected in every photo,
+        or their boxes moved more than min_iou allows
+    """
+    if len(samples) == 0:
+        return None
+    labels = set(samples[0]["boxes"].keys())
+    if len(labels) == 0 or any(set(sample["boxes"].keys()) != labels for sample in samples):
+        return None
+
+    boxes = dict()
+    for label in labels:
+        label_boxes = np.array([sample["boxes"][label] for sample in samples], dtype=np.float32)
+        median_box = np.median(label_boxes, axis=0)
+        if box_iou(label_boxes, median_box).min() < min_iou:
+            return None
+        boxes[label] = [int(v) for v in np.rint(median_box)]
+
+    thumbnails = np.array([sample["thumbnail"] for sample in samples], dtype=np.float32)
+    return {
+        "boxes": boxes,
+        "names": samples[-1]["names"],
+        "reference": np.rint(np.median(thumbnails, axis=0)).astype(np.uint8).tolist(),
+    }
+
+
+def align_to_template(img: np.ndarray, template: dict) -> tuple[float, tuple[int, int]]:
+    """
+    Check how well a photo lines up with a template, using normalized cross correlation of
+    grayscale thumbnails, which allows for a small shift of the camera.
+
+    Returns:
+        tuple: the match score (1 is a perfect match), and the (x, y) shift of the photo in pixels
+    """
+    import cv2
+
+    reference = np.array(template["reference"], dtype=np.uint8).reshape(THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+    patch = reference[ALIGNMENT_MARGIN:-ALIGNMENT_MARGIN, ALIGNMENT_MARGIN:-ALIGNMENT_MARGIN]
+    scores = cv2.matchTemplate(thumbnail(img), patch, cv2.TM_CCOEFF_NORMED)
+    _, score, _, (x, y) = cv2.minMaxLoc(scores)
+    height, width = img.shape[:2]
+    shift = (
+        round((x - ALIGNMENT_MARGIN) * width / THUMBNAIL_SIZE),
+        round((y - ALIGNMENT_MARGIN) * height / THUMBNAIL_SIZE),
+    )
+    return float(score), shift
+
+
+def template_boxes(template: dict, shift: tuple[int, int], img_shape: tuple) -> dict:
+    """The template boxes scaled to the photo, moved by its shift and clipped to it."""
+    height, width = img_shape[:2]
+    scale_x, scale_y = width / TEMPLATE_SIZE, height / TEMPLATE_SIZE
+    boxes = dict()
+    for label, box in template["boxes"].items():
+        x1, x2 = round(box[0] * scale_x), round(box[2] * scale_x)
+        y1, y2 = round(box[1] * scale_y), round(box[3] * scale_y)
+        boxes[label] = [
+            min(max(x1 + shift[0], 0), width),
+            min(max(y1 + shift[1], 0), height),
+            min(max(x2 + shift[0], 0), width),
+            min(max(y2 + shift[1], 0), height),
+        ]
+    return boxes
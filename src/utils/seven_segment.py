@@ -0,0 +1,142 @@
+# Classical seven segment display decoding
+#
+# Reads the digits of seven segment and fixed font LCD/LED counter displays by checking which of the
+# seven segments of every digit are lit. It needs no model and runs in about a millisecond per field.
+#
+#    aaa
+#   f   b
+#    ggg
+#   e   c
+#    ddd
+
+import cv2
+import numpy as np
+
+SEGMENTS = "abcdefg"
+
+# lit segments -> digit
+DIGITS = {
+    "abcdef": "0",
+    "bc": "1",
+    "abdeg": "2",
+    "abcdg": "3",
+    "bcfg": "4",
+    "acdfg": "5",
+    "acdefg": "6",
+    "abc": "7",
+    "abcf": "7",
+    "abcdefg": "8",
+    "abcdfg": "9",
+    "abcfg": "9",
+}
+
+# (top, bottom, left, right) of every segment, as fractions of the digit box
+SEGMENT_REGIONS = {
+    "a": (0.0, 0.15, 0.25, 0.75),
+    "b": (0.15, 0.45, 0.7, 1.0),
+    "c": (0.55, 0.85, 0.7, 1.0),
+    "d": (0.85, 1.0, 0.25, 0.75),
+    "e": (0.55, 0.85, 0.0, 0.3),
+    "f": (0.15, 0.45, 0.0, 0.3),
+    "g": (0.43, 0.57, 0.25, 0.75),
+}
+
+# a segment is lit when this fraction of its region is lit
+LIT_THRESHOLD = 0.4
+# digits narrower than this fraction of their height, or than this fraction of the widest digit
+# of the field, may be a "1", which only lights the right segments. The crop of a 1 is its stroke,
+# lit across its whole width, while a 7 or a 3 on a narrow display leaves its left segments dark.
+ONE_MAX_ASPECT = 0.35
+ONE_MAX_RELATIVE_WIDTH = 0.5
+HEIGHT = 64
+
+
+def binarize(img: np.ndarray) -> np.ndarray:
+    """Lit pixels of a display crop as 1, whether the display has dark digits on a light background or the opposite."""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    gray = cv2.resize(gray, (max(1, round(gray.shape[1] * HEIGHT / gray.shape[0])), HEIGHT))
+    _, binary = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    # the segments cover less of the display than the background
+    if binary.mean() > 0.5:
+        binary = 1 - binary
+    # join the small gaps between the segments of a digit
+    return cv2.morphologyEx(binary, cv2.MORPH_CLOSE, np.ones((3, 3), np.uint8))
+
+
+def digit_boxes(binary: np.ndarray) -> list[tuple[int, int, int, int]]:
+    """(top, bottom, left, right) of every digit, from left to right."""
+    rows = np.flatnonzero(binary.any(axis=1))
+    if len(rows) == 0:
+        return []
+    top, bottom = rows[0], rows[-1] + 1
+    height = bottom - top
+    lit_columns = binary[top:bottom].any(axis=0)
+
+    boxes = []
+    # runs of lit columns, separated by empty columns
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], lit_columns.astype(np.int8), [0]])))
+    for left, right in zip(edges[::2], edges[1::2]):
+        column_rows = np.flatnonzero(binary[top:bottom, left:right].any(axis=1))
+        # decimal points, dashes and noise are much shorter than the digits
+        if column_rows[-1] - column_rows[0] + 1 < 0.6 * height:
+            continue
+        boxes.append((top, bottom, left, right))
+    return boxes
+
+
+def decode_digit(digit: np.ndarray, widest: int) -> tuple[str | None, float]:
+    """
+    Decode the binarized crop of a single digit, widest being the width of the widest digit of its field.
+
+    Returns:
+        tuple: the digit (None if the lit segments don't form a digit), and a confidence between 0 and 1
+        telling how clearly every segment is either lit or unlit
+    """
+    height, width = digit.shape
+    fills = dict()
+    for segment, (top, bottom, left, right) in SEGMENT_REGIONS.items():
+        region = digit[int(top * height):max(int(bottom * height), int(top * height) + 1), int(left * width):max(int(right * width), int(left * width) + 1)]
+        fills[segment] = float(region.mean())
+
+    narrow = width < ONE_MAX_ASPECT * height or width < ONE_MAX_RELATIVE_WIDTH * widest
+    if narrow and fills["e"] > LIT_THRESHOLD and fills["f"] > LIT_THRESHOLD:
+        fill = digit.mean()
+        return "1", float(min(1.0, fill / LIT_THRESHOLD))
+
+    lit = ""
+    margins = []
+    for segment, fill in fills.items():
+        if fill > LIT_THRESHOLD:
+            lit += segment
+            margins.append((fill - LIT_THRESHOLD) / (1 - LIT_THRESHOLD))
+        else:
+            margins.append((LIT_THRESHOLD - fill) / LIT_THRESHOLD)
+    if lit not in DIGITS:
+        return None, 0.0
+    return DIGITS[lit], float(min(margins))
+
+
+def read_seven_segment(img: np.ndarray) -> tuple[str, float, list[float]] | None:
+    """
+    Read the digits of a cropped display.
+
+    Returns:
+        tuple | None: the digits, the field confidence (that of the least confident digit) and the
+        confidence of every digit, or None if no digit was found
+    """
+    if img.size == 0:
+        return None
+    binary = binarize(img)
+    digits = ""
+    digit_confidences = []
+    boxes = digit_boxes(binary)
+    widest = max((right - left for _, _, left, right in boxes), default=0)
+    for top, bottom, left, right in boxes:
+        digit, confidence = decode_digit(binary[top:bottom, left:right], widest)
+        digits += digit if digit is not None else "?"
+        digit_confidences.append(confidence)
+    if len(digits) == 0:
+        return None
+    if "?" in digits:
+        return digits, 0.0, digit_confidences
+    return digits, min(digit_confidences), digit_confidences
@@ -0,0 +1,89 @@
+# Models loaded once and shared by the inference workers
+#
+# With OCR_SHARED_MODELS, the inference workers are forked from a forkserver process that
+# loaded the EasyOCR reader (and, with the torch backend, the most recent detection models)
+# before forking. The workers inherit the weights copy-on-write, so their pages stay shared
+# as long as nobody writes to them: the weights are frozen, and the objects loaded so far are
+# moved out of the reach of the garbage collector, which would otherwise write to them.
+
+import gc
+import os
+
+from ..config import APP_SETTINGS
+
+# torch threads of the workers, the forkserver itself runs single threaded
+worker_num_threads = None
+
+
+def freeze_module(module):
+    """Put a torch module in inference mode for good, so its weights are never written to."""
+    module.eval()
+    for parameter in module.parameters():
+        parameter.requires_grad_(False)
+
+
+def preload():
+    """Load the shared models in the forkserver, see forkserver_preload.py."""
+    global worker_num_threads
+    try:
+        import torch
+
+        # forking is only safe if the OpenMP thread pool was never started in the parent
+        worker_num_threads = torch.get_num_threads()
+        torch.set_num_threads(1)
+
+        from . import ocr_model
+
+        reader = ocr_model.get_reader()
+        for module in [getattr(reader, 'detector', None), getattr(reader, 'recognizer', None)]:
+            if isinstance(module, torch.nn.Module):
+                freeze_module(module)
+
+        # ONNX Runtime sessions can't be forked, with the onnx backend every worker loads its own
+        if APP_SETTINGS.OCR_INFERENCE_BACKEND == 'torch':
+            model_files = sorted(ocr_model.list_model_files(), key=lambda f: os.path.getmtime(f'ocr-models/{f}'), reverse=True)
+            for model_file_name in model_files[:APP_SETTINGS.OCR_WARM_UP_MODELS]:
+                try:
+                    freeze_module(ocr_model.models.get(model_file_name).model)
+                except Exception as e:
+                    print(f"OCR: Could not preload model {model_file_name}: {e}")
+    except Exception as e:
+        # an exception would kill the forkserver, the workers then load the models themselves
+        print(f"OCR: Could not preload the shared models: {e}")
+    gc.collect()
+    gc.freeze()
+    print(f"OCR: Preloaded the shared models in process {os.getpid()}")
+
+
+def init_forked_worker():
+    """Undo the single threaded setup of the forkserver in a freshly forked worker."""
+    if worker_num_threads is not None:
+        import torch
+
+        torch.set_num_threads(worker_num_threads)
+
+
+def process_memory() -> dict:
+    """
+    Memory of the current process, from /proc/self/smaps_rollup (Linux only):
+        rss_bytes: resident memory
+        pss_bytes: resident memory with every shared page divided among the processes sharing it
+        shared_bytes: resident memory shared with other processes, e.g. the weights inherited from the forkserver
+        unique_bytes: resident memory only this process uses
+    """
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            lines = f.readlines()
+    except OSError:
+        return dict()
+    kilobytes = dict()
+    for line in lines:
+        parts = line.split()
+        if len(parts) == 3 and parts[2] == 'kB':
+            kilobytes[parts[0].rstrip(':')] = int(parts[1])
+    return {
+        "rss_bytes": kilobytes.get('Rss', 0) * 1024,
+        "pss_bytes": kilobytes.get('Pss', 0) * 1024,
+        "shared_bytes": (kilobytes.get('Shared_Clean', 0) + kilobytes.get('Shared_Dirty', 0)) * 1024,
+        "unique_bytes": (kilobytes.get('Private_Clean', 0) + kilobytes.get('Private_Dirty', 0)) * 1024,
+    }
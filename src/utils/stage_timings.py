@@ -0,0 +1,35 @@
+# Timings of the stages of the OCR path, recorded in the inference workers
+#
+# The workers can't update the metrics of the API process, so every batch sends its
+# timings back with its results and the API process adds them to the metrics.
+
+import time
+from contextlib import contextmanager
+
+
+class StageTimings:
+    """
+    Usage:
+    with timings.stage("detect"):
+        ...
+    records = timings.drain()  # [(stage, seconds), ...]
+    """
+
+    def __init__(self):
+        self.records = []
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.records.append((name, time.perf_counter() - start))
+
+    def drain(self) -> list[tuple[str, float]]:
+        """The timings recorded since the last drain."""
+        records, self.records = self.records, []
+        return records
+
+
+timings = StageTimings()
@@ -0,0 +1,13 @@
+import os
+
+# the settings without a default, so that the app modules can be imported without a .env file
+for name, value in {
+    "SECRET_KEY": "test-secret-key",
+    "ADMIN_PASSWORD": "test-admin-password",
+    "CLOUDINARY_CLOUD_NAME": "test",
+    "CLOUDINARY_API_KEY": "test",
+    "CLOUDINARY_API_SECRET": "test",
+    "GSHEET_CLIENT_SECRET_FILE_PATH": "client_secret.json",
+    "GSHEET_TOKEN_FILE_PATH": "token.json",
+}.items():
+    os.environ.setdefault(name, value)
@@ -0,0 +1,28 @@
+import threading
+
+from src.data_gathering.utils import read_data_file, save_data_file
+
+
+def test_concurrent_saves_of_the_same_photo(tmp_path):
+    # re-submitted photos are saved under the same content hash, by overlapping background tasks
+    file_path = str(tmp_path / "data" / "photo.jpg")
+    contents = b"\xff\xd8" + bytes(range(256)) * 4096
+    errors = []
+    start = threading.Barrier(8)
+
+    def save():
+        start.wait()
+        try:
+            for _ in range(20):
+                save_data_file(file_path, contents)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=save) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert read_data_file(file_path) == contents
+    assert [path.name for path in (tmp_path / "data").iterdir()] == ["photo.jpg"]
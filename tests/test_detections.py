@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from src.utils.ocr_model import crop_image, decode_detections
+
+NAMES = {0: "Total Production", 1: "Good Production", 2: "Rejection"}
+
+
+def test_keeps_the_most_confident_box_of_every_label():
+    det = np.array([
+        [0.10, 0.50, 0.30, 0.60, 0.4, 0],
+        [0.12, 0.52, 0.32, 0.62, 0.9, 0],
+        [0.50, 0.50, 0.70, 0.60, 0.8, 1],
+        [0.11, 0.51, 0.31, 0.61, 0.6, 0],
+    ], dtype=np.float32)
+    detections = decode_detections(det, (800, 1000, 3), NAMES, top_padding=0)
+    assert len(detections) == 2
+    assert detections.labels() == ["Total Production", "Good Production"]
+    assert detections.confidences_by_label() == pytest.approx({"Total Production": 0.9, "Good Production": 0.8})
+    assert detections.boxes.tolist() == [[120, 416, 320, 496], [500, 400, 700, 480]]
+
+
+def test_pads_the_top_by_a_fraction_of_the_image_height():
+    det = np.array([[0.10, 0.50, 0.30, 0.60, 0.9, 0]], dtype=np.float32)
+    detections = decode_detections(det, (800, 1000, 3), NAMES, top_padding=0.0125)
+    assert detections.boxes.tolist() == [[100, 390, 300, 480]]
+    # the same fraction on a smaller image
+    detections = decode_detections(det, (400, 500, 3), NAMES, top_padding=0.0125)
+    assert detections.boxes.tolist() == [[50, 195, 150, 240]]
+
+
+def test_clips_the_boxes_to_the_image():
+    det = np.array([
+        # at the top edge, padded above the image
+        [0.20, 0.002, 0.40, 0.10, 0.9, 0],
+        # past the right and bottom edges
+        [0.90, 0.90, 1.05, 1.02, 0.8, 2],
+    ], dtype=np.float32)
+    detections = decode_detections(det, (800, 1000, 3), NAMES)
+    assert detections.boxes.tolist() == [[200, 0, 400, 80], [900, 710, 1000, 800]]
+
+
+def test_no_detections():
+    for det in [np.zeros((0, 6), np.float32), []]:
+        detections = decode_detections(det, (800, 1000, 3), NAMES)
+        assert len(detections) == 0
+        assert detections.boxes.shape == (0, 4)
+        assert detections.labels() == []
+
+
+def test_select_and_crop_the_detected_fields():
+    det = np.array([
+        [0.10, 0.50, 0.30, 0.60, 0.9, 0],
+        [0.50, 0.50, 0.70, 0.60, 0.8, 1],
+    ], dtype=np.float32)
+    image = np.zeros((800, 1000, 3), np.uint8)
+    detections = decode_detections(det, image.shape, NAMES, top_padding=0)
+    selected = detections.select({"Good Production"})
+    assert selected.labels() == ["Good Production"]
+    assert detections.select(None) is detections
+    crops = crop_image(image, selected)
+    assert list(crops) == ["Good Production"]
+    assert crops["Good Production"].shape == (80, 200, 3)
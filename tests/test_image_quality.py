@@ -0,0 +1,89 @@
+import asyncio
+import io
+import json
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+from src.exceptions import ImageQualityError, custom_http_exception_handler
+from src.utils.image_quality import measure_quality, quality_problems
+
+THRESHOLDS = {"min_side": 480, "min_sharpness": 20, "min_exposure": 50, "max_glare": 0.2}
+
+
+def photo(width: int = 1280, height: int = 960, scale: float = 1.0, blur: float = 0, glare: float = 0, fmt: str = "JPEG") -> bytes:
+    """A gray panel with light digit-like bars, optionally darkened, blurred or partly blown out."""
+    pixels = np.full((height, width), 90, np.float32)
+    for x in range(width // 10, width - width // 10, width // 20):
+        pixels[height // 3:2 * height // 3, x:x + width // 60] = 220
+    pixels *= scale
+    if glare:
+        pixels[:round(height * glare)] = 255
+    img = Image.fromarray(pixels.clip(0, 255).astype(np.uint8))
+    if blur:
+        img = img.filter(ImageFilter.GaussianBlur(blur))
+    buffer = io.BytesIO()
+    img.save(buffer, fmt)
+    return buffer.getvalue()
+
+
+def test_scores_of_a_good_photo():
+    scores = measure_quality(photo())
+    assert scores["width"] == 1280
+    assert scores["height"] == 960
+    assert scores["sharpness"] > 100
+    assert 200 < scores["exposure"] <= 225
+    assert scores["glare"] == 0
+    assert quality_problems(scores, THRESHOLDS) == {}
+
+
+def test_scores_of_a_png():
+    scores = measure_quality(photo(800, 600, fmt="PNG"))
+    assert (scores["width"], scores["height"]) == (800, 600)
+    assert quality_problems(scores, THRESHOLDS) == {}
+
+
+def test_blur_lowers_the_sharpness():
+    sharp = measure_quality(photo())["sharpness"]
+    blurry = measure_quality(photo(blur=12))
+    assert blurry["sharpness"] < sharp / 10
+    assert list(quality_problems(blurry, THRESHOLDS)) == ["blurry"]
+
+
+def test_dark_photo():
+    scores = measure_quality(photo(scale=0.15))
+    assert scores["exposure"] < 50
+    assert "dark" in quality_problems(scores, THRESHOLDS)
+
+
+def test_glare():
+    scores = measure_quality(photo(glare=0.5))
+    assert 0.45 < scores["glare"] < 0.55
+    assert list(quality_problems(scores, THRESHOLDS)) == ["glare"]
+
+
+def test_small_photo():
+    scores = measure_quality(photo(320, 240))
+    assert (scores["width"], scores["height"]) == (320, 240)
+    assert list(quality_problems(scores, THRESHOLDS)) == ["small"]
+
+
+def test_undecodable_image():
+    assert measure_quality(b"not an image") is None
+    assert list(quality_problems(None, THRESHOLDS)) == ["undecodable"]
+
+
+def test_thresholds_decide():
+    scores = measure_quality(photo(blur=12))
+    assert quality_problems(scores, {**THRESHOLDS, "min_sharpness": 0}) == {}
+
+
+def test_rejection_response_lists_the_problems_and_scores():
+    scores = measure_quality(photo(scale=0.15, blur=12))
+    problems = quality_problems(scores, THRESHOLDS)
+    response = asyncio.run(custom_http_exception_handler(None, ImageQualityError(problems, scores)))
+    body = json.loads(response.body)
+    assert response.status_code == 422
+    assert [error["problem"] for error in body["errors"]] == ["blurry", "dark"]
+    assert body["scores"] == scores
+    assert body["message"].startswith("Photo rejected, please retake it: blurry")
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from src.utils.inference_backends import detections_agreement, letterbox, non_max_suppression
+
+
+def anchor(cx, cy, w, h, objectness, class_scores):
+    return [cx, cy, w, h, objectness, *class_scores]
+
+
+def test_letterbox_keeps_the_aspect_ratio_and_pads_evenly():
+    img = np.full((100, 200, 3), 255, np.uint8)
+    x, gain, (pad_x, pad_y) = letterbox(img, (64, 64))
+    assert x.shape == (3, 64, 64)
+    assert x.dtype == np.float32
+    assert gain == pytest.approx(0.32)
+    assert (pad_x, pad_y) == (0, 16)
+    # gray padding above and below, the image in between
+    assert np.allclose(x[:, :16], 114 / 255)
+    assert np.allclose(x[:, 48:], 114 / 255)
+    assert np.allclose(x[:, 16:48], 1.0)
+
+
+def test_letterbox_leaves_an_image_of_the_right_size_alone():
+    img = np.random.default_rng(0).integers(0, 256, (32, 48, 3), dtype=np.uint8)
+    x, gain, pad = letterbox(img, (32, 48))
+    assert gain == 1
+    assert pad == (0, 0)
+    assert np.allclose(x, img.transpose(2, 0, 1) / 255)
+
+
+def test_letterbox_splits_odd_padding():
+    x, _, (pad_x, pad_y) = letterbox(np.zeros((10, 21, 3), np.uint8), (16, 32))
+    assert x.shape == (3, 16, 32)
+    assert pad_x == 0
+    assert pad_y == pytest.approx(0.5 * (16 - round(10 * 32 / 21)))
+
+
+def test_nms_keeps_the_most_confident_of_overlapping_boxes():
+    prediction = np.array([
+        anchor(50, 50, 20, 20, 0.9, [0.9, 0.1]),
+        anchor(52, 51, 20, 20, 0.8, [0.9, 0.1]),
+        anchor(150, 150, 20, 20, 0.7, [0.9, 0.1]),
+    ], dtype=np.float32)
+    kept = non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, max_det=300)
+    assert kept.shape == (2, 6)
+    assert np.allclose(kept[0], [40, 40, 60, 60, 0.81, 0])
+    assert np.allclose(kept[1], [140, 140, 160, 160, 0.63, 0])
+
+
+def test_nms_never_suppresses_boxes_of_another_class():
+    prediction = np.array([
+        anchor(50, 50, 20, 20, 0.9, [0.9, 0.1]),
+        anchor(50, 50, 20, 20, 0.9, [0.1, 0.8]),
+    ], dtype=np.float32)
+    kept = non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, max_det=300)
+    assert sorted(kept[:, 5]) == [0, 1]
+
+
+def test_nms_drops_unsure_boxes_and_caps_the_detections():
+    # objectness above the threshold, but not once multiplied by the class score
+    unsure = np.array([anchor(50, 50, 20, 20, 0.9, [0.2, 0.1])], dtype=np.float32)
+    assert len(non_max_suppression(unsure, conf_thres=0.25, iou_thres=0.45, max_det=300)) == 0
+    prediction = np.array([
+        anchor(10, 10, 4, 4, 0.9, [0.9]),
+        anchor(30, 30, 4, 4, 0.8, [0.9]),
+        anchor(70, 70, 4, 4, 0.7, [0.9]),
+    ], dtype=np.float32)
+    kept = non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, max_det=2)
+    assert np.allclose(kept[:, 4], [0.81, 0.72])
+
+
+def test_nms_of_an_empty_prediction():
+    kept = non_max_suppression(np.zeros((0, 7), np.float32), conf_thres=0.25, iou_thres=0.45, max_det=300)
+    assert kept.shape == (0, 6)
+
+
+def test_detections_agreement():
+    reference = np.array([[0, 0, 10, 10, 0.9, 0], [20, 20, 30, 30, 0.9, 1]], dtype=np.float32)
+    assert detections_agreement(reference, reference) == 1
+    # the second box found with the wrong class, and an extra box
+    candidate = np.array([[1, 1, 10, 10, 0.8, 0], [20, 20, 30, 30, 0.9, 0], [50, 50, 60, 60, 0.5, 1]], dtype=np.float32)
+    assert detections_agreement(reference, candidate) == pytest.approx(1 / 3)
+    assert detections_agreement(reference[:0], reference[:0]) == 1
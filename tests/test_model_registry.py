@@ -0,0 +1,114 @@
+import os
+
+import pytest
+
+from src.utils.model_registry import ModelRegistry
+
+# model name -> size in bytes of the fake models
+SIZES = {"a": 100, "b": 200, "c": 300, "large": 5000}
+
+
+class FakeModel:
+    def __init__(self, name: str):
+        self.name = name
+        self.size = SIZES.get(name, 100)
+
+
+def make_registry(max_models: int = 0, max_bytes: int = 0) -> tuple[ModelRegistry, list[str]]:
+    loads = []
+
+    def loader(model_name: str) -> FakeModel:
+        if model_name == "broken":
+            raise ValueError("can't load broken")
+        loads.append(model_name)
+        return FakeModel(model_name)
+
+    return ModelRegistry(loader=loader, sizer=lambda model: model.size, max_models=max_models, max_bytes=max_bytes), loads
+
+
+def test_loads_on_first_use_only():
+    registry, loads = make_registry()
+    model = registry.get("a")
+    assert model.name == "a"
+    assert registry.get("a") is model
+    assert loads == ["a"]
+    assert "a" in registry
+    assert "b" not in registry
+
+
+def test_evicts_the_least_recently_used_model_by_count():
+    registry, loads = make_registry(max_models=2)
+    registry.get("a")
+    registry.get("b")
+    # a is used again, so b is the least recently used one
+    registry.get("a")
+    registry.get("c")
+    assert registry.keys() == ["a", "c"]
+    registry.get("b")
+    assert registry.keys() == ["c", "b"]
+    assert loads == ["a", "b", "c", "b"]
+
+
+def test_evicts_by_byte_budget():
+    registry, _ = make_registry(max_bytes=500)
+    registry.get("a")
+    registry.get("b")
+    assert registry.total_bytes() == 300
+    registry.get("c")
+    # 600 bytes, a alone brings it back under the budget
+    assert registry.keys() == ["b", "c"]
+    assert registry.total_bytes() == 500
+
+
+def test_a_model_larger_than_the_budget_stays_loaded():
+    registry, _ = make_registry(max_bytes=500)
+    registry.get("a")
+    registry.get("b")
+    large = registry.get("large")
+    # the others are evicted, the model just loaded is kept even over budget
+    assert registry.keys() == ["large"]
+    assert registry.is_over_budget()
+    assert registry.get("large") is large
+    registry.get("a")
+    assert registry.keys() == ["a"]
+
+
+def test_no_limits():
+    registry, _ = make_registry()
+    for name in ["a", "b", "c", "large"]:
+        registry.get(name)
+    assert registry.keys() == ["a", "b", "c", "large"]
+    assert not registry.is_over_budget()
+
+
+def test_add_replaces_and_remove_unloads():
+    registry, loads = make_registry()
+    first = registry.get("a")
+    assert registry.add("a") is not first
+    registry.remove("a")
+    registry.remove("unknown")
+    assert registry.keys() == []
+    assert loads == ["a", "a"]
+
+
+def test_a_model_that_fails_to_load_is_not_kept():
+    registry, _ = make_registry()
+    with pytest.raises(ValueError):
+        registry.get("broken")
+    assert registry.keys() == []
+    assert registry.stats()["misses"] == 1
+
+
+def test_stats():
+    registry, _ = make_registry(max_models=2)
+    registry.get("a")
+    registry.get("a")
+    registry.get("b")
+    registry.get("c")
+    registry.get("c")
+    stats = registry.stats()
+    assert stats["pid"] == os.getpid()
+    assert stats["loaded_models"] == ["b", "c"]
+    assert stats["loaded_bytes"] == 500
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (2, 3, 1)
+    assert stats["load_seconds"] >= 0
@@ -0,0 +1,175 @@
+from datetime import datetime, timedelta
+
+import mongomock
+import pytest
+
+from src.data_gathering import schemas
+from src.data_gathering.models import OcrJobInDB
+from src.data_gathering.schemas import OcrJobDB
+
+LEASE = timedelta(seconds=300)
+MAX_ATTEMPTS = 3
+
+
+class FakeDatabase:
+    def __init__(self, db):
+        self.db = db
+
+    def get_collection(self, collection_name: str):
+        return self.db[collection_name]
+
+
+@pytest.fixture
+def jobs(monkeypatch) -> OcrJobDB:
+    db = mongomock.MongoClient().db
+    monkeypatch.setattr(schemas, "Database", lambda: FakeDatabase(db))
+    return OcrJobDB()
+
+
+def add_job(jobs: OcrJobDB, created_at: datetime | None = None) -> OcrJobInDB:
+    created_at = created_at or datetime.now()
+    return jobs.add_ocr_job(OcrJobInDB(
+        counter_id="counter",
+        flavor="flavor",
+        size="size",
+        uploader_username="worker",
+        file_path="data/photo.jpg",
+        created_at=created_at,
+        updated_at=created_at,
+    ))
+
+
+def claim(
+        jobs: OcrJobDB,
+        claimed_by: str,
+        ocr_job_id: str | None = None,
+        now: datetime | None = None,
+        running_ids: list[str] | None = None,
+) -> OcrJobInDB | None:
+    stale_before = (now or datetime.now()) - LEASE
+    return jobs.claim_ocr_job(claimed_by, stale_before, MAX_ATTEMPTS, ocr_job_id, running_ids)
+
+
+def test_claims_the_oldest_queued_job_once(jobs):
+    older = add_job(jobs, datetime.now() - timedelta(minutes=1))
+    newer = add_job(jobs)
+
+    first = claim(jobs, "a")
+    assert first.id == older.id
+    assert first.status == "running"
+    assert first.claimed_by == "a"
+    assert first.attempts == 1
+    assert claim(jobs, "b").id == newer.id
+    assert claim(jobs, "c") is None
+
+
+def test_claims_a_given_job(jobs):
+    add_job(jobs, datetime.now() - timedelta(minutes=1))
+    job = add_job(jobs)
+    assert claim(jobs, "a", job.id).id == job.id
+    assert claim(jobs, "b", job.id) is None
+
+
+def test_finish_only_by_the_claiming_process(jobs):
+    job = add_job(jobs)
+    claim(jobs, "a")
+    jobs.finish_ocr_job(job.id, "b", data_id="data")
+    assert jobs.get_ocr_job(job.id).status == "running"
+
+    jobs.finish_ocr_job(job.id, "a", data_id="data")
+    done = jobs.get_ocr_job(job.id)
+    assert (done.status, done.data_id, done.error) == ("done", "data", None)
+    # a finished job is never claimed again
+    assert claim(jobs, "b", now=datetime.now() + 2 * LEASE) is None
+
+
+def test_finish_with_an_error(jobs):
+    job = add_job(jobs)
+    claim(jobs, "a")
+    jobs.finish_ocr_job(job.id, "a", error="No OCR models found for this counter")
+    failed = jobs.get_ocr_job(job.id)
+    assert (failed.status, failed.data_id, failed.error) == ("failed", None, "No OCR models found for this counter")
+
+
+def test_a_stale_claim_is_taken_over(jobs):
+    job = add_job(jobs)
+    claim(jobs, "a")
+    # the lease of a is still running
+    assert claim(jobs, "b") is None
+
+    later = datetime.now() + 2 * LEASE
+    taken = claim(jobs, "b", now=later)
+    assert (taken.id, taken.claimed_by, taken.attempts) == (job.id, "b", 2)
+    # a finishing late doesn't overwrite the job of b
+    jobs.finish_ocr_job(job.id, "a", data_id="data")
+    assert jobs.get_ocr_job(job.id).status == "running"
+    jobs.finish_ocr_job(job.id, "b", data_id="data")
+    assert jobs.get_ocr_job(job.id).status == "done"
+
+
+def test_abandoned_jobs_fail_after_their_last_attempt(jobs):
+    job = add_job(jobs)
+    now = datetime.now()
+    for attempt in range(MAX_ATTEMPTS):
+        now += 2 * LEASE
+        assert claim(jobs, f"process-{attempt}", now=now).attempts == attempt + 1
+    now += 2 * LEASE
+    assert claim(jobs, "another", now=now) is None
+
+    # only once the last claim is stale, the claims are stamped with the real time
+    assert jobs.fail_abandoned_ocr_jobs(datetime.now() - LEASE, MAX_ATTEMPTS) == 0
+    assert jobs.fail_abandoned_ocr_jobs(datetime.now() + LEASE, MAX_ATTEMPTS) == 1
+    failed = jobs.get_ocr_job(job.id)
+    assert (failed.status, failed.error) == ("failed", "The job was abandoned too many times")
+
+
+def test_abandoned_jobs_with_attempts_left_are_not_failed(jobs):
+    add_job(jobs)
+    claim(jobs, "a")
+    assert jobs.fail_abandoned_ocr_jobs(datetime.now() + 2 * LEASE, MAX_ATTEMPTS) == 0
+
+
+def test_requeue_counts_the_attempt(jobs):
+    job = add_job(jobs)
+    claim(jobs, "a")
+    assert jobs.requeue_ocr_job(job.id, "a", MAX_ATTEMPTS, "OCR queue is full") == "queued"
+    queued = jobs.get_ocr_job(job.id)
+    assert (queued.status, queued.claimed_by, queued.attempts) == ("queued", None, 1)
+
+    # claimed again right away, without waiting for the lease
+    assert claim(jobs, "b").attempts == 2
+    assert jobs.requeue_ocr_job(job.id, "a", MAX_ATTEMPTS, "OCR queue is full") is None
+    assert jobs.requeue_ocr_job(job.id, "b", MAX_ATTEMPTS, "OCR queue is full") == "queued"
+    claim(jobs, "c")
+    assert jobs.requeue_ocr_job(job.id, "c", MAX_ATTEMPTS, "OCR queue is full") == "failed"
+    failed = jobs.get_ocr_job(job.id)
+    assert (failed.status, failed.error, failed.attempts) == ("failed", "OCR queue is full", MAX_ATTEMPTS)
+
+
+def test_a_process_never_claims_the_jobs_it_runs(jobs):
+    job = add_job(jobs)
+    claim(jobs, "a")
+    later = datetime.now() + 2 * LEASE
+    assert claim(jobs, "a", now=later, running_ids=[job.id]) is None
+    assert claim(jobs, "a", job.id, now=later, running_ids=[job.id]) is None
+    # other jobs are still claimed
+    other = add_job(jobs)
+    assert claim(jobs, "a", now=later, running_ids=[job.id]).id == other.id
+
+
+def test_a_renewed_claim_is_not_taken_over(jobs):
+    job = add_job(jobs)
+    claim(jobs, "a")
+    # the job has been running for two leases
+    jobs.collection.update_one({}, {"$set": {"claimed_at": datetime.now() - 2 * LEASE}})
+    assert jobs.renew_ocr_job_claim(job.id, "a")
+    assert claim(jobs, "b") is None
+    assert jobs.get_ocr_job(job.id).claimed_by == "a"
+
+
+def test_only_the_claiming_process_renews(jobs):
+    job = add_job(jobs)
+    claim(jobs, "a")
+    assert not jobs.renew_ocr_job_claim(job.id, "b")
+    jobs.finish_ocr_job(job.id, "a", data_id="data")
+    assert not jobs.renew_ocr_job_claim(job.id, "a")
@@ -0,0 +1,65 @@
+import threading
+
+import pytest
+
+from src.config import APP_SETTINGS
+from src.utils.result_cache import ResultCache
+
+
+@pytest.fixture
+def cache(monkeypatch) -> ResultCache:
+    monkeypatch.setattr(APP_SETTINGS, "OCR_RESULT_CACHE_SIZE", 16)
+    monkeypatch.setattr(APP_SETTINGS, "OCR_RESULT_CACHE_MONGO", False)
+    monkeypatch.setattr(ResultCache, "_instance", None)
+    return ResultCache()
+
+
+def test_results_are_cached_per_image_and_model(cache):
+    results = {"values": {"Total Production": "123"}, "confidences": {"Total Production": 0.9}}
+    assert cache.get(b"photo", "model:1") is None
+    cache.set(b"photo", "model:1", results, inference_seconds=0.5)
+    assert cache.get(b"photo", "model:1") == results
+    assert cache.get(b"photo", "model:2") is None
+    assert cache.get(b"another photo", "model:1") is None
+    assert cache.stats() == {
+        "entries": 1,
+        "hits": 1,
+        "misses": 3,
+        "hit_rate": 0.25,
+        "saved_inference_seconds": 0.5,
+    }
+
+
+def test_concurrent_lookups_from_the_threadpool(cache):
+    errors = []
+
+    def upload(thread: int):
+        try:
+            for i in range(2000):
+                contents = f"photo {(thread * 7 + i) % 40}".encode()
+                if cache.get(contents, "model:1") is None:
+                    cache.set(contents, "model:1", {"values": {}}, inference_seconds=0.0)
+                cache.stats()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=upload, args=(thread,)) for thread in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    stats = cache.stats()
+    assert stats["hits"] + stats["misses"] == 8 * 2000
+    assert stats["entries"] == 16
+
+
+def test_a_single_instance_across_threads(monkeypatch):
+    monkeypatch.setattr(ResultCache, "_instance", None)
+    instances = []
+    threads = [threading.Thread(target=lambda: instances.append(ResultCache())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(instance) for instance in instances}) == 1
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from src.utils.seven_segment import read_seven_segment
+
+SEGMENTS = {
+    "0": "abcdef", "1": "bc", "2": "abdeg", "3": "abcdg", "4": "bcfg",
+    "5": "acdfg", "6": "acdefg", "7": "abc", "8": "abcdefg", "9": "abcdfg",
+}
+
+
+def render(digits: str, height: int = 60, width: int = 32, thickness: int = 7, gap: int = 12) -> np.ndarray:
+    """A display crop with light segments on a dark background, a "1" only drawing its right segments like a real display."""
+    img = np.full((height + 2 * gap, len(digits) * (width + gap) + gap), 20, np.uint8)
+    h, w, t = height, width, thickness
+    for i, digit in enumerate(digits):
+        x, y = gap + i * (width + gap), gap
+        regions = {
+            "a": (x + t, y, x + w - t, y + t),
+            "b": (x + w - t, y + t // 2, x + w, y + h // 2),
+            "c": (x + w - t, y + h // 2, x + w, y + h - t // 2),
+            "d": (x + t, y + h - t, x + w - t, y + h),
+            "e": (x, y + h // 2, x + t, y + h - t // 2),
+            "f": (x, y + t // 2, x + t, y + h // 2),
+            "g": (x + t, y + h // 2 - t // 2, x + w - t, y + h // 2 + t // 2 + 1),
+        }
+        for segment in SEGMENTS[digit]:
+            x1, y1, x2, y2 = regions[segment]
+            img[y1:y2, x1:x2] = 230
+    return img
+
+
+@pytest.mark.parametrize("digits", ["0123456789", "98765", "2024"])
+def test_reads_every_digit(digits):
+    result = read_seven_segment(render(digits))
+    assert result is not None
+    assert result[0] == digits
+    assert result[1] > 0
+
+
+# thin strokes, and bold ones whose "1" is between a quarter and a third as wide as it is tall
+@pytest.mark.parametrize("thickness, width", [(7, 32), (8, 36), (13, 56), (14, 60)])
+@pytest.mark.parametrize("digits", ["1", "11", "171", "111", "10", "81"])
+def test_reads_ones(digits, thickness, width):
+    result = read_seven_segment(render(digits, height=60, width=width, thickness=thickness))
+    assert result is not None
+    assert result[0] == digits
+
+
+@pytest.mark.parametrize("digits", ["7", "3", "77", "373"])
+def test_narrow_sevens_and_threes_are_not_ones(digits):
+    # narrow displays, where a 7 or a 3 is less than a third as wide as it is tall
+    result = read_seven_segment(render(digits, height=60, width=18, thickness=4))
+    assert result is not None
+    assert result[0] == digits
+
+
+def test_reads_dark_digits_on_a_light_background():
+    result = read_seven_segment(255 - render("2071"))
+    assert result is not None
+    assert result[0] == "2071"
+
+
+def test_blank_display_has_no_digits():
+    assert read_seven_segment(np.full((80, 200), 20, np.uint8)) is None
+    assert read_seven_segment(np.zeros((0, 0), np.uint8)) is None
@@ -0,0 +1,66 @@
+import numpy as np
+
+from src.utils.ocr_model import image_tiles, merge_tile_detections, tile_origins
+
+
+def test_tile_origins_end_at_the_edge():
+    assert tile_origins(500, 640, 480) == [0]
+    assert tile_origins(640, 640, 480) == [0]
+    assert tile_origins(1280, 640, 480) == [0, 480, 640]
+    assert tile_origins(1000, 400, 300) == [0, 300, 600]
+
+
+def test_image_tiles_cover_the_image():
+    tiles = image_tiles((960, 1280, 3), 640, 0.25)
+    assert tiles == [
+        (0, 0, 640, 640), (480, 0, 1120, 640), (640, 0, 1280, 640),
+        (0, 320, 640, 960), (480, 320, 1120, 960), (640, 320, 1280, 960),
+    ]
+    covered = np.zeros((960, 1280), bool)
+    for x1, y1, x2, y2 in tiles:
+        covered[y1:y2, x1:x2] = True
+    assert covered.all()
+
+
+def test_image_tiles_of_a_small_image():
+    assert image_tiles((300, 400), 640, 0.25) == [(0, 0, 400, 300)]
+
+
+def test_merge_grows_the_best_box_over_the_parts_cut_by_the_tiles():
+    det = np.array([
+        # one display cut in two by a tile edge, and the whole display seen by the full image
+        [0.10, 0.10, 0.30, 0.20, 0.6, 0],
+        [0.25, 0.10, 0.40, 0.20, 0.5, 0],
+        [0.12, 0.11, 0.38, 0.19, 0.9, 0],
+    ], dtype=np.float32)
+    merged = merge_tile_detections(det)
+    assert merged.shape == (1, 6)
+    assert np.allclose(merged[0], [0.10, 0.10, 0.40, 0.20, 0.9, 0])
+
+
+def test_merge_keeps_the_best_box_of_every_class_apart():
+    det = np.array([
+        [0.10, 0.10, 0.30, 0.20, 0.7, 0],
+        [0.10, 0.10, 0.30, 0.20, 0.8, 1],
+        # the same class far from its best box, e.g. a false positive in another tile
+        [0.70, 0.70, 0.90, 0.80, 0.4, 0],
+    ], dtype=np.float32)
+    merged = merge_tile_detections(det)
+    assert np.allclose(merged, [
+        [0.10, 0.10, 0.30, 0.20, 0.7, 0],
+        [0.10, 0.10, 0.30, 0.20, 0.8, 1],
+    ])
+
+
+def test_merge_needs_enough_overlap():
+    det = np.array([
+        [0.10, 0.10, 0.30, 0.20, 0.9, 0],
+        # overlaps a tenth of its area
+        [0.28, 0.10, 0.48, 0.20, 0.5, 0],
+    ], dtype=np.float32)
+    assert np.allclose(merge_tile_detections(det, min_overlap=0.3), det[:1])
+    assert np.allclose(merge_tile_detections(det, min_overlap=0.05)[0, :4], [0.10, 0.10, 0.48, 0.20])
+
+
+def test_merge_of_no_detections():
+    assert merge_tile_detections(np.zeros((0, 6), np.float32)).shape == (0, 6)